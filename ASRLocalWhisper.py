@@ -1,10 +1,14 @@
 import gc
 
+import numpy as np
 import torch
 import whisperx
 
+from Config import vadEnabled
+from PhraseChunker import WordArrays, findPhraseEnds, splitAtPhraseEnds
 from TranscribedPhrase import TranscribedPhrase
 from ASRInterface import ASRInterface
+from VoiceActivityDetector import keepSpeechOnly
 
 
 class ASRLocalWhisper(ASRInterface):
@@ -54,6 +58,10 @@ def doASR(pathToFile, prompt, language):
         asr_options=customAsrOptions
     )
     audio = whisperx.load_audio(pathToFile)
+    timeline = None
+    if vadEnabled:
+        # only transcribe speech, timestamps are mapped back to the original timeline after alignment
+        audio, timeline = keepSpeechOnly(audio, whisperx.audio.SAMPLE_RATE)
     result = model.transcribe(audio, batch_size=16, language=language)
 
     print("--- raw transcript ---")
@@ -69,8 +77,17 @@ def doASR(pathToFile, prompt, language):
     resultAligned = whisperx.align(result["segments"], modelAligned, metadata, audio, "cuda",
                                    return_char_alignments=False)
     cleanUpGPU([model, modelAligned])
+    if timeline:
+        mapToOriginalTimeline(resultAligned, timeline)
     return resultAligned
 
+def mapToOriginalTimeline(resultAligned, timeline):
+    for segment in resultAligned["segments"]:
+        for item in [segment] + segment.get("words", []):
+            for key in ("start", "end"):
+                if key in item:
+                    item[key] = timeline.toOriginal(item[key])
+
 def cleanUpGPU(modelsToDelete):
     gc.collect()
     torch.cuda.empty_cache()
@@ -78,29 +95,24 @@ def cleanUpGPU(modelsToDelete):
         del model
 
 def getChunks(resultAligned):
-    toBreakOn = {"。", "？", "?"} #"、", ",", ".",
-    chunks = []
-    currentPart = None
-
+    words = []
+    forcedBreaks = []
     for segment in resultAligned["segments"]:
-        for word in segment["words"]:
-            if not currentPart:
-                currentPart = TranscribedPhrase()
-            currentPart.text += word["word"]
-            if currentPart.start is None and "start" in word:
-                currentPart.start = word["start"]
-            if "end" in word:
-                currentPart.end = word["end"]
+        segmentWords = [word for word in segment["words"] if word["word"]]
+        words.extend(segmentWords)
+        # never join words across whisper segments
+        forcedBreaks.extend([False] * (len(segmentWords) - 1) + [True] * bool(segmentWords))
 
-            if word["word"] in toBreakOn:
-                chunks.append(currentPart)
-                currentPart = None
-        # include the current sentence even if it hasn't ended
-        if currentPart:
-            chunks.append(currentPart)
-            currentPart = None
-    # include the current sentence even if it hasn't ended
-    if currentPart:
-        chunks.append(currentPart)
+    # the aligner can't always place a word (e.g. numbers), so borrow timings from the previous word
+    starts = []
+    ends = []
+    previousEnd = next((word["start"] for word in words if "start" in word), 0.0)
+    for word in words:
+        starts.append(word.get("start", previousEnd))
+        ends.append(word.get("end", starts[-1]))
+        previousEnd = ends[-1]
 
-    return chunks
+    wordArrays = WordArrays.fromWords(starts, ends, [word["word"] for word in words], np.array(forcedBreaks, dtype=bool))
+    return [TranscribedPhrase(line[0][0], line[-1][1], "".join(text for start, end, text in line))
+            for line in splitAtPhraseEnds(list(zip(starts, ends, [word["word"] for word in words])),
+                                          findPhraseEnds(wordArrays))]
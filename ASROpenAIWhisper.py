@@ -1,176 +1,335 @@
+import asyncio
 import io
-from typing import List
+from typing import AsyncIterator, Iterator, List, Optional
 
-from openai import OpenAI
-from pydub import AudioSegment
+from openai.types.audio import TranscriptionWord
 
+from AudioEncoder import SegmentEncoder, speechSampleRate, speechChannels
+from AudioSegmentPlanner import planSegments, PlannedSegment
+from AudioSource import openAudioSource
+from AsyncUtils import iterateInThread
+from Config import whisperConcurrency, vadEnabled
+from JobJournal import JobJournal
+from RateLimiter import rateLimiterFor
 from Logger import logger
+from OpenAIClients import openAIClient, asyncOpenAIClient
+from PhraseChunker import WordArrays, defaultChunkingSettings, findPhraseEnds, splitAtPhraseEnds
+from TranscriptStitcher import offsetWords, SeamStitcher, StitchedTranscript
+from TranscriptStore import TranscriptStore
+from VoiceActivityDetector import SpanAudioSource, detectSpeech, subtractSpans
 from ASRInterface import ASRInterface
 from TranscribedPhrase import TranscribedPhrase
 
 
 class ASROpenAIWhisper(ASRInterface):
-    def speechToText(self, filepath, prompt, language) -> List[TranscribedPhrase]:
+    def speechToText(self, filepath, prompt, language, skipSpans=()) -> List[TranscribedPhrase]:
+        """
+        skipSpans are (start, end) times of audio which doesn't need transcribing, e.g. because it was reused
+        from an earlier run
+        """
         logger.info("Beginning OpenAI Whisper speech to text transcription")
+        audioSource = openAudioSource(filepath, speechSampleRate, speechChannels)
+
+        # the raw word timings are stored, so changing the chunking settings doesn't mean paying for ASR again
+        transcriptStore = TranscriptStore()
+        storeKey = TranscriptStore.key(audioSource.contentHash(), getASRSettings(prompt, language, skipSpans))
+        storedTranscript = transcriptStore.get(storeKey)
+        if storedTranscript is not None:
+            logger.info("Skipping transcription, using stored transcript")
+            return chunkTranscription(StitchedTranscript(storedTranscript.words()), 0)
+
+        # segments are journalled as they finish, so a crash doesn't mean paying for them again
+        journal = JobJournal(f"asr-{storeKey}")
+        audioSource, energyDb, encoder = self.prepareAudio(audioSource, skipSpans)
+        if whisperConcurrency > 1:
+            words = asyncio.run(collectWords(self.transcribeParallel(encoder, energyDb, prompt, language, journal=journal)))
+        else:
+            words = [word for segmentWords in self.transcribeSequential(encoder, energyDb, prompt, language, journal=journal)
+                     for word in segmentWords]
+
+        transcriptStore.put(storeKey, words)
+        journal.remove()
+        return chunkTranscription(StitchedTranscript(words), 0)
+
+    async def speechToTextStream(self, filepath, prompt, language, skipSpans=()) -> AsyncIterator[List[TranscribedPhrase]]:
+        """
+        Same as speechToText, but yields phrases in order as each segment is transcribed,
+        so later stages can start before the whole file is done
+        """
+        logger.info("Beginning OpenAI Whisper streaming speech to text transcription")
+        audioSource = openAudioSource(filepath, speechSampleRate, speechChannels)
+
+        transcriptStore = TranscriptStore()
+        storeKey = TranscriptStore.key(audioSource.contentHash(),
+                                       getASRSettings(prompt, language, skipSpans, streamingSegmentSeconds))
+        storedTranscript = transcriptStore.get(storeKey)
+        if storedTranscript is not None:
+            logger.info("Skipping transcription, using stored transcript")
+            yield chunkTranscription(StitchedTranscript(storedTranscript.words()), 0)
+            return
+
+        journal = JobJournal(f"asr-{storeKey}")
+        # in a thread, so voice activity detection doesn't hold up other files being processed at the same time
+        audioSource, energyDb, encoder = await asyncio.to_thread(self.prepareAudio, audioSource, skipSpans)
+        if whisperConcurrency > 1:
+            segmentWordsStream = self.transcribeParallel(encoder, energyDb, prompt, language, streamingSegmentSeconds,
+                                                         journal)
+        else:
+            segmentWordsStream = iterateInThread(self.transcribeSequential(encoder, energyDb, prompt, language,
+                                                                           streamingSegmentSeconds, journal))
+
+        words = []
+        pendingWords = []
+        async for segmentWords in segmentWordsStream:
+            words.extend(segmentWords)
+            pendingWords.extend(segmentWords)
+            # the last line might continue into the next segment, every line before it is final
+            phraseEnds = findPhraseEnds(WordArrays.fromWords([word.start for word in pendingWords],
+                                                             [word.end for word in pendingWords],
+                                                             [word.word for word in pendingWords]))
+            finishedWordCount = phraseEnds[-2] + 1 if len(phraseEnds) >= 2 else 0
+            yield chunkTranscription(StitchedTranscript(pendingWords[:finishedWordCount]), 0)
+            pendingWords = pendingWords[finishedWordCount:]
+
+        transcriptStore.put(storeKey, words)
+        journal.remove()
+        yield chunkTranscription(StitchedTranscript(pendingWords), 0)
+
+    def prepareAudio(self, audioSource, skipSpans):
+        # decode once, and choose every cut point before uploading anything
+        if vadEnabled or skipSpans:
+            # only send speech that still needs transcribing to whisper,
+            # timestamps are mapped back to the original timeline before chunking
+            spans = detectSpeech(audioSource) if vadEnabled else [(0.0, audioSource.durationSeconds)]
+            audioSource = SpanAudioSource(audioSource, subtractSpans(spans, skipSpans))
+        energyDb = audioSource.energyDb()
+        return audioSource, energyDb, SegmentEncoder(audioSource, energyDb)
+
+    def transcribeSequential(self, encoder, energyDb, prompt, language, maxSegmentSeconds=None,
+                             journal: Optional[JobJournal] = None) -> Iterator[List[TranscriptionWord]]:
+        """
+        Yields the words of each segment in order, as each one is transcribed.
+        Each segment's words are journalled along with the segments still left to transcribe after it
+        """
+        audioSource = encoder.audioSource
+        durationSeconds = audioSource.durationSeconds
+        segmentSeconds = min(encoder.maxSegmentSeconds(), maxSegmentSeconds or float("inf"))
+        segments = planSegments(energyDb, durationSeconds, segmentSeconds)
+
+        journalledSegments = journal.find("sequentialSegment") if journal else []
+        if journalledSegments:
+            logger.info(f"Resuming transcription after {len(journalledSegments)} journalled segment(s)")
+        for entry in journalledSegments:
+            segments = [PlannedSegment(*segment) for segment in entry["remainingSegments"]]
+            yield wordsFromJournal(entry["words"])
+
+        def journalSegment(words, remainingSegments):
+            if journal:
+                journal.append("sequentialSegment", words=wordsToJournal(words),
+                               remainingSegments=[segmentToJournal(segment) for segment in remainingSegments])
+            return words
+
         audioBuffer = io.BytesIO()
         audioBuffer.name = "timetosimp.webm"  # dummy file name so openai doesn't throw errors
 
-        endOfFile = False
-        startTimeSeconds = 0
-        transcriptAllLines = []
+        i = 0
 
-        while not endOfFile:
+        while i < len(segments):
+            segment = segments[i]
+            i += 1
             logger.info("--- Beginning segment transcription ---")
-            # clear the buffer to save memory
-            audioBuffer.seek(0)
-            audioBuffer.truncate(0)
+            encodedSegment = encoder.encode(segment, audioBuffer)
+            if encodedSegment.end < segment.end:
+                # too large to upload, so the rest of the segment gets transcribed next
+                segments.insert(i, PlannedSegment(encodedSegment.end, segment.end, segment.cleanCut))
+                segment = encodedSegment
 
-            endTimeSeconds, endOfFile = chunkAudio24MB(filepath, audioBuffer, startTimeSeconds)
-            logger.info(f"Transcribing audio: {startTimeSeconds}s to {endTimeSeconds}s")
+            logger.info(f"Transcribing audio: {segment.start:.1f}s to {segment.end:.1f}s")
             rawTranscript = getTranscript(audioBuffer, prompt, language)
-            transcriptLines = chunkTranscription(rawTranscript, startTimeSeconds)
-
-            if len(transcriptLines):
-                if endTimeSeconds - transcriptLines[-1].end > silenceTimeThreshold:
-                    # audio didn't cut mid-sentence
-                    transcriptAllLines.extend(transcriptLines)
-
-                    startTimeSeconds = endTimeSeconds
-                    # add some time padding
-                    if len(transcriptLines):
-                        startTimeSeconds = max(startTimeSeconds - 0.2, transcriptLines[-1].end)
-                else:
-                    # audio cut sentence in half, re-transcribe from the beginning of that sentence
-
-                    # handles edge case where there is only one chunk and it occupies the whole 30 seconds
-                    # otherwise we will endlessly loop that 30secs (until we run out of openai credit)
-                    # use 1 second threshold to detect this
-                    if len(transcriptLines) == 1 and (startTimeSeconds - transcriptLines[0].start) < 1:
-                        transcriptAllLines.extend(transcriptLines)
-                        startTimeSeconds = transcriptLines[0].end
-                    else:
-                        transcriptAllLines.extend(
-                            transcriptLines[:-1])  # add lines except the last line which got cut off
-
-                        startTimeSeconds = transcriptLines[-1].start  # continue from the beginning of the last line
-                        # add some time padding
-                        if len(transcriptLines) >= 2:
-                            startTimeSeconds = max(startTimeSeconds - 0.2, transcriptLines[-2].end)
-            else:
-                # no speech detected, move to next audio segment
-                startTimeSeconds = endTimeSeconds
-
-        return transcriptAllLines
-
-
-def chunkAudio24MB(filepath, newFileBuffer, startTimeSeconds, customLength = 0):
-    logger.info("Generating webm audio")
-
-    audio = AudioSegment.from_file(filepath)
-    bitrate = 256
-    chunkTimeSeconds = 15 * 8 * (1024 / bitrate) # create 15MB of audio
-    endTimeSeconds = startTimeSeconds + chunkTimeSeconds
-
-    # PyDub handles time in milliseconds
-    startTimeMs = startTimeSeconds * 1000
-    endTimeMs = min(len(audio), endTimeSeconds * 1000) # this index might be beyond the end of the list - this is ok because it's python
-    audioChunk = audio[startTimeMs:endTimeMs]
-    audioChunk.export(newFileBuffer, format="webm", bitrate=f"{bitrate}k", codec="libopus")
-    newFileBuffer.seek(0)
-
-    return endTimeSeconds, endTimeMs == len(audio)
-
-
-def getTranscript(audioFile, prompt, language):
-    client = OpenAI(max_retries=5, timeout=120)
-    return client.audio.transcriptions.create(
-        file=audioFile,
-        language=language,
-        model="whisper-1",
-        prompt=prompt,
-        response_format="verbose_json",
-        timestamp_granularities = ["word"]
-    )
-
-
-silenceTimeThreshold = 0.35 # any gaps longer than this will create a new subtitle line
-targetPhraseLength = 30 # words, will start searching harder for gaps after
-
-silenceTimeThresholdShort = 0.1 # when searching harder, any gaps longer than this will create a new subtitle line
-longWordTimeThreshold = 0.5 # when searching harder, any words longer than this will create a new subtitle line
-maxPhraseLength = 50 # words, will forcibly split the sentence here
-
-'''
-Chunking strategy - turning a stream of words into subtitle lines
-- Always break line on end of sentence punctuation
-- If within target line length, break if silence is over threshold
-- If beyond target line length, break if silence is over short threshold, or if word is longer than threshold
-- If at max line length, forcibly break
-'''
-def chunkTranscription(transcription, timeOffsetSeconds):
-    class PhraseBuffer:
-        phrases = []
-
-        start = None
-        end = None
-        textBuffer = []
+            words = offsetWords(rawTranscript.words, segment.start, audioSource.toOriginal)
+            transcriptLines = chunkTranscription(StitchedTranscript(words), 0)
+
+            segmentStart = audioSource.toOriginal(segment.start)
+            segmentEnd = audioSource.toOriginal(segment.end)
+            isLastSegment = i == len(segments)
+            if (segment.cleanCut or isLastSegment or not len(transcriptLines)
+                    or segmentEnd - transcriptLines[-1].end > defaultChunkingSettings.silenceTimeThreshold):
+                # audio didn't cut mid-sentence
+                yield journalSegment(words, segments[i:])
+                continue
 
-        def flush(self):
-            self.phrases.append(TranscribedPhrase(self.start + timeOffsetSeconds, self.end + timeOffsetSeconds, "".join(self.textBuffer)))
+            # rare fallback: no gap in speech was found near the size limit and the audio cut a sentence in half,
+            # so re-transcribe from the beginning of that sentence
 
-            self.start = None
-            self.end = None
-            self.textBuffer = []
+            # handles edge case where there is only one chunk and it occupies the whole segment
+            # otherwise we will endlessly loop that segment (until we run out of openai credit)
+            # use 1 second threshold to detect this
+            if len(transcriptLines) == 1 and (transcriptLines[0].start - segmentStart) < 1:
+                yield journalSegment(words, segments[i:])
+                continue
 
-            # print(f"[word],FLUSH,FLUSH,FLUSH")
+            restartSeconds = transcriptLines[-1].start  # continue from the beginning of the last line
+            # add some time padding
+            if len(transcriptLines) >= 2:
+                restartSeconds = max(restartSeconds - 0.2, transcriptLines[-2].end)
+            logger.info(f"Segment cut mid-sentence, re-planning from {restartSeconds:.1f}s")
+            segments = segments[:i] + planSegments(energyDb, durationSeconds, segmentSeconds,
+                                                   audioSource.toCompact(restartSeconds))
+
+            # add words except those in the last line which got cut off
+            yield journalSegment([word for word in words if word.start < transcriptLines[-1].start], segments[i:])
+
+    async def transcribeParallel(self, encoder, energyDb, prompt, language, maxSegmentSeconds=None,
+                                 journal: Optional[JobJournal] = None) -> AsyncIterator[List[TranscriptionWord]]:
+        """
+        Yields the stitched words of each segment in order, as soon as it and every segment before it are transcribed.
+        Each segment's unstitched words are journalled as soon as it is transcribed
+        """
+        # segments overlap slightly so whisper has context either side of each cut, and the stitcher removes duplicates
+        durationSeconds = encoder.audioSource.durationSeconds
+        # split long files into at least one segment per worker, otherwise there is nothing to parallelise
+        segmentSeconds = min(encoder.maxSegmentSeconds() - 2 * segmentOverlapSeconds,
+                             max(minParallelSegmentSeconds, durationSeconds / whisperConcurrency),
+                             maxSegmentSeconds or float("inf"))
+        segments = planSegments(energyDb, durationSeconds, segmentSeconds)
+
+        logger.info(f"Transcribing {len(segments)} segments, up to {whisperConcurrency} at a time")
+        client = asyncOpenAIClient("transcription")
+        semaphore = asyncio.Semaphore(whisperConcurrency)
+
+        async def transcribeSegment(segment):
+            async with semaphore:
+                extendedSegment = PlannedSegment(max(0.0, segment.start - segmentOverlapSeconds),
+                                                 min(durationSeconds, segment.end + segmentOverlapSeconds),
+                                                 segment.cleanCut)
+                audioBuffer = io.BytesIO()
+                audioBuffer.name = "timetosimp.webm"  # dummy file name so openai doesn't throw errors
+                encodedSegment = await asyncio.to_thread(encoder.encode, extendedSegment, audioBuffer)
+
+                logger.info(f"Transcribing audio: {encodedSegment.start:.1f}s to {encodedSegment.end:.1f}s")
+                rawTranscript = await getTranscriptAsync(client, audioBuffer, prompt, language)
+                logger.info(f"Finished transcribing audio: {encodedSegment.start:.1f}s to {encodedSegment.end:.1f}s")
+                words = offsetWords(rawTranscript.words, encodedSegment.start, encoder.audioSource.toOriginal)
+
+            if encodedSegment.end < extendedSegment.end:
+                # too large to upload, so transcribe the rest of the segment separately
+                shortenedSegment = PlannedSegment(segment.start, encodedSegment.end - segmentOverlapSeconds,
+                                                  encodedSegment.cleanCut)
+                remainingSegment = PlannedSegment(shortenedSegment.end, segment.end, segment.cleanCut)
+                return [(shortenedSegment, words)] + await transcribeSegment(remainingSegment)
+            return [(segment, words)]
+
+        # the same settings always plan the same segments, so journalled segments are found by their times
+        journalledSegments = {(entry["segment"][0], entry["segment"][1]): entry["results"]
+                              for entry in (journal.find("parallelSegment") if journal else [])}
+        if journalledSegments:
+            logger.info(f"Resuming transcription, {len(journalledSegments)} of {len(segments)} segment(s) are journalled")
+
+        async def transcribeOrReplaySegment(segment):
+            if (segment.start, segment.end) in journalledSegments:
+                return [(PlannedSegment(*transcribedSegment), wordsFromJournal(words))
+                        for transcribedSegment, words in journalledSegments[(segment.start, segment.end)]]
+            transcribedSegments = await transcribeSegment(segment)
+            if journal:
+                journal.append("parallelSegment", segment=[float(segment.start), float(segment.end)],
+                               results=[[segmentToJournal(transcribedSegment), wordsToJournal(words)]
+                                        for transcribedSegment, words in transcribedSegments])
+            return transcribedSegments
+
+        tasks = [asyncio.ensure_future(transcribeOrReplaySegment(segment)) for segment in segments]
+        stitcher = SeamStitcher()
+        try:
+            for i, task in enumerate(tasks):
+                transcribedSegments = await task
+                for j, (segment, words) in enumerate(transcribedSegments):
+                    isLastSegment = i == len(tasks) - 1 and j == len(transcribedSegments) - 1
+                    yield stitcher.add(words, float("inf") if isLastSegment else encoder.audioSource.toOriginal(segment.end))
+        finally:
+            for task in tasks:
+                task.cancel()
+        stitcher.logDropped()
+
+
+segmentOverlapSeconds = 2 # when transcribing in parallel, each segment is extended by this much either side
+minParallelSegmentSeconds = 300 # when transcribing in parallel, don't split segments shorter than this
+streamingSegmentSeconds = 300 # when streaming, keep segments short so the first phrases are ready sooner
+whisperModel = "whisper-1"
+
+
+def getASRSettings(prompt, language, skipSpans, maxSegmentSeconds=None):
+    # everything that changes the raw transcript of the same audio
+    settings = {
+        "model": whisperModel,
+        "prompt": prompt,
+        "language": language,
+        "vadEnabled": vadEnabled,
+        "skipSpans": [[start, end] for start, end in skipSpans],
+        "whisperConcurrency": whisperConcurrency,
+    }
+    if maxSegmentSeconds:
+        settings["maxSegmentSeconds"] = maxSegmentSeconds
+    return settings
+
+
+def segmentToJournal(segment: PlannedSegment) -> list:
+    # times and flags can be numpy types, which json can't write
+    return [float(segment.start), float(segment.end), bool(segment.cleanCut)]
+
+
+def wordsToJournal(words: List[TranscriptionWord]) -> list:
+    return [[word.word, float(word.start), float(word.end)] for word in words]
+
+
+def wordsFromJournal(entries) -> List[TranscriptionWord]:
+    return [TranscriptionWord(word=word, start=start, end=end) for word, start, end in entries]
+
+
+async def collectWords(segmentWordsStream) -> List[TranscriptionWord]:
+    return [word async for segmentWords in segmentWordsStream for word in segmentWords]
+
+
+async def getTranscriptAsync(client, audioFile, prompt, language):
+    def sendRequest():
+        audioFile.seek(0) # retries upload the file again from the start
+        return client.audio.transcriptions.with_raw_response.create(
+            file=audioFile,
+            language=language,
+            model=whisperModel,
+            prompt=prompt,
+            response_format="verbose_json",
+            timestamp_granularities = ["word"]
+        )
+    return await rateLimiterFor(whisperModel).call(sendRequest)
 
-        def addWord(self, word):
-            self.textBuffer.append(word.word)
-            if self.start is None: self.start = word.start
-            self.end = word.end
 
-            # print(f"[word],{word.start},{word.end},{word.word}")
+def getTranscript(audioFile, prompt, language):
+    client = openAIClient("transcription")
 
-    phraseBuffer = PhraseBuffer()
+    def sendRequest():
+        audioFile.seek(0) # retries upload the file again from the start
+        return client.audio.transcriptions.with_raw_response.create(
+            file=audioFile,
+            language=language,
+            model=whisperModel,
+            prompt=prompt,
+            response_format="verbose_json",
+            timestamp_granularities = ["word"]
+        )
+    return rateLimiterFor(whisperModel).callSync(sendRequest)
 
-    # TODO different languages have different punctuation, either swap delimiter characters or remove this feature entirely
-    toBreakOn = {"。", "？", "?"}
 
+def chunkTranscription(transcription, timeOffsetSeconds):
     # filter out empty words
     filteredWords = [word for word in transcription.words if word.word]
+    wordArrays = WordArrays.fromWords([word.start for word in filteredWords], [word.end for word in filteredWords],
+                                      [word.word for word in filteredWords])
 
-    for i in range(len(filteredWords)):
-        word = filteredWords[i]
-
-        # add word to chunk
-        phraseBuffer.addWord(word)
-
-        # if this is not the last word
-        if (i + 1) < len(filteredWords):
-            nextWord = filteredWords[i + 1]
-
-            if word.word[-1] in toBreakOn:
-                phraseBuffer.flush()
-                continue
-
-            silenceTime = nextWord.start - word.end
-            currWordTime = word.end - word.start
-            if len(phraseBuffer.textBuffer) <= targetPhraseLength:
-                if silenceTime > silenceTimeThreshold:
-                    phraseBuffer.flush()
-                    continue
-            elif len(phraseBuffer.textBuffer) < maxPhraseLength:
-                if silenceTime > silenceTimeThresholdShort or currWordTime > longWordTimeThreshold:
-                    phraseBuffer.flush()
-                    continue
-            else:
-                phraseBuffer.flush()
-                continue
-        else: # this is the last word
-            phraseBuffer.flush()
+    phrases = [TranscribedPhrase(words[0].start + timeOffsetSeconds, words[-1].end + timeOffsetSeconds,
+                                 "".join(word.word for word in words))
+               for words in splitAtPhraseEnds(filteredWords, findPhraseEnds(wordArrays))]
 
-    for phrase in phraseBuffer.phrases:
+    for phrase in phrases:
         logger.debug(f"[{phrase.start:.1f} - {phrase.end:.1f}] {phrase.text}")
     logger.info("Finished transcribing segment")
 
-    return phraseBuffer.phrases
+    return phrases
@@ -1,17 +1,22 @@
-from openai import OpenAI
+from OpenAIClients import openAIClient
+from RateLimiter import rateLimiterFor
 
 
 class ASROopenAIWhisperAsync:
     def __init__(self, messageBus):
         self.bus = messageBus
-        self.openAIClient = OpenAI()
+        # retries are left to the model's shared rate limiter, which backs off on rate limits
+        self.openAIClient = openAIClient("transcription")
 
     def getTranscript(self, audioFile, prompt, language):
-        return self.openAIClient.audio.transcriptions.create(
-            file=audioFile,
-            language=language,
-            model="whisper-1",
-            prompt=prompt,
-            response_format="verbose_json",
-            timestamp_granularities=["word"]
-        )
\ No newline at end of file
+        def sendRequest():
+            audioFile.seek(0) # retries upload the file again from the start
+            return self.openAIClient.audio.transcriptions.with_raw_response.create(
+                file=audioFile,
+                language=language,
+                model="whisper-1",
+                prompt=prompt,
+                response_format="verbose_json",
+                timestamp_granularities=["word"]
+            )
+        return rateLimiterFor("whisper-1").callSync(sendRequest)
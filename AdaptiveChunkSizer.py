@@ -0,0 +1,54 @@
+from TokenCounter import estimateTokens
+from Logger import logger
+
+
+initialTokenBudget = 5000 # estimated tokens of lines to translate per request, about 200 typical lines
+minTokenBudget = 300
+maxTokenBudget = 15000
+budgetIncrease = 500 # added after each complete response
+budgetDecrease = 0.5 # multiplied after each incomplete or slow response
+slowRequestSeconds = 600 # responses slower than this shrink the budget, so one stuck request doesn't hold up the file
+lineOverheadTokens = 10 # id and json around each line, in both the prompt and the response
+
+
+class AdaptiveChunkSizer:
+    """
+    Decides how many lines go in each translation request, from an estimated token budget that adapts during the run.
+    Additive increase, multiplicative decrease: the budget grows while chatgpt returns every line,
+    and halves whenever lines go missing, aiming for the fewest requests that still avoid the retry path
+    """
+    def __init__(self, tokenBudget=initialTokenBudget):
+        self.tokenBudget = tokenBudget
+
+    def chunkLength(self, phrases, start) -> int:
+        """
+        Number of lines from phrases[start] that fit in the budget, always at least one.
+        Lines that are already translated (e.g. cached) aren't sent, so they don't count
+        """
+        tokens = 0
+        for i in range(start, len(phrases)):
+            if not phrases[i].translatedText:
+                tokens += estimateTokens(phrases[i].text) + lineOverheadTokens
+            if tokens > self.tokenBudget and i > start:
+                return i - start
+        return len(phrases) - start
+
+    def chunkTokens(self, phrases) -> int:
+        return sum(estimateTokens(phrase.text) + lineOverheadTokens for phrase in phrases)
+
+    def onResponse(self, tokens, isComplete, latencySeconds):
+        """
+        Adapts the budget from a response to a request of the given estimated tokens
+        """
+        if tokens < self.tokenBudget / 2:
+            # small requests, e.g. retries of a few missing lines, say little about the budget
+            return
+
+        if not isComplete or latencySeconds > slowRequestSeconds:
+            # relative to the failed request, so requests that were already in flight don't shrink it again and again
+            newBudget = max(minTokenBudget, min(self.tokenBudget, tokens * budgetDecrease))
+            if newBudget < self.tokenBudget:
+                logger.info(f"Reducing translation request size to about {newBudget:.0f} tokens")
+            self.tokenBudget = newBudget
+        else:
+            self.tokenBudget = min(maxTokenBudget, self.tokenBudget + budgetIncrease)
@@ -18,4 +18,12 @@ def serialSubscriber(bus, eventType):
         asyncio.create_task(worker())
         return callback
 
-    return decorator
\ No newline at end of file
+    return decorator
+
+async def iterateInThread(generator):
+    """
+    Runs a blocking generator in a worker thread, so the event loop keeps running while it waits on each item
+    """
+    finished = object()
+    while (item := await asyncio.to_thread(next, generator, finished)) is not finished:
+        yield item
@@ -0,0 +1,97 @@
+import math
+import os
+import tempfile
+
+import numpy as np
+
+from AudioSegmentPlanner import PlannedSegment, planSegments
+from AudioSource import runFfmpeg
+from Logger import logger
+
+
+speechSampleRate = 16000 # whisper works at 16kHz internally, so anything higher is wasted upload
+speechChannels = 1
+maxUploadBytes = 24 * 1024 * 1024 # openai's limit is 25MB, leave some headroom
+targetFill = 0.95 # aim for segments this full, as the actual encoded size varies a little
+minBitrate = 16 # kbps, opus speech is still clear at this bitrate
+maxBitrate = 32 # kbps, there's no benefit going above this for mono speech
+maxSegmentDuration = 600 # seconds, longer uploads risk whisper not finishing within the transcription timeout,
+                         # and every retry uploading the whole segment again
+
+
+class SegmentEncoder:
+    """
+    Encodes segments of an AudioSource to opus, choosing a bitrate and segment length that fill the upload limit,
+    up to maxSegmentDuration
+    - The bitrate is the highest that still allows the fewest requests for the whole file
+    - The actual encoded size is checked, and oversized segments are shortened at a gap in speech
+    """
+    def __init__(self, audioSource, energyDb):
+        self.audioSource = audioSource
+        self.energyDb = energyDb
+
+        targetBytes = maxUploadBytes * targetFill
+        durationSeconds = max(1.0, audioSource.durationSeconds)
+        requestCount = max(math.ceil(durationSeconds * minBitrate * 1000 / 8 / targetBytes),
+                           math.ceil(durationSeconds / maxSegmentDuration))
+        self.bitrate = int(min(maxBitrate, max(minBitrate, targetBytes * 8 / 1000 * requestCount / durationSeconds)))
+        self.bytesPerSecond = self.bitrate * 1000 / 8
+
+        self.encodedSeconds = 0
+        self.encodedRequests = 0
+        logger.info(f"Encoding audio at {self.bitrate}kbps, expecting {requestCount} request(s)")
+
+    def maxSegmentSeconds(self):
+        return min(maxSegmentDuration, maxUploadBytes * targetFill / self.bytesPerSecond)
+
+    def encode(self, segment, outputBuffer) -> PlannedSegment:
+        """
+        Encodes the segment into outputBuffer, returning the segment that was actually encoded.
+        This ends earlier than the segment passed in if the original was too large to upload
+        """
+        while True:
+            outputBuffer.seek(0)
+            outputBuffer.truncate(0)
+            samples = self.audioSource.samples(segment.start, segment.end)
+            encodeWebm(samples, self.audioSource.sampleRate, self.audioSource.channels, outputBuffer, self.bitrate)
+
+            encodedBytes = outputBuffer.getbuffer().nbytes
+            durationSeconds = segment.end - segment.start
+            if durationSeconds > self.maxSegmentSeconds() / 2:
+                # short segments are dominated by container overhead, so don't learn from them
+                self.bytesPerSecond = encodedBytes / durationSeconds
+
+            if encodedBytes <= maxUploadBytes:
+                break
+
+            logger.warn(f"Encoded audio is {encodedBytes / 1024 / 1024:.1f}MB, over the upload limit. Shortening segment")
+            segment = planSegments(self.energyDb, segment.end, self.maxSegmentSeconds(), segment.start)[0]
+
+        self.encodedSeconds += segment.end - segment.start
+        self.encodedRequests += 1
+        logger.info(f"Encoded {segment.end - segment.start:.0f}s of audio into {encodedBytes / 1024 / 1024:.1f}MB. "
+                    f"Averaging {self.encodedSeconds / self.encodedRequests:.0f}s of audio per request")
+        return segment
+
+
+def encodeWebm(samples, sampleRate, channels, outputBuffer, bitrate):
+    """
+    Encodes int16 PCM samples of shape (frames, channels) to webm/opus, written to outputBuffer.
+    The samples are piped to ffmpeg straight from the (usually memory-mapped) array, without copying
+    """
+    logger.info("Generating webm audio")
+    pcm = memoryview(np.ascontiguousarray(samples)).cast("B")
+
+    # the webm muxer needs a seekable output to write the duration, so use a temporary file rather than a pipe
+    tempFile = tempfile.NamedTemporaryFile(suffix=".webm", delete=False)
+    tempFile.close()
+    try:
+        runFfmpeg(["-f", "s16le", "-ar", str(sampleRate), "-ac", str(channels), "-i", "pipe:0",
+                   "-c:a", "libopus", "-b:a", f"{bitrate}k", "-application", "voip", "-f", "webm", "-y", tempFile.name],
+                  pcm)
+        with open(tempFile.name, "rb") as f:
+            outputBuffer.write(f.read())
+    finally:
+        os.remove(tempFile.name)
+
+    outputBuffer.seek(0)
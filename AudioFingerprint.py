@@ -0,0 +1,230 @@
+import hashlib
+import json
+import os
+from dataclasses import dataclass, field, asdict
+from typing import List
+
+import numpy as np
+
+from Logger import logger
+from TranscribedPhrase import TranscribedPhrase
+
+
+indexFolder = os.path.join(os.path.expanduser("~"), ".nihongowakarimasen", "fingerprints")
+fftSize = 1024
+hopSize = 512
+blockSeconds = 60 # how much audio to hold in memory at once while fingerprinting
+peakBandsHz = [(300, 600), (600, 1200), (1200, 2400), (2400, 4800)] # one spectral peak is taken from each band per frame
+pairDistances = (2, 5, 9) # each peak is paired with the peak in the same band this many frames later
+minProminenceDb = 15 # peaks must stand out from the rest of their band by this much, so noise and silence are ignored
+maxHashCollisions = 20 # hashes that appear more often than this in a recording are too common to be useful
+offsetResolutionSeconds = 0.25
+maxMatchGapSeconds = 2.0 # matching hashes further apart than this are treated as separate repeats
+minRepeatSeconds = 5.0
+minMatchesPerSecond = 10.0
+
+
+@dataclass
+class Fingerprint:
+    recordingId: str
+    name: str
+    hashes: np.ndarray # uint32, sorted
+    times: np.ndarray # float32, seconds from the start of the recording
+
+
+@dataclass
+class RepeatedSpan:
+    start: float
+    end: float
+    sourceName: str
+    phrases: List[TranscribedPhrase] = field(default_factory=list)
+
+
+def translationSettings(toLang, model, extraPrompts) -> dict:
+    """
+    What stored translations were made with. They are only reused by runs that would translate the same way,
+    other runs reuse just the transcription
+    """
+    return {"toLang": toLang, "model": model, "context": hashlib.sha256(extraPrompts.encode("utf-8")).hexdigest()}
+
+
+def fingerprintAudio(audioSource, filepath) -> Fingerprint:
+    """
+    Spectral peak pair hashes of a mono audio source, in the style of landmark-based audio fingerprinting
+    """
+    logger.info("Fingerprinting audio")
+    sampleRate = audioSource.sampleRate
+    blockFrames = int(blockSeconds * sampleRate / hopSize)
+
+    hashes = []
+    times = []
+    for firstFrame in range(0, int(audioSource.durationSeconds * sampleRate / hopSize), blockFrames):
+        startSeconds = firstFrame * hopSize / sampleRate
+        # read a little extra, so the pairs of the last frames in the block are complete
+        endSeconds = startSeconds + ((blockFrames + max(pairDistances)) * hopSize + fftSize) / sampleRate
+        samples = audioSource.samples(startSeconds, endSeconds).mean(axis=1)
+        peakBins, peakProminence = findPeaks(samples, sampleRate)
+        blockHashes, blockTimes = hashPeaks(peakBins, peakProminence, sampleRate, blockFrames)
+        hashes.append(blockHashes)
+        times.append(blockTimes + startSeconds)
+
+    hashes = np.concatenate(hashes) if hashes else np.zeros(0, dtype=np.uint32)
+    times = np.concatenate(times) if times else np.zeros(0, dtype=np.float32)
+    order = np.argsort(hashes, kind="stable")
+
+    stat = os.stat(filepath)
+    recordingId = hashlib.sha256(f"{os.path.abspath(filepath)}|{stat.st_size}|{stat.st_mtime_ns}".encode("utf-8")).hexdigest()
+    return Fingerprint(recordingId, os.path.basename(filepath), hashes[order], times[order].astype(np.float32))
+
+
+def findPeaks(samples, sampleRate):
+    """
+    Returns the frequency bin and prominence of the strongest peak in each band, for each frame
+    """
+    if len(samples) < fftSize:
+        return np.zeros((0, len(peakBandsHz)), dtype=np.int64), np.zeros((0, len(peakBandsHz)))
+    frames = np.lib.stride_tricks.sliding_window_view(samples, fftSize)[::hopSize]
+    spectrumDb = 20 * np.log10(np.abs(np.fft.rfft(frames * np.hanning(fftSize), axis=1)) + 1e-6)
+    frequencies = np.fft.rfftfreq(fftSize, 1 / sampleRate)
+
+    peakBins = []
+    peakProminence = []
+    for lowHz, highHz in peakBandsHz:
+        bins = np.flatnonzero((frequencies >= lowHz) & (frequencies < highHz))
+        bandSpectrumDb = spectrumDb[:, bins]
+        bandPeaks = np.argmax(bandSpectrumDb, axis=1)
+        peakBins.append(bins[0] + bandPeaks)
+        peakProminence.append(bandSpectrumDb[np.arange(len(frames)), bandPeaks] - np.mean(bandSpectrumDb, axis=1))
+    return np.stack(peakBins, axis=1), np.stack(peakProminence, axis=1)
+
+
+def hashPeaks(peakBins, peakProminence, sampleRate, frameCount):
+    """
+    Pairs each peak with later peaks in the same band, only for anchors in the first frameCount frames.
+    hash = band (2 bits) | pair distance index (2 bits) | anchor bin (10 bits) | target bin (10 bits)
+    """
+    if not len(peakProminence):
+        return np.zeros(0, dtype=np.uint32), np.zeros(0, dtype=np.float32)
+    isProminent = peakProminence > minProminenceDb
+
+    hashes = []
+    times = []
+    for distanceIndex, distance in enumerate(pairDistances):
+        anchorCount = min(frameCount, len(peakBins) - distance)
+        if anchorCount <= 0:
+            continue
+        for band in range(len(peakBandsHz)):
+            anchors = peakBins[:anchorCount, band]
+            targets = peakBins[distance:distance + anchorCount, band]
+            valid = isProminent[:anchorCount, band] & isProminent[distance:distance + anchorCount, band]
+            pairHashes = (band << 22) | (distanceIndex << 20) | ((anchors & 0x3FF) << 10) | (targets & 0x3FF)
+            hashes.append(pairHashes[valid].astype(np.uint32))
+            times.append(np.flatnonzero(valid) * hopSize / sampleRate)
+
+    return np.concatenate(hashes), np.concatenate(times).astype(np.float32)
+
+
+def findRepeats(query: Fingerprint, stored: Fingerprint):
+    """
+    Returns (queryStart, queryEnd, offsetSeconds, matchCount) for each stretch of the query that also appears in the stored
+    recording, where storedTime = queryTime + offsetSeconds
+    """
+    left = np.searchsorted(stored.hashes, query.hashes, side="left")
+    right = np.searchsorted(stored.hashes, query.hashes, side="right")
+    counts = right - left
+    isUseful = (counts > 0) & (counts <= maxHashCollisions)
+    if not isUseful.any():
+        return []
+
+    # expand every query hash into one row per matching stored hash
+    counts = counts[isUseful]
+    queryIndexes = np.repeat(np.flatnonzero(isUseful), counts)
+    rowStarts = np.repeat(np.cumsum(counts) - counts, counts)
+    storedIndexes = np.repeat(left[isUseful], counts) + np.arange(len(queryIndexes)) - rowStarts
+
+    queryTimes = query.times[queryIndexes]
+    offsetBins = np.round((stored.times[storedIndexes] - queryTimes) / offsetResolutionSeconds).astype(np.int64)
+
+    repeats = []
+    uniqueBins, binCounts = np.unique(offsetBins, return_counts=True)
+    for offsetBin in uniqueBins[binCounts >= minRepeatSeconds * minMatchesPerSecond]:
+        matchTimes = np.sort(queryTimes[offsetBins == offsetBin])
+        clusterEdges = np.flatnonzero(np.diff(matchTimes) > maxMatchGapSeconds) + 1
+        for cluster in np.split(matchTimes, clusterEdges):
+            duration = float(cluster[-1] - cluster[0])
+            if duration >= minRepeatSeconds and len(cluster) / duration >= minMatchesPerSecond:
+                repeats.append((float(cluster[0]), float(cluster[-1]), float(offsetBin * offsetResolutionSeconds), len(cluster)))
+
+    return repeats
+
+
+class FingerprintIndex:
+    """
+    On-disk index of fingerprinted recordings and the phrases transcribed and translated from them,
+    so audio repeated across episodes (openings, jingles, sponsor reads) can reuse earlier results
+    """
+    def __init__(self, folder=indexFolder):
+        self.folder = folder
+        os.makedirs(self.folder, exist_ok=True)
+
+    def recordingIds(self):
+        return [name[:-len(".json")] for name in os.listdir(self.folder) if name.endswith(".json")]
+
+    def load(self, recordingId):
+        """
+        Returns the recording's fingerprint, its phrases, and the translationSettings they were translated with
+        (None for recordings added before these were stored)
+        """
+        path = os.path.join(self.folder, recordingId)
+        with open(path + ".json", "r", encoding="utf-8") as f:
+            info = json.load(f)
+        fingerprint = Fingerprint(recordingId, info["name"],
+                                  np.load(path + ".hashes.npy", mmap_mode="r"), np.load(path + ".times.npy", mmap_mode="r"))
+        return fingerprint, [TranscribedPhrase(**phrase) for phrase in info["phrases"]], info.get("translationSettings")
+
+    def findRepeatedSpans(self, query: Fingerprint, settings: dict) -> List[RepeatedSpan]:
+        """
+        Finds audio in the query that was already processed in an earlier run, along with the phrases from that audio,
+        shifted onto the query's timeline. Their translations are kept if they were made with the same translationSettings,
+        otherwise the phrases are left untranslated
+        """
+        candidates = []
+        for recordingId in self.recordingIds():
+            if recordingId == query.recordingId:
+                continue
+            stored, storedPhrases, storedSettings = self.load(recordingId)
+            reuseTranslations = storedSettings == settings
+            for queryStart, queryEnd, offsetSeconds, matchCount in findRepeats(query, stored):
+                # only reuse whole phrases that lie inside the repeated audio, and were translated successfully
+                phrases = [TranscribedPhrase(phrase.start - offsetSeconds, phrase.end - offsetSeconds, phrase.text,
+                                             phrase.translatedText if reuseTranslations else "")
+                           for phrase in storedPhrases
+                           if phrase.translatedText and phrase.translatedText != "[translation error]"
+                           and queryStart <= phrase.start - offsetSeconds and phrase.end - offsetSeconds <= queryEnd]
+                if phrases:
+                    candidates.append((matchCount, RepeatedSpan(phrases[0].start, phrases[-1].end, stored.name, phrases)))
+
+        # the same audio can match several earlier recordings, keep the strongest non-overlapping matches
+        repeatedSpans = []
+        for matchCount, span in sorted(candidates, key=lambda candidate: -candidate[0]):
+            if all(span.end <= other.start or other.end <= span.start for other in repeatedSpans):
+                repeatedSpans.append(span)
+        repeatedSpans.sort(key=lambda span: span.start)
+
+        for span in repeatedSpans:
+            reused = "phrase(s)" if span.phrases[0].translatedText else "transcribed phrase(s), translated differently,"
+            logger.info(f"Reusing {len(span.phrases)} {reused} from {span.sourceName} for {span.start:.1f}s to {span.end:.1f}s")
+        return repeatedSpans
+
+    def add(self, fingerprint: Fingerprint, phrases: List[TranscribedPhrase], settings: dict):
+        """
+        settings are the translationSettings the phrases were translated with
+        """
+        path = os.path.join(self.folder, fingerprint.recordingId)
+        np.save(path + ".hashes.npy", np.ascontiguousarray(fingerprint.hashes))
+        np.save(path + ".times.npy", np.ascontiguousarray(fingerprint.times))
+        # write the json last, as its presence marks the recording as complete
+        with open(path + ".json", "w", encoding="utf-8") as f:
+            json.dump({"name": fingerprint.name, "translationSettings": settings,
+                       "phrases": [asdict(phrase) for phrase in phrases]}, f, ensure_ascii=False)
+        logger.info(f"Added {fingerprint.name} to the fingerprint index")
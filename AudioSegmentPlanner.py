@@ -0,0 +1,95 @@
+from dataclasses import dataclass
+from typing import List
+
+import numpy as np
+
+from Logger import logger
+
+
+frameSeconds = 0.02 # audio energy is measured over frames of this length
+searchWindowSeconds = 60 # how far back from each size limit to search for a gap to cut at
+minGapSeconds = 0.5 # quiet stretches shorter than this are not treated as gaps between sentences
+silenceMarginDb = 12 # frames quieter than the noise floor plus this margin count as silence
+
+
+@dataclass
+class PlannedSegment:
+    start: float
+    end: float
+    cleanCut: bool # True if the segment ends in a gap in speech (or at the end of the file)
+
+
+def frameEnergyDb(samples, sampleRate):
+    """
+    Returns the RMS energy in dBFS of each frame of a mono 16-bit sample array
+    """
+    frameLength = max(1, int(sampleRate * frameSeconds))
+    frameCount = len(samples) // frameLength
+    if not frameCount:
+        return np.full(1, -120.0)
+
+    frames = samples[:frameCount * frameLength].astype(np.float32).reshape(frameCount, frameLength)
+    rms = np.sqrt(np.mean(np.square(frames), axis=1)) / 32768.0
+    return 20 * np.log10(np.maximum(rms, 1e-6))
+
+
+def findGaps(energyDb):
+    """
+    Returns the (startFrame, endFrame) of every quiet stretch that is at least minGapSeconds long
+    """
+    if not len(energyDb):
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    noiseFloor, speechLevel = np.percentile(energyDb, [5, 90])
+    # don't let the threshold reach speech level when the audio has almost no quiet parts
+    isQuiet = energyDb < noiseFloor + min(silenceMarginDb, (speechLevel - noiseFloor) / 2)
+
+    # find the boundaries of each run of quiet frames
+    edges = np.diff(np.concatenate(([0], isQuiet.astype(np.int8), [0])))
+    runStarts = np.flatnonzero(edges == 1)
+    runEnds = np.flatnonzero(edges == -1)
+
+    isLongEnough = (runEnds - runStarts) * frameSeconds >= minGapSeconds
+    return runStarts[isLongEnough], runEnds[isLongEnough]
+
+
+def planSegments(energyDb, durationSeconds, maxSegmentSeconds, startSeconds=0.0) -> List[PlannedSegment]:
+    """
+    Chooses every cut point up front, so each second of audio only needs to be transcribed once
+    - Each segment is at most maxSegmentSeconds long
+    - Cut in the middle of the longest gap in speech within searchWindowSeconds of the size limit
+    - If there are no gaps, cut at the quietest frame and mark the cut as unclean
+    """
+    gapStarts, gapEnds = findGaps(energyDb)
+    gapMiddles = (gapStarts + gapEnds) / 2 * frameSeconds
+    gapLengths = (gapEnds - gapStarts) * frameSeconds
+
+    segments = []
+    start = startSeconds
+    while start < durationSeconds:
+        limit = start + maxSegmentSeconds
+        if limit >= durationSeconds:
+            segments.append(PlannedSegment(start, durationSeconds, True))
+            break
+
+        windowStart = max(start + 1, limit - searchWindowSeconds)
+        first, last = np.searchsorted(gapMiddles, [windowStart, limit])
+        if last > first:
+            # prefer the longest gap, and the latest one if there is a tie
+            candidates = gapLengths[first:last]
+            best = first + len(candidates) - 1 - np.argmax(candidates[::-1])
+            end = float(gapMiddles[best])
+            cleanCut = True
+        else:
+            firstFrame = int(windowStart / frameSeconds)
+            lastFrame = min(len(energyDb), int(limit / frameSeconds))
+            end = limit
+            if lastFrame > firstFrame:
+                end = float(firstFrame + np.argmin(energyDb[firstFrame:lastFrame])) * frameSeconds
+            cleanCut = False
+            logger.warn(f"No gap in speech found between {windowStart:.1f}s and {limit:.1f}s, cutting at {end:.1f}s")
+
+        segments.append(PlannedSegment(start, end, cleanCut))
+        start = end
+
+    logger.info(f"Planned {len(segments)} audio segment(s) from {startSeconds:.1f}s to {durationSeconds:.1f}s")
+    return segments
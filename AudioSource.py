@@ -0,0 +1,241 @@
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+
+import numpy as np
+from pydub import AudioSegment
+from pydub.utils import get_prober_name
+
+from AudioSegmentPlanner import frameEnergyDb, frameSeconds
+from Logger import logger
+
+
+cacheFolder = os.path.join(tempfile.gettempdir(), "nihongowakarimasen", "audio")
+maxCacheBytes = 4 * 1024 ** 3 # inputs that decode to more PCM than this are streamed instead of cached
+maxCacheFolderBytes = 20 * 1024 ** 3 # least recently used decoded audio is deleted past this, the temp folder isn't
+                                     # cleaned up automatically on windows
+decodeSampleRate = 48000
+energySampleRate = 8000 # a low sample rate is plenty for finding gaps in speech
+energyBlockSeconds = 60 # how much audio to hold in memory at once while measuring energy
+
+
+class AudioSource:
+    """
+    Decoded audio as 16-bit PCM, which can be sliced by time without decoding the whole file again
+    """
+    sampleRate: int
+    channels: int
+    durationSeconds: float
+
+    def samples(self, startSeconds, endSeconds) -> np.ndarray:
+        """
+        Returns an int16 array of shape (frames, channels)
+        """
+        pass
+
+    def energyDb(self) -> np.ndarray:
+        """
+        Returns the energy of each frame, as used by AudioSegmentPlanner
+        """
+        pass
+
+    def contentHash(self) -> str:
+        """
+        sha256 of the decoded audio, so identical audio is recognised even if the file was renamed or re-muxed
+        """
+        digest = hashlib.sha256(f"{self.sampleRate}|{self.channels}|".encode("utf-8"))
+        for start in np.arange(0, self.durationSeconds, energyBlockSeconds):
+            digest.update(np.ascontiguousarray(self.samples(start, start + energyBlockSeconds)))
+        return digest.hexdigest()
+
+    def toOriginal(self, seconds):
+        """
+        Maps a time in this source to a time in the original file. Only differs for sources that skip audio
+        """
+        return seconds
+
+    def toCompact(self, seconds):
+        """
+        Maps a time in the original file to a time in this source
+        """
+        return seconds
+
+
+class CachedAudioSource(AudioSource):
+    """
+    Decodes the file once to a PCM file on disk and memory-maps it, so slices are views rather than copies.
+    The cache is keyed on the file's path, size and modification time, so re-runs of the same input reuse it.
+    The least recently used files are deleted once the cache folder is over maxCacheFolderBytes
+    """
+    def __init__(self, filepath, sampleRate, channels):
+        self.sampleRate = sampleRate
+        self.channels = channels
+
+        cachePath = getCachePath(filepath, self.sampleRate, self.channels)
+        if os.path.exists(cachePath):
+            logger.info(f"Reusing decoded audio from {cachePath}")
+            # the modification time marks when it was last used
+            os.utime(cachePath)
+        else:
+            logger.info(f"Decoding audio to {cachePath}")
+            os.makedirs(cacheFolder, exist_ok=True)
+            partialPath = cachePath + ".partial"
+            runFfmpeg(["-i", filepath, *pcmOutputArgs(self.sampleRate, self.channels), "-y", partialPath])
+            os.replace(partialPath, cachePath)
+            evictCache(cachePath)
+
+        self.cachePath = cachePath
+        frameCount = os.path.getsize(cachePath) // (2 * self.channels)
+        self.pcm = np.memmap(cachePath, dtype=np.int16, mode="r", shape=(frameCount, self.channels))
+        self.durationSeconds = frameCount / self.sampleRate
+
+    def contentHash(self) -> str:
+        # hashing takes a moment on long files, so keep it next to the decoded audio
+        hashPath = self.cachePath + ".sha256"
+        if os.path.exists(hashPath):
+            with open(hashPath, "r") as f:
+                return f.read()
+
+        contentHash = super().contentHash()
+        with open(hashPath, "w") as f:
+            f.write(contentHash)
+        return contentHash
+
+    def samples(self, startSeconds, endSeconds) -> np.ndarray:
+        startFrame = max(0, int(startSeconds * self.sampleRate))
+        endFrame = min(len(self.pcm), int(endSeconds * self.sampleRate))
+        return self.pcm[startFrame:endFrame]
+
+    def energyDb(self) -> np.ndarray:
+        # kept next to the decoded audio as well, so it is only measured once, e.g. by mainMultiFile's decoding processes
+        energyPath = self.cachePath + ".energy.npy"
+        if os.path.exists(energyPath):
+            return np.load(energyPath)
+
+        # average the channels and measure each block separately, so we never hold the whole file in memory
+        frameLength = int(self.sampleRate * frameSeconds)
+        blockFrames = frameLength * int(energyBlockSeconds / frameSeconds)
+        blocks = [frameEnergyDb(self.pcm[i:i + blockFrames].mean(axis=1), self.sampleRate)
+                  for i in range(0, len(self.pcm), blockFrames)]
+        # empty audio has no blocks to join
+        energyDb = np.concatenate(blocks) if blocks else np.zeros(0)
+        # written under another name and moved into place, so a crash never leaves a partial file
+        partialPath = self.cachePath + ".energy.partial.npy"
+        np.save(partialPath, energyDb)
+        os.replace(partialPath, energyPath)
+        return energyDb
+
+
+class StreamingAudioSource(AudioSource):
+    """
+    For inputs too large to cache. Energy is measured in one streaming pass, and each slice is decoded on demand
+    by seeking to it, so memory use is bounded by the slice length
+    """
+    def __init__(self, filepath, sampleRate, channels, durationSeconds):
+        self.filepath = filepath
+        self.sampleRate = sampleRate
+        self.channels = channels
+        self.durationSeconds = durationSeconds
+
+    def samples(self, startSeconds, endSeconds) -> np.ndarray:
+        output = runFfmpeg(["-ss", f"{startSeconds:.3f}", "-t", f"{endSeconds - startSeconds:.3f}", "-i", self.filepath,
+                            *pcmOutputArgs(self.sampleRate, self.channels), "pipe:1"])
+        return np.frombuffer(output, dtype=np.int16).reshape(-1, self.channels)
+
+    def energyDb(self) -> np.ndarray:
+        logger.info("Measuring audio energy")
+        command = [AudioSegment.converter, "-v", "error", "-i", self.filepath,
+                   *pcmOutputArgs(energySampleRate, 1), "pipe:1"]
+        blockBytes = 2 * int(energySampleRate * frameSeconds) * int(energyBlockSeconds / frameSeconds)
+
+        blocks = []
+        with subprocess.Popen(command, stdout=subprocess.PIPE, stdin=subprocess.DEVNULL) as process:
+            while block := process.stdout.read(blockBytes):
+                blocks.append(frameEnergyDb(np.frombuffer(block, dtype=np.int16), energySampleRate))
+        if process.returncode:
+            raise RuntimeError(f"ffmpeg failed to decode {self.filepath}")
+        return np.concatenate(blocks) if blocks else np.zeros(0)
+
+
+def openAudioSource(filepath, sampleRate=decodeSampleRate, channels=None) -> AudioSource:
+    """
+    Decodes to the given sample rate and number of channels, which default to 48kHz and the file's own channel count
+    """
+    sourceChannels, durationSeconds = probeAudio(filepath)
+    channels = channels or sourceChannels
+    pcmBytes = durationSeconds * sampleRate * channels * 2
+
+    os.makedirs(cacheFolder, exist_ok=True)
+    freeBytes = shutil.disk_usage(cacheFolder).free
+    if pcmBytes > min(maxCacheBytes, freeBytes):
+        logger.info(f"Decoded audio would be {pcmBytes / 1024 ** 3:.1f}GB, streaming instead of caching")
+        return StreamingAudioSource(filepath, sampleRate, channels, durationSeconds)
+
+    return CachedAudioSource(filepath, sampleRate, channels)
+
+
+def probeAudio(filepath):
+    output = subprocess.run(
+        [get_prober_name(), "-v", "error", "-select_streams", "a:0", "-show_entries", "stream=channels:format=duration",
+         "-of", "json", filepath],
+        capture_output=True, check=True
+    ).stdout
+    info = json.loads(output)
+    return int(info["streams"][0]["channels"]), float(info["format"]["duration"])
+
+
+def getCachePath(filepath, sampleRate, channels):
+    stat = os.stat(filepath)
+    key = f"{os.path.abspath(filepath)}|{stat.st_size}|{stat.st_mtime_ns}|{sampleRate}|{channels}"
+    return os.path.join(cacheFolder, hashlib.sha256(key.encode("utf-8")).hexdigest() + ".pcm")
+
+
+def evictCache(keepPath):
+    """
+    Deletes the least recently used decoded audio, along with the files kept next to it, until the cache folder fits in
+    maxCacheFolderBytes. keepPath is never deleted, and neither is audio still being decoded or still open elsewhere
+    (which can't be deleted on windows)
+    """
+    entries = {} # cache key: {path: size} of its files
+    for entry in os.scandir(cacheFolder):
+        try:
+            entries.setdefault(entry.name.split(".")[0], {})[entry.path] = entry.stat().st_size
+        except OSError:
+            pass # deleted by another process in the meantime
+    totalBytes = sum(size for files in entries.values() for size in files.values())
+
+    lastUsed = {}
+    for key, files in entries.items():
+        pcmPath = os.path.join(cacheFolder, key + ".pcm")
+        # audio that is still being decoded, or its energy measured, is in use
+        if pcmPath in files and pcmPath != keepPath and not any(".partial" in path for path in files):
+            lastUsed[pcmPath] = os.path.getmtime(pcmPath)
+
+    for pcmPath in sorted(lastUsed, key=lastUsed.get):
+        if totalBytes <= maxCacheFolderBytes:
+            break
+        files = entries[os.path.basename(pcmPath).split(".")[0]]
+        try:
+            # the audio goes first, so files left behind by a failure are only ever the small ones next to it
+            for path in sorted(files, key=lambda path: path != pcmPath):
+                os.remove(path)
+        except OSError as e:
+            logger.warn(f"Couldn't delete cached audio {pcmPath}: {e}")
+            continue
+        totalBytes -= sum(files.values())
+        logger.info(f"Deleted cached audio {pcmPath}, last used {time.ctime(lastUsed[pcmPath])}")
+
+
+def pcmOutputArgs(sampleRate, channels):
+    return ["-vn", "-f", "s16le", "-acodec", "pcm_s16le", "-ar", str(sampleRate), "-ac", str(channels)]
+
+
+def runFfmpeg(args, inputData=None):
+    result = subprocess.run([AudioSegment.converter, "-v", "error", *args], input=inputData, capture_output=True)
+    if result.returncode:
+        raise RuntimeError(f"ffmpeg failed: {result.stderr.decode('utf-8', errors='replace')}")
+    return result.stdout
@@ -0,0 +1,45 @@
+import importlib
+import time
+from contextlib import contextmanager
+
+from Logger import logger
+
+
+'''
+Speech to text and translation backends by name. Each one is imported only when it is chosen,
+so a run doesn't pay to load dependencies it never uses, e.g. torch and whisperx for local whisper,
+or openai when translating an srt file with the passthrough translator
+'''
+
+asrBackends = {
+    "openai-whisper": "ASROpenAIWhisper.ASROpenAIWhisper",
+    "local-whisper": "ASRLocalWhisper.ASRLocalWhisper", # needs torch and whisperx
+    "srt": "ASRFromSrtFile.ASRFromSrtFile", # reads an existing srt file instead of transcribing
+}
+translationBackends = {
+    "batch-chatgpt": "TranslationBatchChatGPT.TranslationBatchChatGPT",
+    "chatgpt": "TranslationChatGPT.TranslationChatGPT", # one line at a time, japanese to english only
+    "passthrough": "TranslationPassthrough.TranslationPassthrough", # leaves lines untranslated
+}
+
+
+@contextmanager
+def importTimer(name):
+    """
+    Logs how long the imports inside the block took, so slow startup can be traced to a dependency
+    """
+    startTime = time.perf_counter()
+    yield
+    logger.info(f"Imported {name} in {(time.perf_counter() - startTime) * 1000:.0f}ms")
+
+
+def loadBackend(backends, name):
+    """
+    Imports the backend's module, returning its class
+    """
+    if name not in backends:
+        raise ValueError(f"Unknown backend {name}, choose from {', '.join(backends)}")
+    moduleName, className = backends[name].rsplit(".", 1)
+    with importTimer(f"{name} backend"):
+        module = importlib.import_module(moduleName)
+    return getattr(module, className)
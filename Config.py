@@ -1,16 +1,20 @@
-import pycountry
-from openai.types import ResponsesModel
+from functools import lru_cache
+from typing import TYPE_CHECKING
 
 from Types import ServiceTier
 from Prompts import translationContextClarisSeason3, whisperPromptGenericJA, translationContextClarisSeason2, \
-    translationContextMizukiNana, translationContextBlueArchive, whisperPromptGenericKO
+    translationContextMizukiNana, translationContextBlueArchive, whisperPromptGenericKO, glossaryClarisSeason3, \
+    glossaryClarisSeason2, glossaryMizukiNana, glossaryBlueArchive, translationStyle
 
-# These arguments will get moved to a proper CLI interface in the future
+if TYPE_CHECKING:
+    # only for type checking, importing openai takes most of a second
+    from openai.types import ResponsesModel
+
+# Defaults of main.py's command line arguments, see python main.py --help
 
 fromLang = "Japanese"
-fromLangCode = pycountry.languages.get(name=fromLang).alpha_2
 toLang = "English"
-toLangCode = pycountry.languages.get(name=toLang).alpha_2
+toLangs = [toLang] # e.g. ["English", "Korean"] to translate into each of them, with a subtitle file per language
 
 folder = "C:/Users/pathToFolder/"
 file = "videoFile"
@@ -18,10 +22,38 @@ fileExtension = ".mp4"
 
 inputFile = folder + file + fileExtension
 outputFile = folder + file
+multiFileInput = folder # for mainMultiFile.py, a folder of inputs, or a manifest file listing one input path per line
+multiFileConcurrency = 2 # for mainMultiFile.py, number of files being transcribed and translated at once
 
+asrBackend = "openai-whisper" # see Backends for the others, e.g. "srt" to translate an existing srt file
+translationBackend = "batch-chatgpt"
 configWhisperPrompt = whisperPromptGenericJA
+whisperConcurrency = 1 # number of audio segments to transcribe at once, set above 1 to transcribe long files faster
+vadEnabled = False # skip music, jingles and silence before transcribing, to save cost and avoid hallucinations
+fingerprintDedupEnabled = False # reuse transcriptions and translations of audio repeated from earlier runs, e.g. show openings
+streamingPipelineEnabled = False # translate and write subtitles while transcription is still running, to finish long files sooner
 configTranslationContext = translationContextClarisSeason3
+configGlossary = None # e.g. glossaryClarisSeason3, only the entries appearing in each chunk are sent. Set the context above to translationStyle when using one
 
 chatGPTServiceTier:ServiceTier = "flex" # set to "flex" to save cost
-chatGPTModel:ResponsesModel = "gpt-5.1"
+hedgeLatencyPercentile = 90 # flex requests slower than this percentile of recent ones are also sent on the default tier, None to never
+rateLimitRequestsPerMinute = 500 # starting rate limits of each model, until the api's rate limit headers say otherwise
+rateLimitTokensPerMinute = 500000
+chatGPTModel: "ResponsesModel" = "gpt-5.1"
 chatGPTReasoningEffort = "low"
+cascadeModel: "ResponsesModel | None" = None # e.g. "gpt-5-nano" to translate with it first, then only lines failing cheap checks with chatGPTModel
+translationConcurrency = 1 # number of chunks to translate at once. Above 1, chunks use the untranslated lines before them as context
+promptCacheKeyEnabled = True # send a key per show with each request, so requests sharing the show context hit the same prompt cache
+translationRequestLimit = 8 # translating into several languages, the most requests in flight at once across all of them
+multiLanguageResponsesEnabled = False # translating into several languages, request every language of a line in one response
+batchAPIEnabled = False # translate through the OpenAI Batch API, which costs less but can take up to a day
+promptLineEncoding = "json" # how lines are written in translation prompts: "json", or the more compact "minjson" or "tsv"
+
+
+@lru_cache
+def languageCode(lang) -> str:
+    """
+    Two letter code of a language name, e.g. "ja" for Japanese
+    """
+    import pycountry # only loaded when a code is needed
+    return pycountry.languages.get(name=lang).alpha_2
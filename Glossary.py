@@ -0,0 +1,114 @@
+import unicodedata
+from collections import deque
+from dataclasses import dataclass
+from typing import Iterable, List, Sequence, Set
+
+
+@dataclass(frozen=True)
+class GlossaryEntry:
+    term: str # how the name or term is usually written in Japanese
+    translation: str
+    aliases: Sequence[str] = () # other ways it is written, e.g. in kana
+    misTranscriptions: Sequence[str] = () # ways whisper gets it wrong, so they are recognised and corrected
+    note: str = ""
+
+    def surfaceForms(self) -> List[str]:
+        return [self.term, *self.aliases, *self.misTranscriptions]
+
+    def toPrompt(self) -> str:
+        line = f"- {self.term} ({self.translation})"
+        if self.aliases:
+            line += f", also written as {', '.join(self.aliases)}"
+        if self.misTranscriptions:
+            line += f", sometimes mis-transcribed as {', '.join(self.misTranscriptions)}"
+        if self.note:
+            line += f": {self.note}"
+        return line
+
+
+def normalise(text) -> str:
+    # so full and half width forms, and upper and lower case, match each other
+    return unicodedata.normalize("NFKC", text).casefold()
+
+
+class AhoCorasick:
+    """
+    Finds which of many patterns occur in a text in a single pass over the text, however many patterns there are
+    """
+    def __init__(self, patterns: Iterable[str]):
+        # trie of patterns, with each node's fallback node (the longest suffix that is also in the trie)
+        # and the patterns that end at each node
+        self.children = [{}]
+        self.fallbacks = [0]
+        self.matches = [set()]
+
+        for i, pattern in enumerate(patterns):
+            node = 0
+            for character in pattern:
+                if character not in self.children[node]:
+                    self.children[node][character] = len(self.children)
+                    self.children.append({})
+                    self.fallbacks.append(0)
+                    self.matches.append(set())
+                node = self.children[node][character]
+            if node:
+                self.matches[node].add(i)
+
+        # fallbacks are found breadth first, as each one depends on the fallbacks of shorter prefixes
+        queue = deque(self.children[0].values())
+        while queue:
+            node = queue.popleft()
+            for character, child in self.children[node].items():
+                fallback = self.fallbacks[node]
+                while fallback and character not in self.children[fallback]:
+                    fallback = self.fallbacks[fallback]
+                self.fallbacks[child] = self.children[fallback].get(character, 0)
+                self.matches[child] |= self.matches[self.fallbacks[child]]
+                queue.append(child)
+
+    def find(self, text) -> Set[int]:
+        """
+        Returns the index of every pattern that occurs in text
+        """
+        found = set()
+        node = 0
+        for character in text:
+            while node and character not in self.children[node]:
+                node = self.fallbacks[node]
+            node = self.children[node].get(character, 0)
+            found |= self.matches[node]
+        return found
+
+
+class Glossary:
+    """
+    Names and terms of a show, so only the entries that appear in the lines being translated are sent with them,
+    rather than the whole glossary with every request
+    """
+    def __init__(self, entries: Sequence[GlossaryEntry], language="English"):
+        """
+        language is the language of the entries' translations
+        """
+        self.entries = list(entries)
+        self.language = language
+        surfaceForms = [(i, normalise(surfaceForm)) for i, entry in enumerate(self.entries) for surfaceForm in entry.surfaceForms()]
+        self.entryOfPattern = [i for i, surfaceForm in surfaceForms]
+        self.matcher = AhoCorasick([surfaceForm for i, surfaceForm in surfaceForms])
+
+    def find(self, texts: Iterable[str]) -> List[GlossaryEntry]:
+        """
+        Returns the entries that appear in any of the texts, in glossary order
+        """
+        found = set()
+        for text in texts:
+            found |= {self.entryOfPattern[pattern] for pattern in self.matcher.find(normalise(text))}
+        return [self.entries[i] for i in sorted(found)]
+
+    def toPrompt(self, texts: Iterable[str]) -> str:
+        """
+        The entries appearing in texts as prompt lines, or an empty string if there are none
+        """
+        return "\n".join(entry.toPrompt() for entry in self.find(texts))
+
+    def fullPrompt(self) -> str:
+        return "\n".join(entry.toPrompt() for entry in self.entries)
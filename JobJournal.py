@@ -0,0 +1,57 @@
+import json
+import os
+import threading
+from typing import List
+
+from Logger import logger
+
+
+journalFolder = os.path.join(os.path.expanduser("~"), ".nihongowakarimasen", "journals")
+
+
+class JobJournal:
+    """
+    Append-only record of the work a job has finished, one json object per line, written as each piece of work
+    finishes. A job restarted after a crash replays it and carries on from there, rather than paying for that work again.
+    A line left half written by a crash is dropped
+    """
+    def __init__(self, key, folder=journalFolder):
+        os.makedirs(folder, exist_ok=True)
+        self.path = os.path.join(folder, f"{key}.jsonl")
+        self.lock = threading.Lock()
+        self.entries = self.read()
+        if self.entries:
+            logger.info(f"Found journal of an interrupted job with {len(self.entries)} finished piece(s) of work")
+
+    def read(self) -> List[dict]:
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path, "rb") as f:
+            data = f.read()
+        completeLength = data.rfind(b"\n") + 1
+        if completeLength < len(data):
+            # so the next entry doesn't get appended onto the end of the broken one
+            with open(self.path, "r+b") as f:
+                f.truncate(completeLength)
+        return [json.loads(line) for line in data[:completeLength].decode("utf-8").splitlines() if line.strip()]
+
+    def find(self, kind) -> List[dict]:
+        return [entry for entry in self.entries if entry["kind"] == kind]
+
+    def append(self, kind, **data):
+        entry = {"kind": kind, **data}
+        with self.lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            self.entries.append(entry)
+
+    def remove(self):
+        """
+        Called once the job's results are stored elsewhere, so the journal is no longer needed
+        """
+        with self.lock:
+            self.entries = []
+            if os.path.exists(self.path):
+                os.remove(self.path)
@@ -0,0 +1,170 @@
+import asyncio
+from dataclasses import replace
+from datetime import datetime
+from typing import AsyncIterator, Dict, List, Optional
+
+from Config import chatGPTReasoningEffort, translationRequestLimit, cascadeModel
+from Glossary import Glossary
+from Logger import logger
+from PromptEncoding import MultiLanguageJsonEncoding
+from TokenCounter import TokenUsage, estimateTokens
+from TranscribedPhrase import TranscribedPhrase
+from TranslationBatchChatGPT import TranslationBatchChatGPT, generatePrompt, findValidLines, splitIntoRuns, memorySize, \
+    promptCacheKey
+
+
+'''
+Translating one transcript into several languages
+- Every language gets its own copy of the phrases, and its own translator
+- The translators run at the same time, sharing one limit on requests in flight
+- Optionally, lines are first requested in every language at once, with any lines that didn't come back
+  then translated per language as normal
+The first language keeps the translations the phrases already have, e.g. reused from earlier runs
+'''
+
+
+def sharedRequestLimit(toLangs) -> Optional[asyncio.Semaphore]:
+    # a single language keeps its own limit of translationConcurrency
+    return asyncio.Semaphore(max(1, translationRequestLimit)) if len(toLangs) > 1 else None
+
+
+def copyPhrases(phrases: List[TranscribedPhrase], toLangs: List[str]) -> Dict[str, List[TranscribedPhrase]]:
+    return {toLang: phrases if i == 0 else [replace(phrase, translatedText="") for phrase in phrases]
+            for i, toLang in enumerate(toLangs)}
+
+
+async def translateLanguages(phrases: List[TranscribedPhrase], toLangs: Dict[str, str], extraPrompts, model,
+                             glossary: Optional[Glossary] = None,
+                             combinedResponses=False) -> Dict[str, List[TranscribedPhrase]]:
+    """
+    Translates phrases into every language of toLangs ({name: code}), returning each language's phrases by name
+    """
+    requestLimit = sharedRequestLimit(toLangs)
+    phraseLists = copyPhrases(phrases, list(toLangs))
+    combinedResponses = combinedResponses and len(toLangs) > 1
+    if combinedResponses and cascadeModel and cascadeModel != model:
+        # the combined requests go to model alone, so the lines left for each language do too
+        logger.warn(f"The cascade through {cascadeModel} isn't applied with combined language responses, "
+                    f"every line is translated with {model}")
+    translators = {toLang: TranslationBatchChatGPT(glossary=glossary, toLang=toLang, requestLimit=requestLimit,
+                                                   cascadeModel=None if combinedResponses else cascadeModel)
+                   for toLang in toLangs}
+
+    cacheKeys = {}
+    if combinedResponses:
+        cacheKeys = await translateCombined(translators, phraseLists, toLangs, extraPrompts, model, requestLimit)
+
+    await asyncio.gather(*[translators[toLang].translateAsync(phraseLists[toLang], extraPrompts, model, cacheKeys.get(toLang))
+                           for toLang in toLangs])
+    return phraseLists
+
+
+async def translateLanguagesStream(phraseBatches: AsyncIterator[List[TranscribedPhrase]], toLangs: List[str],
+                                   extraPrompts, model, glossary: Optional[Glossary] = None,
+                                   onTranslated=None,
+                                   requestLimit: Optional[asyncio.Semaphore] = None) -> Dict[str, List[TranscribedPhrase]]:
+    """
+    Streaming version of translateLanguages, where each language's translateStream gets a copy of every batch.
+    onTranslated(toLang, phraseBatch) is called with each language's translated batches in order.
+    requestLimit is shared with other translations running at the same time, e.g. of other files
+    """
+    requestLimit = requestLimit or sharedRequestLimit(toLangs)
+    queues = {toLang: asyncio.Queue() for toLang in toLangs}
+    phraseLists = {toLang: [] for toLang in toLangs}
+
+    async def distributeBatches():
+        try:
+            async for phraseBatch in phraseBatches:
+                for toLang, batch in copyPhrases(phraseBatch, toLangs).items():
+                    queues[toLang].put_nowait(batch)
+        finally:
+            for queue in queues.values():
+                queue.put_nowait(None)
+
+    async def translateLanguage(toLang):
+        async def queuedBatches():
+            while (phraseBatch := await queues[toLang].get()) is not None:
+                yield phraseBatch
+
+        translator = TranslationBatchChatGPT(glossary=glossary, toLang=toLang, requestLimit=requestLimit)
+        async for phraseBatch in translator.translateStream(queuedBatches(), extraPrompts, model):
+            phraseLists[toLang].extend(phraseBatch)
+            if onTranslated:
+                onTranslated(toLang, phraseBatch)
+
+    await asyncio.gather(distributeBatches(), *[translateLanguage(toLang) for toLang in toLangs])
+    return phraseLists
+
+
+async def translateCombined(translators: Dict[str, TranslationBatchChatGPT], phraseLists: Dict[str, List[TranscribedPhrase]],
+                            toLangs: Dict[str, str], extraPrompts, model, requestLimit) -> Dict[str, List[str]]:
+    """
+    Requests every language of each line in one response. Lines missing from a response are left for the per-language
+    translators, which retry them as usual. Returns each language's cache keys, to pass on to those translators
+    rather than looking up the cache again
+    """
+    encoding = MultiLanguageJsonEncoding(toLangs)
+    firstLanguage = next(iter(toLangs))
+    firstTranslator = translators[firstLanguage]
+    firstPhrases = phraseLists[firstLanguage]
+    chunkSizer = firstTranslator.chunkSizerFor(model)
+    cacheKeys = {toLang: translators[toLang].lookUpCache(phraseLists[toLang], 0, len(firstPhrases), extraPrompts, model)
+                 for toLang in toLangs}
+
+    # a line is requested if any language still needs it, in runs of consecutive lines so MEMORY is the lines before
+    # each run. The response holds every language, so each request is smaller than a single language chunk
+    neededIndexes = [i for i in range(len(firstPhrases)) if any(not phraseLists[toLang][i].translatedText for toLang in toLangs)]
+    tokenBudget = chunkSizer.tokenBudget / len(toLangs)
+    requests = []
+    for run in splitIntoRuns(neededIndexes):
+        requestTokens = tokenBudget
+        for i in run:
+            lineTokens = chunkSizer.chunkTokens([firstPhrases[i]])
+            if requestTokens + lineTokens > tokenBudget:
+                requests.append([])
+                requestTokens = 0
+            requests[-1].append(i)
+            requestTokens += lineTokens
+
+    logger.info(f"Translating {len(neededIndexes)} line(s) into {', '.join(toLangs)} in {len(requests)} combined request(s)")
+
+    async def translateRequest(indexes):
+        requestPhrases = [firstPhrases[i] for i in indexes]
+        memory = [replace(phrase) for phrase in firstPhrases[max(0, indexes[0] - memorySize):indexes[0]]]
+        translationPrompt = generatePrompt(extraPrompts, requestPhrases, memory, encoding=encoding,
+                                           glossary=firstTranslator.glossary, toLang=" and ".join(toLangs))
+        async with requestLimit:
+            translationStartTime = datetime.now()
+            response = await firstTranslator.parseResponse(
+                estimateTokens(translationPrompt) + chunkSizer.chunkTokens(requestPhrases) * len(toLangs),
+                model=model,
+                reasoning={
+                    "effort": chatGPTReasoningEffort
+                },
+                input=[{
+                    "role": "user",
+                    "content": translationPrompt
+                }],
+                store=False,
+                prompt_cache_key=promptCacheKey(extraPrompts, model, encoding.name),
+                text_format=encoding.outputModel
+            )
+        logger.info(f"Received combined translation of {len(indexes)} lines in {datetime.now() - translationStartTime}")
+        usage.add(response.usage.model_dump())
+
+        expectedIdList = [str(n) for n in range(len(memory) + 1, len(memory) + len(indexes) + 1)]
+        tokensPerLine = response.usage.total_tokens / len(indexes) / len(toLangs)
+        for toLang, translatedLines in encoding.toLinesByLanguage(response.output_parsed).items():
+            validLines = findValidLines(expectedIdList, translatedLines)
+            newCacheEntries = []
+            for i, expectedId in zip(indexes, expectedIdList):
+                phrase = phraseLists[toLang][i]
+                if expectedId in validLines and not phrase.translatedText:
+                    phrase.translatedText = validLines[expectedId]
+                    newCacheEntries.append((cacheKeys[toLang][i], phrase.translatedText, tokensPerLine))
+            translators[toLang].cache.put(newCacheEntries)
+
+    usage = TokenUsage()
+    await asyncio.gather(*[translateRequest(indexes) for indexes in requests])
+    usage.logStats()
+    return cacheKeys
@@ -0,0 +1,67 @@
+import asyncio
+import importlib.util
+import threading
+import weakref
+from typing import Dict, Optional
+
+from openai import OpenAI, AsyncOpenAI, DefaultHttpxClient, DefaultAsyncHttpxClient
+
+from Logger import logger
+
+
+'''
+Every OpenAI client comes from here, so all call sites share keep-alive connection pools
+(and TLS sessions) instead of each opening their own, using HTTP/2 when the h2 package is installed
+- Sync clients share one pool per base url
+- Async clients share one pool per base url and event loop, as async connections can't move between event loops
+Clients default to no retries, as the rate limiter retries instead (see RateLimiter)
+'''
+
+timeoutProfiles = {
+    "transcription": 120.0, # one audio segment, of at most AudioEncoder.maxSegmentDuration
+    "translation": 900.0, # a whole chunk, flex requests can wait a long time
+    "live": 8.0, # a single live subtitle line, which is no use if it arrives late. TODO: maybe tune this
+    "batch": 900.0, # Batch API file uploads and downloads
+}
+
+http2Available = importlib.util.find_spec("h2") is not None
+
+syncHttpClients: Dict[Optional[str], DefaultHttpxClient] = {}
+asyncHttpClients = weakref.WeakKeyDictionary() # event loop: {base url: http client}
+httpClientsLock = threading.Lock()
+
+
+def openAIClient(profile, baseUrl=None, maxRetries=0) -> OpenAI:
+    """
+    baseUrl overrides the OpenAI API url (as does the OPENAI_BASE_URL environment variable), e.g. for a local stand-in
+    """
+    with httpClientsLock:
+        if baseUrl not in syncHttpClients:
+            syncHttpClients[baseUrl] = DefaultHttpxClient(http2=http2Available)
+        httpClient = syncHttpClients[baseUrl]
+    return OpenAI(base_url=baseUrl, timeout=timeoutProfiles[profile], max_retries=maxRetries, http_client=httpClient)
+
+
+def asyncOpenAIClient(profile, baseUrl=None, maxRetries=0) -> AsyncOpenAI:
+    """
+    Must be called from the event loop the client will be used in
+    """
+    loop = asyncio.get_running_loop()
+    with httpClientsLock:
+        loopHttpClients = asyncHttpClients.setdefault(loop, {})
+        if baseUrl not in loopHttpClients:
+            loopHttpClients[baseUrl] = DefaultAsyncHttpxClient(http2=http2Available)
+        httpClient = loopHttpClients[baseUrl]
+    return AsyncOpenAI(base_url=baseUrl, timeout=timeoutProfiles[profile], max_retries=maxRetries, http_client=httpClient)
+
+
+async def prewarmConnections(profile="live", baseUrl=None, connectionCount=2):
+    """
+    Opens connections ahead of the first real request, so it doesn't pay for the TCP and TLS handshakes
+    """
+    client = asyncOpenAIClient(profile, baseUrl)
+    results = await asyncio.gather(*[client.models.with_raw_response.list() for i in range(connectionCount)],
+                                   return_exceptions=True)
+    failures = [result for result in results if isinstance(result, BaseException)]
+    if failures:
+        logger.warn(f"Could not prewarm connections: {failures[0]}")
@@ -0,0 +1,181 @@
+from dataclasses import dataclass
+from typing import List, Sequence
+
+import numpy as np
+
+from TranscribedPhrase import Word
+
+
+'''
+Chunking strategy - turning a stream of words into subtitle lines
+- Always break line on end of sentence punctuation
+- If within target line length, break if silence is over threshold
+- If beyond target line length, break if silence is over short threshold, or if word is longer than threshold
+- If at max line length, forcibly break
+'''
+
+# TODO different languages have different punctuation, either swap delimiter characters or remove this feature entirely
+toBreakOn = {"。", "？", "?"}
+
+
+@dataclass(frozen=True)
+class ChunkingSettings:
+    silenceTimeThreshold: float = 0.35 # any gaps longer than this will create a new subtitle line
+    targetPhraseLength: int = 30 # words, will start searching harder for gaps after
+    silenceTimeThresholdShort: float = 0.1 # when searching harder, any gaps longer than this will create a new subtitle line
+    longWordTimeThreshold: float = 0.5 # when searching harder, any words longer than this will create a new subtitle line
+    maxPhraseLength: int = 50 # words, will forcibly split the sentence here
+
+
+defaultChunkingSettings = ChunkingSettings()
+
+
+@dataclass
+class WordArrays:
+    starts: np.ndarray
+    ends: np.ndarray
+    mustBreak: np.ndarray # True for words that always end a line, e.g. end of sentence punctuation
+
+    def __len__(self):
+        return len(self.starts)
+
+    @staticmethod
+    def fromWords(starts, ends, texts, forcedBreaks=None) -> "WordArrays":
+        mustBreak = np.array([text[-1] in toBreakOn for text in texts], dtype=bool)
+        if forcedBreaks is not None:
+            mustBreak |= forcedBreaks
+        return WordArrays(np.asarray(starts, dtype=np.float64), np.asarray(ends, dtype=np.float64), mustBreak)
+
+    @staticmethod
+    def fromStoredTranscript(storedTranscript) -> "WordArrays":
+        """
+        Builds the arrays straight from a StoredTranscript's columns, without decoding any text
+        """
+        offsets = np.asarray(storedTranscript.textOffsets)
+        blob = np.asarray(storedTranscript.textBlob)
+        wordStarts = offsets[:-1]
+        wordEnds = offsets[1:]
+        isNotEmpty = wordEnds > wordStarts
+
+        # compare the last bytes of each word against each delimiter's utf-8 encoding
+        mustBreak = np.zeros(len(wordEnds), dtype=bool)
+        for delimiter in (toBreakOn if len(blob) else ()):
+            encoded = np.frombuffer(delimiter.encode("utf-8"), dtype=np.uint8)
+            isMatch = wordEnds - wordStarts >= len(encoded)
+            for j, byte in enumerate(encoded):
+                positions = np.where(isMatch, wordEnds - len(encoded) + j, 0)
+                isMatch &= blob[positions] == byte
+            mustBreak |= isMatch
+
+        return WordArrays(np.asarray(storedTranscript.starts)[isNotEmpty], np.asarray(storedTranscript.ends)[isNotEmpty],
+                          mustBreak[isNotEmpty])
+
+
+def nextTrueIndex(mask):
+    """
+    For each position along the last axis, the index of the next True at or after it (or the length if there is none)
+    """
+    length = mask.shape[-1]
+    indexes = np.where(mask, np.arange(length), length)
+    return np.minimum.accumulate(indexes[..., ::-1], axis=-1)[..., ::-1]
+
+
+def findPhraseEnds(words: WordArrays, settings: ChunkingSettings = defaultChunkingSettings) -> np.ndarray:
+    """
+    Returns the index of the last word of each line
+    """
+    return sweepPhraseEnds(words, [settings])[0]
+
+
+def sweepPhraseEnds(words: WordArrays, settingsList: Sequence[ChunkingSettings]) -> List[np.ndarray]:
+    """
+    Evaluates many chunking settings over the same words at once, returning the line ends for each setting.
+    Every break condition is computed for all settings and words up front, so the only Python loop is per line
+    """
+    wordCount = len(words)
+    if not wordCount:
+        return [np.zeros(0, dtype=np.int64) for settings in settingsList]
+
+    gaps = np.append(words.starts[1:] - words.ends[:-1], np.inf) # the last word always ends a line
+    durations = words.ends - words.starts
+
+    silence = np.array([settings.silenceTimeThreshold for settings in settingsList])[:, None]
+    silenceShort = np.array([settings.silenceTimeThresholdShort for settings in settingsList])[:, None]
+    longWord = np.array([settings.longWordTimeThreshold for settings in settingsList])[:, None]
+
+    # next word that would end a line while within the target length, and while beyond it
+    nextBreakWithinTarget = nextTrueIndex(words.mustBreak | (gaps > silence))
+    nextBreakBeyondTarget = nextTrueIndex(words.mustBreak | (gaps > silenceShort) | (durations > longWord))
+
+    results = []
+    for s, settings in enumerate(settingsList):
+        phraseEnds = []
+        start = 0
+        while start < wordCount:
+            targetEnd = start + settings.targetPhraseLength - 1 # last word within the target length
+            maxEnd = start + settings.maxPhraseLength - 1 # line is forcibly broken here
+
+            end = nextBreakWithinTarget[s, start]
+            if end > targetEnd:
+                end = nextBreakBeyondTarget[s, targetEnd + 1] if targetEnd + 1 < wordCount else wordCount
+                end = min(end, maxEnd)
+            end = min(end, wordCount - 1)
+
+            phraseEnds.append(end)
+            start = end + 1
+        results.append(np.array(phraseEnds, dtype=np.int64))
+
+    return results
+
+
+def splitAtPhraseEnds(items, phraseEnds) -> List[list]:
+    """
+    Splits a list of words (of any type) into lines, given the index of the last word of each line
+    """
+    return [items[start:end + 1] for start, end in zip(np.concatenate(([0], phraseEnds[:-1] + 1)), phraseEnds)]
+
+
+def shouldBreak(wordCount, word: Word, nextWord: Word, settings: ChunkingSettings = defaultChunkingSettings):
+    """
+    Whether the line should end after word, which is the wordCount'th word in the line.
+    The same rules as sweepPhraseEnds, for one word at a time
+    """
+    if word.text and word.text[-1] in toBreakOn:
+        return True
+    if wordCount >= settings.maxPhraseLength:
+        return True
+    if nextWord is None:
+        return False
+
+    silenceTime = nextWord.start - word.end
+    if wordCount <= settings.targetPhraseLength:
+        return silenceTime > settings.silenceTimeThreshold
+    return silenceTime > settings.silenceTimeThresholdShort or word.end - word.start > settings.longWordTimeThreshold
+
+
+class IncrementalChunker:
+    """
+    Chunks words as they arrive, for the live path.
+    Punctuation and length breaks happen as soon as the word arrives, silence breaks when the following word arrives
+    """
+    def __init__(self, settings: ChunkingSettings = defaultChunkingSettings):
+        self.settings = settings
+        self.words = []
+
+    def push(self, word: Word) -> List[List[Word]]:
+        """
+        Adds a word, returning any lines that are now complete
+        """
+        completed = []
+        if self.words and shouldBreak(len(self.words), self.words[-1], word, self.settings):
+            completed.append(self.flush())
+
+        self.words.append(word)
+        if shouldBreak(len(self.words), word, None, self.settings):
+            completed.append(self.flush())
+        return completed
+
+    def flush(self) -> List[Word]:
+        words = self.words
+        self.words = []
+        return words
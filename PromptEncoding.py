@@ -0,0 +1,266 @@
+import json
+import textwrap
+from typing import Dict, List
+
+from pydantic import BaseModel, create_model
+
+from TokenCounter import estimateTokens
+
+
+'''
+How subtitle lines are written into translation prompts, and read back out of the structured output
+- json: pretty printed objects with "id", "ja" and "en" keys, the original format
+- minjson: minified arrays, with short keys in the output
+- tsv: one line per subtitle with tab separated fields, in and out
+Each MEMORY line is (id, ja, en) and each TARGET line is (id, ja), en is empty if the line isn't translated yet
+'''
+
+
+class SubtitleLineTranslated(BaseModel):
+    id: str
+    en: str
+
+
+class SubtitleFileTranslated(BaseModel):
+    subtitleLines: list[SubtitleLineTranslated]
+
+
+class CompactSubtitleLine(BaseModel):
+    i: str
+    t: str
+
+
+class CompactSubtitleFile(BaseModel):
+    l: list[CompactSubtitleLine]
+
+
+class TsvSubtitleFile(BaseModel):
+    tsv: str
+
+
+def strictObjectSchema(properties):
+    return {"type": "object", "properties": properties, "required": list(properties), "additionalProperties": False}
+
+
+class JsonEncoding:
+    name = "json"
+    outputModel = SubtitleFileTranslated
+    # same shape as outputModel, for batch requests which can't pass the pydantic model
+    outputSchema = strictObjectSchema({
+        "subtitleLines": {
+            "type": "array",
+            "items": strictObjectSchema({"id": {"type": "string"}, "en": {"type": "string"}}),
+        },
+    })
+    formatDescription = textwrap.dedent(
+        """\
+        - When MEMORY is present, each item includes:
+            - "id": numeric line ID
+            - "ja": the original Japanese subtitle line
+            - "en": the previously translated {toLang} line, if it has been translated yet
+        """)
+    example = textwrap.dedent(
+        """\
+        Example:
+
+        MEMORY:
+        [
+          { "id": 11, "ja": "本気でそんなことを言ってるの？", "en": "Do you seriously mean that?" },
+          { "id": 12, "ja": "嘘だと言ってよ。", "en": "Tell me it's a lie." }
+        ]
+
+        TARGET:
+        {
+          "subtitle_lines": [
+            { "id": 13, "ja": "信じたくない。" },
+            { "id": 14, "ja": "でも前に進まなきゃ。" }
+          ]
+        }
+
+        Expected output (structure only):
+        {
+          "subtitle_lines_translated": [
+            { "id": 13, "en": "I don't want to believe it." },
+            { "id": 14, "en": "But I have to keep moving forward." }
+          ]
+        }
+        """)
+
+    def encodeData(self, memoryLines, targetLines) -> str:
+        memory = []
+        for lineId, ja, en in memoryLines:
+            indent = "  "
+            if en:
+                line = f'\n{indent}{{ "id": {lineId}, "ja": "{ja}", "en": "{en}" }}'
+            else:
+                line = f'\n{indent}{{ "id": {lineId}, "ja": "{ja}" }}'
+            memory.append(line)
+
+        jaLines = []
+        for lineId, ja in targetLines:
+            indent = "    "
+            line = f'\n{indent}{{ "id": {lineId}, "ja": "{ja}" }}'
+            jaLines.append(line)
+
+        return textwrap.dedent(f"""\
+MEMORY:
+[{",".join(memory)}
+]
+
+TARGET:
+{{
+  "subtitle_lines": [{",".join(jaLines)}
+  ]
+}}
+)""")
+
+    def toLines(self, output) -> List[SubtitleLineTranslated]:
+        return output.subtitleLines
+
+
+class MinifiedJsonEncoding:
+    name = "minjson"
+    outputModel = CompactSubtitleFile
+    outputSchema = strictObjectSchema({
+        "l": {
+            "type": "array",
+            "items": strictObjectSchema({"i": {"type": "string"}, "t": {"type": "string"}}),
+        },
+    })
+    formatDescription = textwrap.dedent(
+        """\
+        - When MEMORY is present, each item is an array of:
+            - numeric line ID
+            - the original Japanese subtitle line
+            - the previously translated {toLang} line, if it has been translated yet
+        - Each TARGET item is an array of the numeric line ID and the Japanese subtitle line.
+        - Output each translation as "i" (the line ID) and "t" (the {toLang} translation).
+        """)
+    example = textwrap.dedent(
+        """\
+        Example:
+
+        MEMORY:
+        [[11,"本気でそんなことを言ってるの？","Do you seriously mean that?"],[12,"嘘だと言ってよ。","Tell me it's a lie."]]
+
+        TARGET:
+        [[13,"信じたくない。"],[14,"でも前に進まなきゃ。"]]
+
+        Expected output (structure only):
+        {"l":[{"i":"13","t":"I don't want to believe it."},{"i":"14","t":"But I have to keep moving forward."}]}
+        """)
+
+    def encodeData(self, memoryLines, targetLines) -> str:
+        memory = [[lineId, ja, en] if en else [lineId, ja] for lineId, ja, en in memoryLines]
+        target = [[lineId, ja] for lineId, ja in targetLines]
+        return (f"MEMORY:\n{json.dumps(memory, ensure_ascii=False, separators=(',', ':'))}\n\n"
+                f"TARGET:\n{json.dumps(target, ensure_ascii=False, separators=(',', ':'))}")
+
+    def toLines(self, output) -> List[SubtitleLineTranslated]:
+        return [SubtitleLineTranslated(id=line.i, en=line.t) for line in output.l]
+
+
+class TsvEncoding:
+    name = "tsv"
+    outputModel = TsvSubtitleFile
+    outputSchema = strictObjectSchema({"tsv": {"type": "string"}})
+    formatDescription = textwrap.dedent(
+        """\
+        - When MEMORY is present, each line has these fields, separated by tabs:
+            - numeric line ID
+            - the original Japanese subtitle line
+            - the previously translated {toLang} line, if it has been translated yet
+        - Each TARGET line is the numeric line ID and the Japanese subtitle line, separated by a tab.
+        - Output "tsv" with one line per translation: the line ID, a tab, then the {toLang} translation.
+        """)
+    example = textwrap.dedent(
+        """\
+        Example:
+
+        MEMORY:
+        11\t本気でそんなことを言ってるの？\tDo you seriously mean that?
+        12\t嘘だと言ってよ。\tTell me it's a lie.
+
+        TARGET:
+        13\t信じたくない。
+        14\tでも前に進まなきゃ。
+
+        Expected output (structure only):
+        {"tsv":"13\\tI don't want to believe it.\\n14\\tBut I have to keep moving forward."}
+        """)
+
+    def encodeData(self, memoryLines, targetLines) -> str:
+        memory = ["\t".join([str(lineId), toTsvField(ja)] + ([toTsvField(en)] if en else [])) for lineId, ja, en in memoryLines]
+        target = [f"{lineId}\t{toTsvField(ja)}" for lineId, ja in targetLines]
+        return "MEMORY:\n" + "\n".join(memory) + "\n\nTARGET:\n" + "\n".join(target)
+
+    def toLines(self, output) -> List[SubtitleLineTranslated]:
+        lines = []
+        for row in output.tsv.splitlines():
+            if "\t" in row:
+                lineId, en = row.split("\t", 1)
+                lines.append(SubtitleLineTranslated(id=lineId.strip(), en=en.strip()))
+        return lines
+
+
+class MultiLanguageJsonEncoding(JsonEncoding):
+    """
+    Asks for the translation into several languages in one response, with one output field per language code.
+    MEMORY lines hold the translation into the first language
+    """
+    def __init__(self, languages: Dict[str, str]):
+        """
+        languages is {name: code} of each target language, e.g. {"English": "en", "Korean": "ko"}
+        """
+        self.languages = languages
+        self.name = "multi-" + "-".join(languages.values())
+        # prefixed, so a language code can't clash with the other fields, e.g. indonesian's "id"
+        self.fields = {name: f"t_{code}" for name, code in languages.items()}
+        fields = list(self.fields.values())
+        lineModel = create_model("MultiLanguageSubtitleLine", id=(str, ...), **{field: (str, ...) for field in fields})
+        self.outputModel = create_model("MultiLanguageSubtitleFile", subtitleLines=(list[lineModel], ...))
+        self.outputSchema = strictObjectSchema({
+            "subtitleLines": {
+                "type": "array",
+                "items": strictObjectSchema({"id": {"type": "string"}, **{field: {"type": "string"} for field in fields}}),
+            },
+        })
+
+        firstLanguage = next(iter(languages))
+        self.formatDescription = JsonEncoding.formatDescription.replace("{toLang}", firstLanguage) + "".join(
+            f'- Output each line\'s {name} translation as "{field}".\n' for name, field in self.fields.items())
+        exampleOutput = ", ".join(f'"{field}": "<{name} translation>"' for name, field in self.fields.items())
+        self.example = JsonEncoding.example[:JsonEncoding.example.index("Expected output")] + textwrap.dedent(
+            f"""\
+            Expected output (structure only):
+            {{
+              "subtitle_lines_translated": [
+                {{ "id": 13, {exampleOutput} }},
+                {{ "id": 14, {exampleOutput} }}
+              ]
+            }}
+            """)
+
+    def toLines(self, output) -> List[SubtitleLineTranslated]:
+        return self.toLinesByLanguage(output)[next(iter(self.languages))]
+
+    def toLinesByLanguage(self, output) -> Dict[str, List[SubtitleLineTranslated]]:
+        """
+        Returns the lines of each language, by language name
+        """
+        return {name: [SubtitleLineTranslated(id=line.id, en=getattr(line, field)) for line in output.subtitleLines]
+                for name, field in self.fields.items()}
+
+
+def toTsvField(text):
+    return " ".join(text.split("\t")).replace("\n", " ")
+
+
+promptEncodings = {encoding.name: encoding for encoding in (JsonEncoding(), MinifiedJsonEncoding(), TsvEncoding())}
+
+
+def compareEncodings(memoryLines, targetLines) -> Dict[str, int]:
+    """
+    Estimated tokens of the same lines in each encoding
+    """
+    return {name: estimateTokens(encoding.encodeData(memoryLines, targetLines)) for name, encoding in promptEncodings.items()}
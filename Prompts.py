@@ -1,3 +1,5 @@
+from Glossary import Glossary, GlossaryEntry
+
 # keywordsClaris = ["クララ", "エリイ", "アンナ", "リスアニ"]
 # keywordsBandori = ["バンドリ", "愛美", "伊藤彩沙", "大橋彩香", "西本りみ", "大塚紗英"]
 # translationsBandori = {
@@ -30,3 +32,29 @@ translationContextBlueArchive = ("For context, "
                                  "This is a live broadcast about the game Blue Archive. "
                                  + translationStyle)
 # translationContext = "For context, バンドリ (bandori) is the abbreviation for the BanG Dream! franchise."
+
+# structured versions of the show contexts above, where only the entries that appear in each chunk are sent
+glossaryClarisSeason3 = Glossary([
+    GlossaryEntry("クラリス", "ClariS", aliases=("ClariS",), note="a trio of singers comprising of Clara, Elly and Anna"),
+    GlossaryEntry("クララ", "Clara", note="member of ClariS"),
+    GlossaryEntry("エリイ", "Elly", misTranscriptions=("エリー",), note="member of ClariS"),
+    GlossaryEntry("アンナ", "Anna", note="member of ClariS"),
+    GlossaryEntry("海月", "Umitsuki", aliases=("うみつき",), note="a recently released ClariS song"),
+    GlossaryEntry("コネクト", "Connect", note="a ClariS song"),
+    GlossaryEntry("リンクス", "Links", note="a ClariS song"),
+])
+glossaryClarisSeason2 = Glossary([
+    GlossaryEntry("クラリス", "ClariS", aliases=("ClariS",), note="a duo of singers comprising of Clara and Karen"),
+    GlossaryEntry("クララ", "Clara", note="member of ClariS"),
+    GlossaryEntry("カレン", "Karen", note="member of ClariS"),
+    GlossaryEntry("ティンクトゥラ", "Tinctura", note="a ClariS live tour"),
+    GlossaryEntry("ヴィア・フォルトゥナ", "Via Fortuna", aliases=("ヴィアフォルトゥナ",), note="a ClariS live tour"),
+])
+glossaryMizukiNana = Glossary([
+    GlossaryEntry("水樹奈々", "Nana Mizuki", aliases=("水樹 奈々", "みずきなな"), note="a J-pop singer"),
+    GlossaryEntry("スマイルギャング", "Smile Gang", aliases=("スマギャン",), note="Mizuki Nana's radio show"),
+    GlossaryEntry("福圓美里", "Misato Fukuen", aliases=("福圓 美里", "ふくえんみさと"), note="co-host of Smile Gang"),
+])
+glossaryBlueArchive = Glossary([
+    GlossaryEntry("ブルーアーカイブ", "Blue Archive", aliases=("ブルアカ",), note="a mobile game"),
+])
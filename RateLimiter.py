@@ -0,0 +1,199 @@
+import asyncio
+import re
+import threading
+import time
+from typing import Awaitable, Callable, Dict, Optional
+
+import openai
+
+from Config import rateLimitRequestsPerMinute, rateLimitTokensPerMinute
+from Logger import logger
+
+
+'''
+Client-side rate limiting, shared by every OpenAI call for the same model
+- Token buckets of requests and tokens per minute, refilled continuously, so calls are spaced out rather than bursting
+- The bucket sizes and levels follow the x-ratelimit-* headers of each response
+- The number of requests in flight grows by about one per round of successful requests,
+  and halves whenever a request is rate limited (AIMD)
+Calls are made with the clients' own retries turned off, so every 429 is seen here rather than retried blindly
+'''
+
+initialConcurrency = 4
+maxConcurrency = 64
+concurrencyDecrease = 0.5 # multiplied by this on every 429
+maxRetries = 5
+pollSeconds = 0.05 # how often waiting calls check again, the limiter is shared across threads and event loops
+
+
+class TokenBucket:
+    def __init__(self, perMinute):
+        self.capacity = float(perMinute)
+        self.level = float(perMinute)
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.capacity / 60)
+        self.updated = now
+
+    def waitTime(self, amount) -> float:
+        # requests bigger than the whole bucket only wait for it to be full, rather than forever
+        amount = min(amount, self.capacity)
+        return max(0.0, (amount - self.level) * 60 / self.capacity)
+
+
+def parseResetTime(value) -> Optional[float]:
+    """
+    Seconds from a reset header such as "1s", "6m0s" or "20ms"
+    """
+    if not value:
+        return None
+    units = {"h": 3600, "m": 60, "s": 1, "ms": 0.001}
+    parts = re.findall(r"([\d.]+)(ms|h|m|s)", value)
+    return sum(float(number) * units[unit] for number, unit in parts) if parts else None
+
+
+class RateLimiter:
+    def __init__(self, name, requestsPerMinute=rateLimitRequestsPerMinute, tokensPerMinute=rateLimitTokensPerMinute):
+        self.name = name
+        self.lock = threading.Lock()
+        self.requests = TokenBucket(requestsPerMinute)
+        self.tokens = TokenBucket(tokensPerMinute)
+        self.concurrencyLimit = float(initialConcurrency)
+        self.inFlight = 0
+        self.pausedUntil = 0.0
+
+        self.rateLimitedCount = 0
+        self.waitedSeconds = 0.0
+
+    def tryAcquire(self, estimatedTokens) -> float:
+        """
+        Takes a slot for one request if one is free, returning 0, otherwise returns how long to wait before trying again
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.requests.refill(now)
+            self.tokens.refill(now)
+            wait = max(self.pausedUntil - now, self.requests.waitTime(1), self.tokens.waitTime(estimatedTokens))
+            if wait <= 0 and self.inFlight < int(self.concurrencyLimit):
+                self.requests.level -= 1
+                self.tokens.level -= estimatedTokens
+                self.inFlight += 1
+                return 0.0
+            return max(wait, pollSeconds)
+
+    def release(self):
+        with self.lock:
+            self.inFlight -= 1
+
+    def onSuccess(self, headers, estimatedTokens, usedTokens):
+        with self.lock:
+            self.concurrencyLimit = min(maxConcurrency, self.concurrencyLimit + 1 / self.concurrencyLimit)
+            if usedTokens:
+                # correct the estimate taken from the bucket
+                self.tokens.level -= usedTokens - estimatedTokens
+            self.updateFromHeaders(headers)
+
+    def onRateLimited(self, headers):
+        with self.lock:
+            self.rateLimitedCount += 1
+            self.concurrencyLimit = max(1.0, self.concurrencyLimit * concurrencyDecrease)
+            self.updateFromHeaders(headers)
+            retryAfter = headers.get("retry-after")
+            pause = float(retryAfter) if retryAfter and retryAfter.replace(".", "", 1).isdigit() else \
+                max(parseResetTime(headers.get("x-ratelimit-reset-requests")) or 0,
+                    parseResetTime(headers.get("x-ratelimit-reset-tokens")) or 0) or 1.0
+            self.pausedUntil = max(self.pausedUntil, time.monotonic() + pause)
+        logger.warn(f"Rate limited on {self.name}, waiting {pause:.1f}s and lowering concurrency to {int(self.concurrencyLimit)}")
+
+    def updateFromHeaders(self, headers):
+        for bucket, kind in ((self.requests, "requests"), (self.tokens, "tokens")):
+            limit = headers.get(f"x-ratelimit-limit-{kind}")
+            remaining = headers.get(f"x-ratelimit-remaining-{kind}")
+            if limit and limit.isdigit() and int(limit):
+                bucket.capacity = float(limit)
+            if remaining and remaining.isdigit():
+                bucket.level = min(bucket.level, float(remaining))
+
+    def retryDelay(self, error, attempt, retries) -> float:
+        """
+        Returns how long to wait before retrying after error, or raises it if it shouldn't be retried
+        """
+        if attempt >= retries:
+            raise error
+        if isinstance(error, openai.RateLimitError):
+            self.onRateLimited(error.response.headers)
+            return 0.0
+        if isinstance(error, (openai.APIConnectionError, openai.InternalServerError)):
+            delay = min(30.0, 0.5 * 2 ** attempt)
+            logger.warn(f"{type(error).__name__} on {self.name}, retrying in {delay:.1f}s")
+            return delay
+        raise error
+
+    async def call(self, sendRequest: Callable[[], Awaitable], estimatedTokens=0,
+                   countTokens: Callable[[object], int] = lambda response: 0, retries=maxRetries,
+                   onSent: Callable[[], None] = lambda: None):
+        """
+        sendRequest() makes the request through with_raw_response, so the headers can be read.
+        Returns the parsed response, and countTokens(response) corrects the estimated token use.
+        onSent() is called each time the request is actually sent
+        """
+        for attempt in range(retries + 1):
+            while wait := self.tryAcquire(estimatedTokens):
+                self.waitedSeconds += wait
+                await asyncio.sleep(wait)
+            onSent()
+            try:
+                rawResponse = await sendRequest()
+            except openai.APIError as error:
+                self.release()
+                await asyncio.sleep(self.retryDelay(error, attempt, retries))
+                continue
+            except BaseException:
+                self.release()
+                raise
+            self.release()
+            response = rawResponse.parse()
+            self.onSuccess(rawResponse.headers, estimatedTokens, countTokens(response))
+            return response
+
+    def callSync(self, sendRequest: Callable[[], object], estimatedTokens=0,
+                 countTokens: Callable[[object], int] = lambda response: 0, retries=maxRetries):
+        """
+        Blocking version of call
+        """
+        for attempt in range(retries + 1):
+            while wait := self.tryAcquire(estimatedTokens):
+                self.waitedSeconds += wait
+                time.sleep(wait)
+            try:
+                rawResponse = sendRequest()
+            except openai.APIError as error:
+                self.release()
+                time.sleep(self.retryDelay(error, attempt, retries))
+                continue
+            except BaseException:
+                self.release()
+                raise
+            self.release()
+            response = rawResponse.parse()
+            self.onSuccess(rawResponse.headers, estimatedTokens, countTokens(response))
+            return response
+
+    def logStats(self):
+        logger.info(f"Rate limiter for {self.name}: {self.rateLimitedCount} request(s) rate limited, "
+                    f"{self.waitedSeconds:.0f}s spent waiting, concurrency limit {int(self.concurrencyLimit)}")
+
+
+rateLimiters: Dict[str, RateLimiter] = {}
+rateLimitersLock = threading.Lock()
+
+
+def rateLimiterFor(model) -> RateLimiter:
+    """
+    The limiter shared by every call to model, as OpenAI's limits are per model
+    """
+    with rateLimitersLock:
+        if model not in rateLimiters:
+            rateLimiters[model] = RateLimiter(model)
+        return rateLimiters[model]
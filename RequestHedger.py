@@ -0,0 +1,98 @@
+import asyncio
+import time
+from collections import deque
+from typing import Awaitable, Callable, Optional
+
+import numpy as np
+
+from Logger import logger
+
+
+latencyHistorySize = 50 # recent flex latencies the hedging delay is learnt from
+minimumLatencySamples = 5 # no hedging until this many flex requests have finished
+
+
+class RequestHedger:
+    """
+    Sends a duplicate of a slow flex tier request on the default tier, once it has taken longer than a percentile of
+    recent flex latencies, then takes whichever valid response comes first and cancels the other
+    """
+    def __init__(self, serviceTier, hedgePercentile: Optional[float]):
+        """
+        hedgePercentile of None never hedges, as does any service tier other than flex
+        """
+        self.serviceTier = serviceTier
+        self.hedgePercentile = hedgePercentile
+        self.latencies = deque(maxlen=latencyHistorySize)
+
+        self.requests = 0
+        self.hedges = 0
+        self.hedgeWins = 0
+        self.latencySaved = 0.0
+
+    def hedgeDelay(self) -> Optional[float]:
+        if self.serviceTier != "flex" or self.hedgePercentile is None or len(self.latencies) < minimumLatencySamples:
+            return None
+        return float(np.percentile(self.latencies, self.hedgePercentile))
+
+    async def run(self, sendRequest: Callable[[str, Callable[[], None]], Awaitable], isValid: Callable[[object], bool]):
+        """
+        sendRequest(serviceTier, onSent) sends the request on the given tier, calling onSent() as it is actually sent,
+        so time spent waiting on a rate limiter doesn't count as latency. Returns the first valid response,
+        or if neither is valid, the first response (or raises the primary request's error)
+        """
+        self.requests += 1
+        sent = asyncio.Event()
+        primary = asyncio.create_task(sendRequest(self.serviceTier, sent.set))
+        tasks = [primary]
+        waitForSent = asyncio.create_task(sent.wait())
+        try:
+            await asyncio.wait([primary, waitForSent], return_when=asyncio.FIRST_COMPLETED)
+            startTime = time.monotonic()
+            delay = self.hedgeDelay()
+            done, pending = await asyncio.wait(tasks, timeout=delay)
+            if not done:
+                logger.info(f"Request still running after {delay:.1f}s, sending a duplicate on the default tier")
+                self.hedges += 1
+                tasks.append(asyncio.create_task(sendRequest("default", lambda: None)))
+
+            fallback = None
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in [task for task in tasks if task in done]:
+                    if task.exception() is not None:
+                        continue
+                    if task is primary:
+                        self.latencies.append(time.monotonic() - startTime)
+                    if isValid(task.result()):
+                        if task is not primary:
+                            latency = time.monotonic() - startTime
+                            self.onHedgeWin(latency)
+                            # the cancelled flex request took at least this long. Leaving it out would only learn
+                            # from flex requests that beat the hedge, pulling the hedging delay down over time
+                            self.latencies.append(latency)
+                        return task.result()
+                    fallback = fallback or task
+
+            if fallback:
+                return fallback.result()
+            return primary.result()
+        finally:
+            waitForSent.cancel()
+            for task in tasks:
+                task.cancel()
+
+    def onHedgeWin(self, latency):
+        self.hedgeWins += 1
+        # the cancelled flex request would have taken at least this long, so estimate it from the recent flex requests
+        # that did take longer
+        slowerLatencies = [recentLatency for recentLatency in self.latencies if recentLatency > latency]
+        if slowerLatencies:
+            self.latencySaved += float(np.mean(slowerLatencies)) - latency
+
+    def logStats(self, name=""):
+        if not self.hedges:
+            return
+        logger.info(f"Hedged {self.hedges} of {self.requests} {name + ' ' if name else ''}request(s) on the default tier, "
+                    f"{self.hedgeWins} duplicate(s) finished first, saving an estimated {self.latencySaved:.0f}s of latency")
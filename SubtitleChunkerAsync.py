@@ -1,16 +1,16 @@
-from collections import deque
-from functools import reduce
-
 from AsyncUtils import serialSubscriber
 from MessageBus import MessageType
+from PhraseChunker import IncrementalChunker
 from TranscribedPhrase import SubtitleChunk
 
 
 class SubtitleChunker:
+    """
+    Turns the live stream of ASR words into subtitle lines, with the same rules as the batch chunking (see PhraseChunker)
+    """
     def __init__(self, messageBus):
         self.bus = messageBus
-        self.words = []
-        self.bufferSize = 0
+        self.chunker = IncrementalChunker()
         self.phraseId = 0
 
         serialSubscriber(self.bus, MessageType.ASR_FINAL)(self.onASRWord)
@@ -19,36 +19,13 @@ class SubtitleChunker:
 
     async def onASRWord(self, data):
         # print(f"Received async message: {data}")
-        self.words.append(data)
-        self.bufferSize += len(data.text)
-
-        if self.shouldChunk():
+        for words in self.chunker.push(data):
             subtitleChunk = SubtitleChunk(
-                start=self.words[0].start,
-                end=self.words[-1].end,
-                text="".join([word.text for word in self.words]),
+                start=words[0].start,
+                end=words[-1].end,
+                text="".join([word.text for word in words]),
                 uuid=str(self.phraseId)
             )
             self.bus.publish(MessageType.SUBTITLE_CHUNK, subtitleChunk)
             # print(f"Chunker published {subtitleChunk.text}")
-            self.words = []
-            self.bufferSize = 0
             self.phraseId += 1
-
-    def shouldChunk(self):
-        """
-        Chunking strategy - turning a stream of words into subtitle lines
-        - Always break line on end of sentence punctuation
-        - If within target line length, break if silence is over threshold
-        - If beyond target line length, break if silence is over short threshold, or if word is longer than threshold
-        - If at max line length, forcibly break
-        """
-
-        if not len(self.words):
-            return False
-
-        delimiters = {"。", "？", "?"}
-
-        return reduce(lambda acc, delimiter: acc or delimiter in self.words[-1].text, delimiters, False)
-
-        # return True
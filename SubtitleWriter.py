@@ -5,39 +5,62 @@ from TranscribedPhrase import TranscribedPhrase
 from Logger import logger
 
 
-def writeSubtitles(subtitleLines: List[TranscribedPhrase], filepath):
-    logger.info("--- Writing subtitle file ---")
-    extendTime = 0.2  # how long to extend each subtitle line by
+extendTime = 0.2  # how long to extend each subtitle line by
 
-    srtFile = []
 
-    for i, subtitleLine in enumerate(subtitleLines):
+def writeSubtitles(subtitleLines: List[TranscribedPhrase], filepath):
+    logger.info("--- Writing subtitle file ---")
+    subtitleWriter = SubtitleFileWriter(filepath)
+    subtitleWriter.add(subtitleLines)
+    subtitleWriter.close()
+
+
+class SubtitleFileWriter:
+    """
+    Writes subtitle lines to an srt file as they become available.
+    Each line is written once the line after it arrives, as that decides when it ends
+    """
+    def __init__(self, filepath):
+        self.fullFilePath = filepath + ".srt"
+        self.outputFile = open(self.fullFilePath, "w", encoding="utf-8")
+        self.lineCount = 0
+        self.pendingLine = None
+
+    def add(self, subtitleLines: List[TranscribedPhrase]):
+        for subtitleLine in subtitleLines:
+            if self.pendingLine:
+                self.write(self.pendingLine, subtitleLine)
+            self.pendingLine = subtitleLine
+        self.outputFile.flush()
+
+    def close(self):
+        if self.pendingLine:
+            self.write(self.pendingLine, None)
+        self.outputFile.close()
+        logger.info(f"Finished writing subtitles to {self.fullFilePath}")
+
+    def write(self, subtitleLine, nextSubtitleLine):
+        self.lineCount += 1
         if subtitleLine.start is None or subtitleLine.end is None:
             logger.warn("Writing subtitle, no start/end timestamp detected")
-            continue
+            return
 
         line = []
-        line.append(f"{i + 1}")
+        line.append(f"{self.lineCount}")
 
         # slightly extend the end time of each subtitle line for readability
         endTimestamp = subtitleLine.end
-        if i < (len(subtitleLines) - 1): # if not the last subtitleLine
-            endTimestamp = min(subtitleLine.end + extendTime, subtitleLines[i + 1].start)
+        if nextSubtitleLine: # if not the last subtitleLine
+            endTimestamp = min(subtitleLine.end + extendTime, nextSubtitleLine.start)
 
         line.append(f"{genTimestamp(subtitleLine.start)} --> {genTimestamp(endTimestamp)}")
         line.append(f"{subtitleLine.translatedText}")
-        srtFile.append("\n".join(line))
-
-    output = "\n\n".join(srtFile)
-
-    fullFilePath = filepath + ".srt"
-
-    outputFile = open(fullFilePath, "w", encoding="utf-8")
-    outputFile.write(output)
-    outputFile.close()
+        output = "\n".join(line)
 
-    logger.info(f"Finished writing subtitles to {fullFilePath}")
-    logger.debug(output)
+        if self.outputFile.tell():
+            self.outputFile.write("\n\n")
+        self.outputFile.write(output)
+        logger.debug(output)
 
 
 def genTimestamp(seconds):
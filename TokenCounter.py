@@ -0,0 +1,50 @@
+import math
+import re
+
+from Logger import logger
+
+
+cjkTokensPerCharacter = 1.0 # kana and kanji are roughly one token each in the gpt tokenizers
+asciiCharactersPerToken = 4.0 # for runs of letters and digits
+
+# letters and digits, other ascii symbols, runs of indentation and line breaks
+tokenPattern = re.compile(r"([A-Za-z0-9]+)|([!-/:-@\[-`{-~])|(\s{2,})")
+
+
+def estimateTokens(text) -> int:
+    """
+    Rough token count without needing a tokenizer, good enough for budgeting requests and comparing prompt formats.
+    Punctuation is counted as a token each, so the syntax of structured formats like json is not undercounted
+    """
+    tokens = 0.0
+    for letters, symbol, whitespace in tokenPattern.findall(text):
+        tokens += len(letters) / asciiCharactersPerToken if letters else 1
+    nonAsciiCount = sum(1 for character in text if ord(character) >= 128)
+    return math.ceil(tokens + nonAsciiCount * cjkTokensPerCharacter)
+
+
+class TokenUsage:
+    """
+    Running total of the token usage reported by the api, to check how much of the input hit the prompt cache
+    """
+    def __init__(self):
+        self.requests = 0
+        self.inputTokens = 0
+        self.cachedInputTokens = 0
+        self.outputTokens = 0
+
+    def add(self, usage: dict):
+        """
+        Adds the usage of one response, as the dict form of the responses api usage
+        """
+        self.requests += 1
+        self.inputTokens += usage.get("input_tokens") or 0
+        self.cachedInputTokens += (usage.get("input_tokens_details") or {}).get("cached_tokens") or 0
+        self.outputTokens += usage.get("output_tokens") or 0
+
+    def logStats(self):
+        if not self.requests:
+            return
+        logger.info(f"Token usage over {self.requests} request(s): {self.inputTokens} input "
+                    f"({self.cachedInputTokens} cached, {self.inputTokens - self.cachedInputTokens} uncached, "
+                    f"{self.cachedInputTokens / max(1, self.inputTokens):.0%} cache hit ratio), {self.outputTokens} output")
@@ -0,0 +1,71 @@
+from dataclasses import dataclass, field
+from typing import List
+
+from openai.types.audio import TranscriptionWord
+
+from Logger import logger
+
+
+duplicateToleranceSeconds = 0.5 # words with the same text this close together at a seam are treated as duplicates
+maxSeamWords = 5 # how many words before a seam to compare against when looking for duplicates
+
+
+@dataclass
+class StitchedTranscript:
+    # same shape as the verbose_json transcript returned by whisper, so it can be fed straight into chunkTranscription
+    words: List[TranscriptionWord] = field(default_factory=list)
+
+
+def offsetWords(words, timeOffsetSeconds, mapTime=lambda seconds: seconds) -> List[TranscriptionWord]:
+    """
+    Moves segment-relative word timestamps onto the file's timeline, optionally mapping them with mapTime
+    (e.g. from the compacted voice activity timeline back to the original)
+    """
+    return [TranscriptionWord(word=word.word,
+                              start=mapTime(word.start + timeOffsetSeconds),
+                              end=mapTime(word.end + timeOffsetSeconds))
+            for word in (words or []) if word.word]
+
+
+class SeamStitcher:
+    """
+    Merges the word lists of overlapping segments into one list, ordered by timestamp. Segments are added one at a time,
+    in order, so the words before each seam can be used before later segments finish
+    - Each seam is made at the point the earlier segment was planned to end
+    - Duplicate words either side of a seam are dropped
+    """
+    def __init__(self):
+        self.stitched = []
+        self.seamStart = float("-inf")
+        self.droppedCount = 0
+        self.segmentCount = 0
+
+    def add(self, words, cutPoint=float("inf")) -> List[TranscriptionWord]:
+        """
+        Adds the next segment's words, already offset to the original timeline, returning the words kept from it.
+        cutPoint is where the segment was planned to end, leave it as inf for the last segment
+        """
+        # each word belongs to the segment its midpoint falls in
+        kept = [word for word in words if self.seamStart <= (word.start + word.end) / 2 < cutPoint]
+
+        # whisper timestamps are fuzzy, so the same words can land either side of a seam
+        previousTail = self.stitched[-maxSeamWords:]
+        while kept and any(isDuplicate(previousWord, kept[0]) for previousWord in previousTail):
+            kept.pop(0)
+            self.droppedCount += 1
+
+        self.stitched.extend(kept)
+        self.seamStart = cutPoint
+        self.segmentCount += 1
+        return kept
+
+    def logDropped(self):
+        if self.droppedCount:
+            logger.info(f"Dropped {self.droppedCount} duplicate word(s) while stitching {self.segmentCount} segments")
+
+
+def isDuplicate(previousWord, word):
+    # same text, and the two words overlap in time (give or take the tolerance)
+    return (previousWord.word.strip() == word.word.strip()
+            and word.start <= previousWord.end + duplicateToleranceSeconds
+            and previousWord.start <= word.end + duplicateToleranceSeconds)
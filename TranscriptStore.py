@@ -0,0 +1,101 @@
+import hashlib
+import json
+import os
+import shutil
+from functools import cached_property
+from typing import List, Optional
+
+import numpy as np
+from openai.types.audio import TranscriptionWord
+
+from Logger import logger
+
+
+storeFolder = os.path.join(os.path.expanduser("~"), ".nihongowakarimasen", "transcripts")
+
+
+class StoredTranscript:
+    """
+    Word-level timings of one transcript, stored as columns:
+    - starts.npy, ends.npy: float64 seconds
+    - textOffsets.npy: int64 byte offsets into text.bin, one more than the number of words
+    - text.bin: every word's utf-8 text, concatenated
+    Each column is memory-mapped the first time it is used
+    """
+    def __init__(self, folder):
+        self.folder = folder
+
+    @cached_property
+    def starts(self) -> np.ndarray:
+        return np.load(os.path.join(self.folder, "starts.npy"), mmap_mode="r")
+
+    @cached_property
+    def ends(self) -> np.ndarray:
+        return np.load(os.path.join(self.folder, "ends.npy"), mmap_mode="r")
+
+    @cached_property
+    def textOffsets(self) -> np.ndarray:
+        return np.load(os.path.join(self.folder, "textOffsets.npy"), mmap_mode="r")
+
+    @cached_property
+    def textBlob(self) -> np.ndarray:
+        path = os.path.join(self.folder, "text.bin")
+        if not os.path.getsize(path):
+            return np.zeros(0, dtype=np.uint8)
+        return np.memmap(path, dtype=np.uint8, mode="r")
+
+    def __len__(self):
+        return len(self.starts)
+
+    def text(self, i) -> str:
+        return self.textBlob[self.textOffsets[i]:self.textOffsets[i + 1]].tobytes().decode("utf-8")
+
+    def words(self) -> List[TranscriptionWord]:
+        return [TranscriptionWord(word=self.text(i), start=float(self.starts[i]), end=float(self.ends[i]))
+                for i in range(len(self))]
+
+
+class TranscriptStore:
+    """
+    Raw whisper word timings, keyed by the decoded audio content and the ASR settings,
+    so re-chunking or re-translating a file never needs to pay for ASR again
+    """
+    def __init__(self, folder=storeFolder):
+        self.folder = folder
+        os.makedirs(self.folder, exist_ok=True)
+
+    @staticmethod
+    def key(audioHash, settings) -> str:
+        return hashlib.sha256(f"{audioHash}|{json.dumps(settings, sort_keys=True)}".encode("utf-8")).hexdigest()
+
+    def get(self, key) -> Optional[StoredTranscript]:
+        entryFolder = os.path.join(self.folder, key)
+        if not os.path.isdir(entryFolder):
+            return None
+        logger.info(f"Found stored transcript {key}")
+        return StoredTranscript(entryFolder)
+
+    def keys(self) -> List[str]:
+        # partial entries are left behind by a crash while storing
+        return sorted(name for name in os.listdir(self.folder)
+                      if not name.endswith(".partial") and os.path.isdir(os.path.join(self.folder, name)))
+
+    def put(self, key, words):
+        encodedWords = [word.word.encode("utf-8") for word in words]
+        textOffsets = np.zeros(len(words) + 1, dtype=np.int64)
+        textOffsets[1:] = np.cumsum([len(encodedWord) for encodedWord in encodedWords])
+
+        # write to a temporary folder and move it into place, so a crash never leaves a partial entry
+        entryFolder = os.path.join(self.folder, key)
+        partialFolder = entryFolder + ".partial"
+        shutil.rmtree(partialFolder, ignore_errors=True)
+        os.makedirs(partialFolder)
+        np.save(os.path.join(partialFolder, "starts.npy"), np.array([word.start for word in words], dtype=np.float64))
+        np.save(os.path.join(partialFolder, "ends.npy"), np.array([word.end for word in words], dtype=np.float64))
+        np.save(os.path.join(partialFolder, "textOffsets.npy"), textOffsets)
+        with open(os.path.join(partialFolder, "text.bin"), "wb") as f:
+            f.write(b"".join(encodedWords))
+
+        shutil.rmtree(entryFolder, ignore_errors=True)
+        os.replace(partialFolder, entryFolder)
+        logger.info(f"Stored transcript of {len(words)} words as {key}")
@@ -1,31 +1,52 @@
+import asyncio
+import hashlib
+import json
 import textwrap
-from collections import deque
+import time
+from collections import Counter, deque
+from dataclasses import replace
 from datetime import datetime
+from typing import AsyncIterator, Dict, List, Optional, Tuple
 
-from openai import OpenAI
-from pydantic import BaseModel
+from openai import AsyncOpenAI
+from pydantic import ValidationError
 
-from Config import fromLang, toLang, chatGPTServiceTier, chatGPTReasoningEffort
+from Config import fromLang, toLang, chatGPTServiceTier, chatGPTReasoningEffort, translationConcurrency, promptLineEncoding, \
+    promptCacheKeyEnabled, hedgeLatencyPercentile, cascadeModel
+from TranscribedPhrase import TranscribedPhrase
 from TranslationInterface import TranslationInterface
+from Glossary import Glossary
 from Logger import logger
+from JobJournal import JobJournal
+from OpenAIClients import openAIClient, asyncOpenAIClient
+from TokenCounter import TokenUsage, estimateTokens
+from TranslationCache import TranslationCache
+from TranslationChecks import findSuspectLines
+from PromptEncoding import promptEncodings, compareEncodings
+from RateLimiter import rateLimiterFor
+from RequestHedger import RequestHedger
+from AdaptiveChunkSizer import AdaptiveChunkSizer
 
 
-def generatePrompt(extraPrompts, untranslatedSubs, previousContext):
+memorySize = 5 # number of previous lines given as context to each request
+maxBatchRounds = 3 # Batch API mode, rounds of retries before falling back to normal requests
+batchPollSeconds = 60
+
+def generatePrompt(extraPrompts, untranslatedSubs, previousContext, encoding=None, glossary=None, toLang=toLang):
+    encoding = encoding or promptEncodings[promptLineEncoding]
     instructions = textwrap.dedent(
         f"""\
-        You are a precise translator specializing in Japanese-to-English subtitle translation.
+        You are a precise translator specializing in {fromLang}-to-{toLang} subtitle translation.
         
         Your task:
-        Translate the TARGET lines into English while using the MEMORY block for narrative continuity,
+        Translate the TARGET lines into {toLang} while using the MEMORY block for narrative continuity,
         character consistency, tone, naming conventions, and handling ambiguous references.
         
         MEMORY (context block):
         - The MEMORY block may contain zero or more previously translated subtitle pairs.
         - If MEMORY is empty, treat the translation as the beginning of the scene and do NOT assume any prior context.
-        - When MEMORY is present, each item includes:
-            - "id": numeric line ID
-            - "ja": the original Japanese subtitle line
-            - "en": the previously translated English line
+        """) + encoding.formatDescription.format(toLang=toLang) + textwrap.dedent(
+        f"""\
         - MEMORY lines are NOT to be translated again.
         - NEVER output, modify, or repeat MEMORY lines.
         - MEMORY exists ONLY as contextual reference to maintain style, pronouns, tone, speaking manner,
@@ -43,44 +64,15 @@ def generatePrompt(extraPrompts, untranslatedSubs, previousContext):
         - Output ONLY the structured JSON specified by the API (no explanations).
         
         General style rules:
-        - Use clear, natural English suitable for timed subtitles.
+        - Use clear, natural {toLang} suitable for timed subtitles.
         - Resolve pronouns consistently with MEMORY.
         - If ambiguity exists even with MEMORY, choose a neutral faithful translation.
-        - Use English punctuation conventions.
+        - Use {toLang} punctuation conventions.
         
         """)
 
-    additionalContext = textwrap.dedent(
-f"""
-Additional translation context:
-{extraPrompts}
-""")
-
-    example = textwrap.dedent(
+    example = encoding.example + textwrap.dedent(
         """\
-        Example:
-        
-        MEMORY:
-        [
-          { "id": 11, "ja": "本気でそんなことを言ってるの？", "en": "Do you seriously mean that?" },
-          { "id": 12, "ja": "嘘だと言ってよ。", "en": "Tell me it's a lie." }
-        ]
-        
-        TARGET:
-        {
-          "subtitle_lines": [
-            { "id": 13, "ja": "信じたくない。" },
-            { "id": 14, "ja": "でも前に進まなきゃ。" }
-          ]
-        }
-        
-        Expected output (structure only):
-        {
-          "subtitle_lines_translated": [
-            { "id": 13, "en": "I don't want to believe it." },
-            { "id": 14, "en": "But I have to keep moving forward." }
-          ]
-        }
         
         If id 14 was missing for example, this would be an incorrect output because a line from TARGET is missing.
         You MUST ensure there are no missing lines.
@@ -88,99 +80,534 @@ Additional translation context:
         ---
         
         """)
-    memory = []
-    for i, phrase in enumerate(previousContext, start=1):
-        indent = "  "
-        line = f'\n{indent}{{ "id": {i}, "ja": "{phrase.text}", "en": "{phrase.translatedText}" }}'
-        memory.append(line)
-
-    jaLines = []
-    for i, phrase in enumerate(untranslatedSubs, start=len(memory) + 1):
-        indent = "    "
-        line = f'\n{indent}{{ "id": {i}, "ja": "{phrase.text}" }}'
-        jaLines.append(line)
-
-    data = textwrap.dedent(f"""\
-Now translate the following:
-MEMORY:
-[{",".join(memory)}
-]
-
-TARGET:
-{{
-  "subtitle_lines": [{",".join(jaLines)}
-  ]
-}}
-)""")
+
+    # the same for every request of a show, so it goes after the parts that are the same for every show
+    additionalContext = textwrap.dedent(
+f"""\
+Additional translation context:
+{extraPrompts}
+
+---
+
+""")
+
+    # only the entries that appear in these lines, after the shared prefix as they change between requests
+    glossaryPrompt = ""
+    if glossary is not None:
+        foundEntries = glossary.toPrompt([phrase.text for phrase in list(previousContext) + list(untranslatedSubs)])
+        if foundEntries:
+            glossaryPrompt = f"Names and terms in these lines:\n{foundEntries}\n\n"
+
+    memoryLines, targetLines = toEncodingLines(untranslatedSubs, previousContext)
+    data = glossaryPrompt + "Now translate the following:\n" + encoding.encodeData(memoryLines, targetLines)
 
     # TODO: add next phrases to the end so it knows the following context
     # or simply chop off the end and re-translate it next loop
 
-    return instructions + additionalContext + example + data
+    # everything before data is identical between requests, so the api can reuse its cached prefix
+    return instructions + example + additionalContext + data
+
 
+def promptCacheKey(extraPrompts, model, toLang=toLang):
+    """
+    Groups requests of the same show, so they are routed to where their shared prompt prefix is already cached
+    """
+    if not promptCacheKeyEnabled:
+        return None
+    return "subtitles-" + hashlib.sha256(f"{model}|{toLang}|{extraPrompts}".encode("utf-8")).hexdigest()[:32]
 
-def checkValidTranslation(expectedUuidList, actualUuidList):
-    # check number of lines in output matches input
-    if len(expectedUuidList) != len(actualUuidList):
-        logger.warn("Translation failed, different number of lines than expected. "
-                    f"Input was {len(expectedUuidList)} lines but output was {len(actualUuidList)} lines. "
-                    f"Missing line(s): {set(expectedUuidList) - set(actualUuidList)}. "
-                    f"Extra line(s): {set(actualUuidList) - set(expectedUuidList)}")
-        return False
-    # check each line UUID matches the original and the ordering is the same
-    for expectedUuid, actualUuid in zip(expectedUuidList, actualUuidList):
-        if expectedUuid != actualUuid:
-            logger.warn("Translation failed, line UUID mismatch. "
-                        f"Input UUID is {expectedUuid} but output UUID is {actualUuid}")
-            return False
 
-    return True
+def toEncodingLines(untranslatedSubs, previousContext):
+    memoryLines = [(i, phrase.text, phrase.translatedText) for i, phrase in enumerate(previousContext, start=1)]
+    targetLines = [(i, phrase.text) for i, phrase in enumerate(untranslatedSubs, start=len(memoryLines) + 1)]
+    return memoryLines, targetLines
+
+
+def findValidLines(expectedIdList, translatedLines):
+    """
+    Returns {id: translation} for every expected line that chatgpt translated, ignoring extra, duplicate and empty lines
+    """
+    validLines = {}
+    for line in translatedLines:
+        if line.id in expectedIdList and line.id not in validLines and line.en.strip():
+            validLines[line.id] = line.en
+
+    if len(validLines) != len(expectedIdList) or len(translatedLines) != len(expectedIdList):
+        logger.warn("Translation incomplete. "
+                    f"Input was {len(expectedIdList)} lines but output was {len(translatedLines)} lines. "
+                    f"Missing or invalid line(s): {set(expectedIdList) - set(validLines)}. "
+                    f"Extra line(s): {set(line.id for line in translatedLines) - set(expectedIdList)}")
+    return validLines
+
+
+def splitIntoRuns(indexes):
+    """
+    Splits a sorted list of indexes into lists of consecutive indexes
+    """
+    runs = []
+    for i in indexes:
+        if runs and i == runs[-1][-1] + 1:
+            runs[-1].append(i)
+        else:
+            runs.append([i])
+    return runs
+
+
+def groupIndexes(phrases, indexes, chunkSizer) -> List[List[int]]:
+    """
+    Splits a sorted list of indexes, which needn't be consecutive, into as few lists as fit the chunk sizer's budget
+    """
+    groups = []
+    groupTokens = 0
+    for i in indexes:
+        lineTokens = chunkSizer.chunkTokens([phrases[i]])
+        if not groups or groupTokens + lineTokens > chunkSizer.tokenBudget:
+            groups.append([])
+            groupTokens = 0
+        groups[-1].append(i)
+        groupTokens += lineTokens
+    return groups
+
+
+def neighbourLines(phrases, previousPhrases, indexes) -> List[TranscribedPhrase]:
+    """
+    The translated lines either side of each of phrases[indexes], in order, as MEMORY for lines that aren't next to each other
+    """
+    allPhrases = list(previousPhrases) + list(phrases)
+    offset = len(previousPhrases)
+    neighbours = sorted({j for i in indexes for j in (i - 1, i + 1)
+                         if j not in indexes and -offset <= j < len(phrases)})
+    return [allPhrases[j + offset] for j in neighbours if allPhrases[j + offset].translatedText]
+
+
+def logEncodingComparison(untranslatedSubs, previousContext):
+    tokens = compareEncodings(*toEncodingLines(untranslatedSubs, previousContext))
+    saving = 1 - tokens[promptLineEncoding] / max(1, tokens["json"])
+    logger.info(f"Estimated tokens of prompt lines: {', '.join(f'{name} {count}' for name, count in tokens.items())}. "
+                f"Using {promptLineEncoding}, {saving:.0%} fewer than json")
+
+
+def parseBatchResponse(body):
+    """
+    Returns the translated lines and token usage of one response from a batch output file
+    """
+    text = "".join(content.get("text", "")
+                   for item in body.get("output", []) if item.get("type") == "message"
+                   for content in item.get("content", []) if content.get("type") == "output_text")
+    encoding = promptEncodings[promptLineEncoding]
+    try:
+        translatedLines = encoding.toLines(encoding.outputModel.model_validate_json(text))
+    except ValidationError:
+        logger.warn("Batch response was not valid json")
+        translatedLines = []
+    return translatedLines, body.get("usage") or {}
 
 
 class TranslationBatchChatGPT(TranslationInterface):
-    def __init__(self):
-        self.client = OpenAI(
-            timeout=900.0
-        )
+    def __init__(self, baseUrl=None, glossary: Optional[Glossary] = None, toLang=toLang,
+                 requestLimit: Optional[asyncio.Semaphore] = None, cascadeModel=cascadeModel):
+        """
+        baseUrl overrides the OpenAI API url (as does the OPENAI_BASE_URL environment variable),
+        e.g. to point the Batch API mode at a local stand-in server.
+        glossary entries are sent with the chunks they appear in, on top of extraPrompts.
+        requestLimit is shared with other translators running at the same time, e.g. for other languages,
+        otherwise each translation gets its own limit of translationConcurrency requests.
+        cascadeModel translates every chunk first, and only the lines failing cheap checks are translated again
+        with the model given to translate
+        """
+        self.baseUrl = baseUrl
+        self.batchClient = openAIClient("batch", baseUrl, maxRetries=2)
+        self.glossary = glossary
+        self.toLang = toLang
+        self.requestLimit = requestLimit
+        self.cascadeModel = cascadeModel
+        self.escalationReasons = Counter()
+        self.cascadeLineCount = 0
+        self.cache = TranslationCache()
+        self.usage = TokenUsage()
+        # each model has its own, as a cascade's cheap model answers in different times and copes with different
+        # chunk sizes to the main model
+        self.hedgers: Dict[str, RequestHedger] = {}
+        self.chunkSizers: Dict[str, AdaptiveChunkSizer] = {}
+
+    def hedgerFor(self, model) -> RequestHedger:
+        # flex requests that are slower than usual are sent again on the default tier
+        if model not in self.hedgers:
+            self.hedgers[model] = RequestHedger(chatGPTServiceTier, hedgeLatencyPercentile)
+        return self.hedgers[model]
+
+    def chunkSizerFor(self, model) -> AdaptiveChunkSizer:
+        # translating too many subtitles at once makes chatgpt more likely to not follow instructions
+        if model not in self.chunkSizers:
+            self.chunkSizers[model] = AdaptiveChunkSizer()
+        return self.chunkSizers[model]
+
+    def firstPassModel(self, model):
+        """
+        The model every chunk is sent to first, which decides how big the chunks are
+        """
+        return self.cascadeModel if self.cascadeModel and self.cascadeModel != model else model
 
     def translate(self, phrases, extraPrompts="", model="gpt-5-nano") -> None:
-        logger.info(f"Beginning ChatGPT batch translation. Number of lines to be translated: {len(phrases)}")
+        asyncio.run(self.translateAsync(phrases, extraPrompts, model))
 
-        class SubtitleLineTranslated(BaseModel):
-            id: str
-            en: str
+    async def translateAsync(self, phrases, extraPrompts="", model="gpt-5-nano", cacheKeys: Optional[List[str]] = None) -> None:
+        """
+        cacheKeys are given when the cache has already been looked up for phrases, so it isn't looked up again
+        """
+        logger.info(f"Beginning ChatGPT batch translation into {self.toLang}. Number of lines to be translated: {len(phrases)}")
+        self.usage = TokenUsage()
+        self.escalationReasons = Counter()
+        self.cascadeLineCount = 0
 
-        class SubtitleFileTranslated(BaseModel):
-            subtitleLines: list[SubtitleLineTranslated]
+        requestLimit = self.requestLimit or asyncio.Semaphore(max(1, translationConcurrency))
+        if cacheKeys is None:
+            cacheKeys = self.lookUpCache(phrases, 0, len(phrases), extraPrompts, model)
+        chunkSizer = self.chunkSizerFor(self.firstPassModel(model))
+        nextChunkStart = 0
 
-        # translating too many subtitles at once makes chatgpt more likely to not follow instructions
-        chunkSize = 200
-        splitPhrases = deque([phrases[i:i + chunkSize] for i in range(0, len(phrases), chunkSize)])
-        previousPhrases = deque(maxlen=5)
-
-        while len(splitPhrases):
-            phraseChunk = splitPhrases.popleft()
-
-            translationPrompt = generatePrompt(extraPrompts, phraseChunk, previousPhrases)
-
-            translationStartTime = datetime.now()
-            logger.info(f"--- Beginning translation of {len(phraseChunk)} lines ---")
-            logger.debug(f"Translation prompt:\n{translationPrompt}")
-
-            response = self.client.responses.parse(
-                model=model,
-                reasoning={
-                    "effort": chatGPTReasoningEffort
-                },
-                input=[{
-                    "role": "user",
-                    "content": translationPrompt
-                }],
-                store=False,
-                service_tier=chatGPTServiceTier,
-                text_format=SubtitleFileTranslated
-            )
-            translatedLines = response.output_parsed.subtitleLines
+        # each chunk is sized when it starts, so it benefits from what the chunk sizer learnt from earlier chunks
+        if translationConcurrency <= 1:
+            # each chunk waits for the previous one, so it can use the previous chunk's translations as context
+            while nextChunkStart < len(phrases):
+                start = nextChunkStart
+                nextChunkStart = end = start + chunkSizer.chunkLength(phrases, start)
+                await self.translateChunk(phrases[start:end], cacheKeys[start:end],
+                                          phrases[max(0, start - memorySize):start], extraPrompts, model, requestLimit)
+        else:
+            # chunks are translated at the same time, so each one gets a snapshot of the lines before it as context,
+            # which are only translated if they were cached or their chunk has already finished
+            async def translateNextChunks():
+                nonlocal nextChunkStart
+                while nextChunkStart < len(phrases):
+                    start = nextChunkStart
+                    nextChunkStart = end = start + chunkSizer.chunkLength(phrases, start)
+                    await self.translateChunk(phrases[start:end], cacheKeys[start:end],
+                                              [replace(phrase) for phrase in phrases[max(0, start - memorySize):start]],
+                                              extraPrompts, model, requestLimit)
+            await asyncio.gather(*[translateNextChunks() for worker in range(translationConcurrency)])
+
+        self.cache.logStats()
+        self.usage.logStats()
+        for hedgedModel, hedger in self.hedgers.items():
+            hedger.logStats(hedgedModel)
+        self.logCascadeStats()
+        rateLimiterFor(model).logStats()
+
+    async def translateStream(self, phraseBatches: AsyncIterator[List[TranscribedPhrase]], extraPrompts="",
+                              model="gpt-5-nano") -> AsyncIterator[List[TranscribedPhrase]]:
+        """
+        Translates phrases as they arrive, starting each chunk as soon as it is full,
+        and yields the translated chunks in order. Lines that are already translated are passed through
+        """
+        logger.info("Beginning ChatGPT streaming translation")
+        self.usage = TokenUsage()
+        self.escalationReasons = Counter()
+        self.cascadeLineCount = 0
+        requestLimit = self.requestLimit or asyncio.Semaphore(max(1, translationConcurrency))
+        chunkSizer = self.chunkSizerFor(self.firstPassModel(model))
+        phrases = []
+        cacheKeys = []
+        chunkTasks = asyncio.Queue()
+
+        def startChunk(start, end, previousTask):
+            if translationConcurrency <= 1:
+                async def translateAfterPrevious():
+                    # wait for the previous chunk, so its translations can be used as context
+                    if previousTask:
+                        await previousTask
+                    await self.translateChunk(phrases[start:end], cacheKeys[start:end],
+                                              phrases[max(0, start - memorySize):start], extraPrompts, model, requestLimit)
+                task = asyncio.create_task(translateAfterPrevious())
+            else:
+                task = asyncio.create_task(self.translateChunk(
+                    phrases[start:end], cacheKeys[start:end],
+                    [replace(phrase) for phrase in phrases[max(0, start - memorySize):start]],
+                    extraPrompts, model, requestLimit))
+            chunkTasks.put_nowait((task, phrases[start:end]))
+            return task
+
+        async def receivePhrases():
+            chunkStart = 0
+            previousTask = None
+            try:
+                async for phraseBatch in phraseBatches:
+                    phrases.extend(phraseBatch)
+                    cacheKeys.extend(self.lookUpCache(phrases, len(phrases) - len(phraseBatch), len(phrases), extraPrompts, model))
+                    # start chunks once they are full, the last one might still grow
+                    while (chunkEnd := chunkStart + chunkSizer.chunkLength(phrases, chunkStart)) < len(phrases):
+                        previousTask = startChunk(chunkStart, chunkEnd, previousTask)
+                        chunkStart = chunkEnd
+                while chunkStart < len(phrases):
+                    chunkEnd = chunkStart + chunkSizer.chunkLength(phrases, chunkStart)
+                    previousTask = startChunk(chunkStart, chunkEnd, previousTask)
+                    chunkStart = chunkEnd
+            finally:
+                chunkTasks.put_nowait(None)
+
+        receiver = asyncio.create_task(receivePhrases())
+        while (chunkTask := await chunkTasks.get()) is not None:
+            task, phraseChunk = chunkTask
+            await task
+            yield phraseChunk
+        await receiver
+
+        self.cache.logStats()
+        self.usage.logStats()
+        for hedgedModel, hedger in self.hedgers.items():
+            hedger.logStats(hedgedModel)
+        self.logCascadeStats()
+        rateLimiterFor(model).logStats()
+
+    def translateFiles(self, phraseLists: List[List[TranscribedPhrase]], extraPrompts="", model="gpt-5-nano") -> None:
+        """
+        Translates the phrases of one or more files through the OpenAI Batch API, which costs less but can take up to a day.
+        Missing lines are sent again in another batch, the same as translateChunk would,
+        and anything still left after maxBatchRounds is translated with normal requests.
+        There is no cascade, every line is translated with model
+        """
+        logger.info(f"Beginning ChatGPT Batch API translation of {len(phraseLists)} file(s)")
+        if self.firstPassModel(model) != model:
+            logger.warn(f"The cascade through {self.cascadeModel} isn't applied with the Batch API, "
+                        f"every line is translated with {model}")
+        self.usage = TokenUsage()
+        self.escalationReasons = Counter()
+        self.cascadeLineCount = 0
+
+        # every chunk is translated at the same time, so each one gets a snapshot of the lines before it as context
+        chunkSizer = self.chunkSizerFor(model)
+        chunks = []
+        for phrases in phraseLists:
+            cacheKeys = self.lookUpCache(phrases, 0, len(phrases), extraPrompts, model, cascade=False)
+            start = 0
+            while start < len(phrases):
+                end = start + chunkSizer.chunkLength(phrases, start)
+                chunks.append((phrases[start:end], cacheKeys[start:end],
+                               [replace(phrase) for phrase in phrases[max(0, start - memorySize):start]]))
+                start = end
+
+        pendingRequests = [(chunk, indexes) for chunk in chunks
+                           for indexes in splitIntoRuns([i for i, phrase in enumerate(chunk[0]) if not phrase.translatedText])]
+
+        for batchRound in range(maxBatchRounds):
+            if not pendingRequests:
+                break
+
+            requestLines = []
+            memoryCounts = []
+            for n, ((phrases, cacheKeys, previousPhrases), indexes) in enumerate(pendingRequests):
+                memory = (list(previousPhrases) + phrases[:indexes[0]])[-memorySize:]
+                memoryCounts.append(len(memory))
+                requestLines.append({
+                    "custom_id": str(n),
+                    "method": "POST",
+                    "url": "/v1/responses",
+                    "body": {
+                        "model": model,
+                        "reasoning": {
+                            "effort": chatGPTReasoningEffort
+                        },
+                        "input": [{
+                            "role": "user",
+                            "content": generatePrompt(extraPrompts, [phrases[i] for i in indexes], memory,
+                                                          glossary=self.glossary, toLang=self.toLang)
+                        }],
+                        "store": False,
+                        "prompt_cache_key": promptCacheKey(extraPrompts, model, self.toLang),
+                        "text": {
+                            "format": {
+                                "type": "json_schema",
+                                "name": promptEncodings[promptLineEncoding].outputModel.__name__,
+                                "strict": True,
+                                "schema": promptEncodings[promptLineEncoding].outputSchema
+                            }
+                        }
+                    }
+                })
+
+            responses, journal = self.runBatch(requestLines)
+
+            nextRequests = []
+            for n, ((phrases, cacheKeys, previousPhrases), indexes) in enumerate(pendingRequests):
+                if str(n) not in responses:
+                    # the request itself failed rather than chatgpt getting it wrong, so send it again unchanged
+                    nextRequests.append(((phrases, cacheKeys, previousPhrases), indexes))
+                    continue
+                translatedLines, usage = parseBatchResponse(responses[str(n)])
+                self.usage.add(usage)
+                nextRequests += [((phrases, cacheKeys, previousPhrases), nextIndexes)
+                                 for nextIndexes in self.acceptTranslation(phrases, cacheKeys, indexes, memoryCounts[n],
+                                                                           translatedLines, usage.get("total_tokens", 0))]
+            journal.remove()
+            pendingRequests = nextRequests
+
+        if pendingRequests:
+            logger.info(f"Translating the remaining {len(pendingRequests)} request(s) without the Batch API")
+            remainingChunks = list({id(chunk): chunk for chunk, indexes in pendingRequests}.values())
+
+            async def translateRemaining():
+                requestLimit = self.requestLimit or asyncio.Semaphore(max(1, translationConcurrency))
+                await asyncio.gather(*[self.translateChunk(phrases, cacheKeys, previousPhrases, extraPrompts, model, requestLimit,
+                                                           cascade=False)
+                                       for phrases, cacheKeys, previousPhrases in remainingChunks])
+            asyncio.run(translateRemaining())
+
+        self.cache.logStats()
+        self.usage.logStats()
+        for hedgedModel, hedger in self.hedgers.items():
+            hedger.logStats(hedgedModel)
+        self.logCascadeStats()
+        rateLimiterFor(model).logStats()
+
+    def runBatch(self, requestLines) -> Tuple[Dict[str, dict], JobJournal]:
+        """
+        Submits a batch and waits for it to finish, returning the response body of each successful request by custom_id,
+        and the batch's journal, to be removed once the responses are stored
+        """
+        batchInput = "\n".join(json.dumps(line, ensure_ascii=False) for line in requestLines).encode("utf-8")
+        # a job restarted while its batch was running picks the batch up again, rather than paying for another one
+        journal = JobJournal(f"batch-{hashlib.sha256(batchInput).hexdigest()}")
+        submittedBatches = journal.find("batchSubmitted")
+        if submittedBatches:
+            batch = self.batchClient.batches.retrieve(submittedBatches[-1]["batchId"])
+            logger.info(f"Resuming batch {batch.id} of {len(requestLines)} request(s), submitted before the job was interrupted")
+        else:
+            inputFile = self.batchClient.files.create(file=("translations.jsonl", batchInput), purpose="batch")
+            batch = self.batchClient.batches.create(input_file_id=inputFile.id, endpoint="/v1/responses", completion_window="24h")
+            journal.append("batchSubmitted", batchId=batch.id)
+            logger.info(f"Submitted batch {batch.id} of {len(requestLines)} request(s)")
+
+        while batch.status not in ("completed", "failed", "expired", "cancelled"):
+            time.sleep(batchPollSeconds)
+            batch = self.batchClient.batches.retrieve(batch.id)
+            if batch.request_counts:
+                logger.info(f"Batch {batch.id} is {batch.status}, "
+                            f"{batch.request_counts.completed}/{batch.request_counts.total} request(s) done")
+        if batch.status != "completed":
+            # expired batches still return the requests that did finish
+            logger.error(f"Batch {batch.id} {batch.status}")
+
+        responses = {}
+        if batch.output_file_id:
+            for line in self.batchClient.files.content(batch.output_file_id).text.splitlines():
+                if not line.strip():
+                    continue
+                result = json.loads(line)
+                response = result.get("response") or {}
+                if response.get("status_code") == 200:
+                    responses[result["custom_id"]] = response["body"]
+
+        failedCount = len(requestLines) - len(responses)
+        if failedCount:
+            logger.warn(f"{failedCount} batch request(s) failed, they will be retried")
+        return responses, journal
+
+    def lookUpCache(self, phrases, start, end, extraPrompts, model, cascade=True) -> List[str]:
+        """
+        Fills in cached translations for phrases[start:end], returning the cache key of each phrase.
+        cascade False looks up model's own translations, for lines that won't go through the cascade
+        """
+        # lines are cached along with the source lines before them, as those change how the line is translated
+        texts = [phrase.text for phrase in phrases[max(0, start - memorySize):end]]
+        offset = min(start, memorySize)
+        if self.glossary is not None:
+            extraPrompts += "\n" + self.glossary.fullPrompt()
+        if cascade and self.firstPassModel(model) != model:
+            # most lines of a cascade are the cheap model's translations, so they aren't mixed up with model's own
+            model = f"{self.cascadeModel}>{model}"
+        cacheKeys = [TranslationCache.key(texts[i], texts[max(0, i - memorySize):i], extraPrompts, model, chatGPTReasoningEffort,
+                                          self.toLang)
+                     for i in range(offset, len(texts))]
+
+        untranslated = [(phrase, cacheKey) for phrase, cacheKey in zip(phrases[start:end], cacheKeys)
+                        if not phrase.translatedText]
+        cachedTranslations = self.cache.get([cacheKey for phrase, cacheKey in untranslated])
+        for phrase, cacheKey in untranslated:
+            if cacheKey in cachedTranslations:
+                phrase.translatedText = cachedTranslations[cacheKey]
+        return cacheKeys
+
+    async def translateChunk(self, phrases, cacheKeys, previousPhrases, extraPrompts, model, requestLimit, cascade=True):
+        """
+        Translates phrases in place. previousPhrases are the lines before them, used as MEMORY context.
+        cascade False translates with model alone, matching cache keys looked up with cascade False
+        """
+        if not cascade or self.firstPassModel(model) == model:
+            await self.translateRequests(phrases, cacheKeys, previousPhrases, extraPrompts, model, requestLimit)
+            return
+
+        # the cheap model translates everything, then the lines it got wrong or probably got wrong are cleared
+        # and translated again with model, with the cheap translations of the lines around them as context
+        untranslatedIndexes = [i for i, phrase in enumerate(phrases) if not phrase.translatedText]
+        # the cheap translations are only cached once they have passed the checks, so a job interrupted before
+        # the suspect lines are escalated doesn't find them in the cache when it is restarted
+        uncheckedEntries = {}
+        missingIndexes = await self.translateRequests(phrases, cacheKeys, previousPhrases, extraPrompts, self.cascadeModel,
+                                                      requestLimit, retryMissing=False, uncheckedEntries=uncheckedEntries)
+        suspects = {i: reason for i, reason in findSuspectLines(phrases, fromLang, self.toLang, self.glossary).items()
+                    if i in untranslatedIndexes}
+        suspects.update({i: "failed id validation" for i in missingIndexes})
+        self.cache.put([entry for i, entry in uncheckedEntries.items() if i not in suspects])
+
+        self.cascadeLineCount += len(untranslatedIndexes)
+        for i, reason in sorted(suspects.items()):
+            logger.debug(f"Escalating line {phrases[i].text!r} (translated as {phrases[i].translatedText!r}): {reason}")
+            self.escalationReasons[reason.split(" (")[0]] += 1
+            phrases[i].translatedText = ""
+        if suspects:
+            logger.info(f"Escalating {len(suspects)} of {len(untranslatedIndexes)} line(s) to {model}")
+            # suspect lines are usually scattered through the chunk, so they are sent together rather than a request each
+            await self.translateRequests(phrases, cacheKeys, previousPhrases, extraPrompts, model, requestLimit,
+                                         scattered=True)
+
+    async def translateRequests(self, phrases, cacheKeys, previousPhrases, extraPrompts, model, requestLimit,
+                                retryMissing=True, uncheckedEntries: Optional[Dict[int, tuple]] = None,
+                                scattered=False) -> List[int]:
+        """
+        Translates the untranslated phrases in place with model. With retryMissing False, lines missing from a
+        response aren't requested again but left untranslated, and their indexes returned.
+        With uncheckedEntries, translations are collected there by index instead of being cached.
+        scattered sends lines that aren't next to each other in the same request, with the lines around them as MEMORY,
+        rather than a request per run of consecutive lines
+        """
+        missingIndexes = []
+        chunkSizer = self.chunkSizerFor(model)
+        # lists of indexes into phrases, each sent as one request. Cached lines don't need sending
+        untranslatedIndexes = [i for i, phrase in enumerate(phrases) if not phrase.translatedText]
+        pendingRequests = deque(groupIndexes(phrases, untranslatedIndexes, chunkSizer) if scattered
+                                else splitIntoRuns(untranslatedIndexes))
+
+        while len(pendingRequests):
+            indexes = pendingRequests.popleft()
+            phraseChunk = [phrases[i] for i in indexes]
+            if scattered:
+                memory = neighbourLines(phrases, previousPhrases, indexes)
+            else:
+                memory = (list(previousPhrases) + phrases[:indexes[0]])[-memorySize:]
+
+            translationPrompt = generatePrompt(extraPrompts, phraseChunk, memory, glossary=self.glossary, toLang=self.toLang)
+            logEncodingComparison(phraseChunk, memory)
+
+            async with requestLimit:
+                translationStartTime = datetime.now()
+                logger.info(f"--- Beginning translation of {len(phraseChunk)} lines ---")
+                logger.debug(f"Translation prompt:\n{translationPrompt}")
+
+                response = await self.parseResponse(
+                    estimateTokens(translationPrompt) + chunkSizer.chunkTokens(phraseChunk),
+                    model=model,
+                    reasoning={
+                        "effort": chatGPTReasoningEffort
+                    },
+                    input=[{
+                        "role": "user",
+                        "content": translationPrompt
+                    }],
+                    store=False,
+                    prompt_cache_key=promptCacheKey(extraPrompts, model, self.toLang),
+                    text_format=promptEncodings[promptLineEncoding].outputModel
+                )
+            translatedLines = promptEncodings[promptLineEncoding].toLines(response.output_parsed)
 
             translationTime = datetime.now() - translationStartTime
             subs = "\n".join([f"[{line.id}] {line.en}" for line in translatedLines])
@@ -188,27 +615,87 @@ class TranslationBatchChatGPT(TranslationInterface):
             logger.debug(f"Translation contents:\n{subs}")
             logger.info(f"Time taken: {translationTime}")
             logger.debug(f"Token usage:\n{response.usage.model_dump_json(indent=2)}")
+            self.usage.add(response.usage.model_dump())
 
-            # chatgpt doesn't always follow the prompt, so we must do error checking
-            # if errors are detected, we keep halving the number of subtitle lines
-            # until we reach the base case of one line, which is virtually guaranteed to translate successfully
-            actualUuidList = [line.id for line in translatedLines]
-            if not checkValidTranslation([str(n) for n in range(len(previousPhrases) + 1, len(previousPhrases) + len(phraseChunk) + 1)], actualUuidList):
-                if len(phraseChunk) <= 1:
-                    logger.error(f"Could not translate {phraseChunk}")
-                    for phrase in phraseChunk:
-                        phrase.translatedText = "[translation error]"
-                    continue
+            nextRequests = self.acceptTranslation(phrases, cacheKeys, indexes, len(memory), translatedLines,
+                                                  response.usage.total_tokens, retryMissing, uncheckedEntries, scattered)
+            chunkSizer.onResponse(chunkSizer.chunkTokens(phraseChunk), not nextRequests, translationTime.total_seconds())
+            if retryMissing:
+                pendingRequests.extendleft(reversed(nextRequests))
+            else:
+                missingIndexes.extend(i for request in nextRequests for i in request)
+        return missingIndexes
+
+    def logCascadeStats(self):
+        if not self.cascadeLineCount:
+            return
+        escalatedCount = sum(self.escalationReasons.values())
+        reasons = ", ".join(f"{count} {reason}" for reason, count in self.escalationReasons.most_common())
+        logger.info(f"Cascade: {escalatedCount} of {self.cascadeLineCount} line(s) translated by {self.cascadeModel} "
+                    f"were escalated ({escalatedCount / self.cascadeLineCount:.0%})" + (f": {reasons}" if reasons else ""))
+
+    @property
+    def client(self) -> AsyncOpenAI:
+        # looked up on each use, as each event loop has its own connection pool
+        return asyncOpenAIClient("translation", self.baseUrl)
+
+    async def parseResponse(self, estimatedTokens, **request):
+        """
+        Sends a structured output request through the model's shared rate limiter, hedging slow flex requests
+        """
+        rateLimiter = rateLimiterFor(request["model"])
+        return await self.hedgerFor(request["model"]).run(
+            lambda serviceTier, onSent: rateLimiter.call(
+                lambda: self.client.responses.with_raw_response.parse(service_tier=serviceTier, **request),
+                estimatedTokens, lambda response: response.usage.total_tokens, onSent=onSent),
+            isValid=lambda response: response.output_parsed is not None)
+
+    def acceptTranslation(self, phrases, cacheKeys, indexes, memoryCount, translatedLines, totalTokens,
+                          retryMissing=True, uncheckedEntries: Optional[Dict[int, tuple]] = None,
+                          scattered=False) -> List[List[int]]:
+        """
+        Stores the valid lines of a response for phrases[indexes], and returns the indexes to request next,
+        or with retryMissing False, the indexes that are missing.
+        With uncheckedEntries, the cache entries of the valid lines are added to it by index rather than cached.
+        scattered retries the missing lines together, as the lines weren't requested in consecutive runs
+        """
+        # chatgpt doesn't always follow the prompt, so we must do error checking
+        # every line with a valid id is kept, and only the missing lines are requested again
+        expectedIdList = [str(n) for n in range(memoryCount + 1, memoryCount + len(indexes) + 1)]
+        validLines = findValidLines(expectedIdList, translatedLines)
+        missingIndexes = []
+        newCacheEntries = {}
+        tokensPerLine = totalTokens / len(indexes)
+        for i, expectedId in zip(indexes, expectedIdList):
+            if expectedId in validLines:
+                phrases[i].translatedText = validLines[expectedId]
+                newCacheEntries[i] = (cacheKeys[i], validLines[expectedId], tokensPerLine)
+            else:
+                missingIndexes.append(i)
+        if uncheckedEntries is not None:
+            uncheckedEntries.update(newCacheEntries)
+        else:
+            self.cache.put(list(newCacheEntries.values()))
+
+        if not missingIndexes:
+            return []
+
+        if not retryMissing:
+            return [missingIndexes]
 
-                pivot = len(phraseChunk) // 2
-                phraseHalf1 = phraseChunk[:pivot]
-                phraseHalf2 = phraseChunk[pivot:]
-                splitPhrases.appendleft(phraseHalf2)
-                splitPhrases.appendleft(phraseHalf1)
+        if validLines:
+            # request each run of consecutive missing lines separately, so the lines before it are the context
+            logger.warn(f"Retrying translation of {len(missingIndexes)} missing line(s)")
+            return [missingIndexes] if scattered else splitIntoRuns(missingIndexes)
 
-                logger.warn(f"Retrying translation with {pivot} lines")
-                continue
+        # nothing usable came back, so keep halving the number of subtitle lines
+        # until we reach the base case of one line, which is virtually guaranteed to translate successfully
+        if len(indexes) <= 1:
+            logger.error(f"Could not translate {[phrases[i] for i in indexes]}")
+            for i in indexes:
+                phrases[i].translatedText = "[translation error]"
+            return []
 
-            for i, (phrase, subtitleLine) in enumerate(zip(phraseChunk, translatedLines), 1):
-                phrase.translatedText = subtitleLine.en
-                previousPhrases.append(phrase)
+        pivot = len(indexes) // 2
+        logger.warn(f"Retrying translation with {pivot} lines")
+        return [indexes[:pivot], indexes[pivot:]]
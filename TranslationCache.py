@@ -0,0 +1,71 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from typing import Dict, List, Tuple
+
+from Logger import logger
+
+
+cachePath = os.path.join(os.path.expanduser("~"), ".nihongowakarimasen", "translations.sqlite3")
+maxCacheEntries = 500000 # least recently used translations are evicted past this
+
+
+class TranslationCache:
+    """
+    On-disk cache of translated lines, keyed by the line, the lines before it, the extra prompt, the model settings
+    and the target language, so re-running a file only pays for lines that actually changed
+    """
+    def __init__(self, path=cachePath, maxEntries=maxCacheEntries):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS translations "
+                                "(key TEXT PRIMARY KEY, translation TEXT, tokens REAL, lastUsed REAL)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS translationsLastUsed ON translations (lastUsed)")
+        self.maxEntries = maxEntries
+
+        self.hits = 0
+        self.misses = 0
+        self.tokensSaved = 0
+
+    @staticmethod
+    def key(text, contextTexts, extraPrompts, model, reasoningEffort, toLang) -> str:
+        return hashlib.sha256(json.dumps([text, list(contextTexts), extraPrompts, model, reasoningEffort, toLang],
+                                         ensure_ascii=False).encode("utf-8")).hexdigest()
+
+    def get(self, keys: List[str]) -> Dict[str, str]:
+        """
+        Returns {key: translation} for the keys that are cached
+        """
+        found = {}
+        # sqlite limits the number of parameters in one query
+        for i in range(0, len(keys), 500):
+            batch = keys[i:i + 500]
+            rows = self.connection.execute(f"SELECT key, translation, tokens FROM translations "
+                                           f"WHERE key IN ({','.join('?' * len(batch))})", batch).fetchall()
+            for key, translation, tokens in rows:
+                found[key] = translation
+                self.tokensSaved += tokens
+
+        with self.connection:
+            self.connection.executemany("UPDATE translations SET lastUsed = ? WHERE key = ?",
+                                        [(time.time(), key) for key in found])
+        self.hits += len(found)
+        self.misses += len(set(keys) - set(found))
+        return found
+
+    def put(self, entries: List[Tuple[str, str, float]]):
+        """
+        Stores (key, translation, tokens) entries, where tokens is this line's share of the request that translated it
+        """
+        with self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO translations VALUES (?, ?, ?, ?)",
+                                        [(key, translation, tokens, time.time()) for key, translation, tokens in entries])
+            self.connection.execute("DELETE FROM translations WHERE key IN "
+                                    "(SELECT key FROM translations ORDER BY lastUsed DESC LIMIT -1 OFFSET ?)",
+                                    (self.maxEntries,))
+
+    def logStats(self):
+        logger.info(f"Translation cache: {self.hits} hit(s), {self.misses} miss(es), "
+                    f"about {self.tokensSaved:.0f} tokens saved")
@@ -1,13 +1,16 @@
 from collections import deque
 
-from openai import OpenAI
+from OpenAIClients import openAIClient
+from RateLimiter import rateLimiterFor
+from TokenCounter import estimateTokens
 
 from TranslationInterface import TranslationInterface
 
 
 class TranslationChatGPT(TranslationInterface):
     def __init__(self):
-        self.client = OpenAI()
+        # retries are left to the model's shared rate limiter, which backs off on rate limits
+        self.client = openAIClient("translation")
 
     def translate(self, phrases, extraPrompts="", model="gpt-4.1"):
         instructions = (
@@ -23,11 +26,14 @@ class TranslationChatGPT(TranslationInterface):
             "role": "developer",
             "content": f"{instructions}",
         }
-        initialResponse = self.client.responses.create(
-            model=model,
-            input=[initialPrompt],
-            store=False
-        )
+        rateLimiter = rateLimiterFor(model)
+        initialResponse = rateLimiter.callSync(
+            lambda: self.client.responses.with_raw_response.create(
+                model=model,
+                input=[initialPrompt],
+                store=False
+            ),
+            estimateTokens(instructions), lambda response: response.usage.total_tokens)
 
         def getOutput(response):
             return [{"role": el.role, "content": el.content} for el in response.output if el.type == "message"]
@@ -46,12 +52,16 @@ class TranslationChatGPT(TranslationInterface):
                 "role": "user",
                 "content": f"{content}"
             })
-            response = self.client.responses.create(
-                model=model,
-                # previous_response_id=prevResponse.id,
-                input=historyPrefix + list(translationHistory),
-                store=False
-            )
+            messages = historyPrefix + list(translationHistory)
+            response = rateLimiter.callSync(
+                lambda: self.client.responses.with_raw_response.create(
+                    model=model,
+                    # previous_response_id=prevResponse.id,
+                    input=messages,
+                    store=False
+                ),
+                estimateTokens("".join(message["content"] for message in messages if isinstance(message["content"], str))),
+                lambda response: response.usage.total_tokens)
             translationHistory += getOutput(response)
 
             phrase.translatedText = response.output_text
@@ -0,0 +1,67 @@
+import re
+import statistics
+from typing import Dict, List, Optional
+
+from Glossary import Glossary, normalise
+from TranscribedPhrase import TranscribedPhrase
+
+
+'''
+Cheap checks for translations that are likely wrong, so only those lines need translating again with a stronger model
+- Untranslated text: characters of the source language's script left in the translation
+- Length outliers: translations much longer or shorter than the other lines of the chunk, relative to their source lines,
+  which is usually a line merged with its neighbours, cut short or made up
+- Glossary misses: a name or term from the glossary appears in the source line but its translation doesn't.
+  Only checked when translating into the glossary's language, as the translations are in that language
+Lines that fail id validation are found while parsing the response, see TranslationBatchChatGPT
+'''
+
+sourceScripts = { # characters that shouldn't be left in a translation out of each language
+    "Japanese": re.compile(r"[\u3040-\u30ff]"), # hiragana and katakana, kanji are shared with chinese
+    "Korean": re.compile(r"[\u1100-\u11ff\u3130-\u318f\uac00-\ud7af]"),
+}
+lengthRatioLimit = 4.0 # how many times longer or shorter than the chunk's median length ratio a line can be
+minLengthCheckCharacters = 4 # shorter source lines vary too much in length to be checked, e.g. はい to "Yes"
+minLengthCheckLines = 3 # fewer checked lines than this don't give a meaningful median
+
+
+def untranslatedText(phrase: TranscribedPhrase, fromLang, toLang) -> bool:
+    script = sourceScripts.get(fromLang)
+    return script is not None and toLang != fromLang and script.search(phrase.translatedText) is not None
+
+
+def lengthOutliers(phrases: List[TranscribedPhrase]) -> List[int]:
+    """
+    Returns the index of every phrase whose translation length is an outlier compared to the rest of phrases
+    """
+    ratios = {i: len(phrase.translatedText) / len(phrase.text) for i, phrase in enumerate(phrases)
+              if len(phrase.text) >= minLengthCheckCharacters}
+    if len(ratios) < minLengthCheckLines:
+        return []
+    medianRatio = statistics.median(ratios.values())
+    return [i for i, ratio in ratios.items()
+            if ratio > medianRatio * lengthRatioLimit or ratio < medianRatio / lengthRatioLimit]
+
+
+def glossaryMisses(phrase: TranscribedPhrase, glossary: Glossary) -> List[str]:
+    """
+    Returns the glossary terms in the source line whose translation isn't in the translated line
+    """
+    translatedText = normalise(phrase.translatedText)
+    return [entry.term for entry in glossary.find([phrase.text]) if normalise(entry.translation) not in translatedText]
+
+
+def findSuspectLines(phrases: List[TranscribedPhrase], fromLang, toLang,
+                     glossary: Optional[Glossary] = None) -> Dict[int, str]:
+    """
+    Returns {index: reason} for every translated phrase that fails a check
+    """
+    suspects = {}
+    for i in lengthOutliers(phrases):
+        suspects[i] = "length outlier"
+    for i, phrase in enumerate(phrases):
+        if untranslatedText(phrase, fromLang, toLang):
+            suspects[i] = "untranslated text"
+        elif glossary is not None and glossary.language == toLang and (missedTerms := glossaryMisses(phrase, glossary)):
+            suspects[i] = f"glossary miss ({', '.join(missedTerms)})"
+    return suspects
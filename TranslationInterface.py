@@ -1,10 +1,11 @@
-from typing import List, Optional
-
-from openai.types import ResponsesModel
+from typing import List, Optional, TYPE_CHECKING
 
 from TranscribedPhrase import TranscribedPhrase
 
+if TYPE_CHECKING:
+    from openai.types import ResponsesModel
+
 
 class TranslationInterface:
-    def translate(self, phrases: List[TranscribedPhrase], extraPrompts, model: ResponsesModel) -> None:
+    def translate(self, phrases: List[TranscribedPhrase], extraPrompts, model: "ResponsesModel") -> None:
         pass
\ No newline at end of file
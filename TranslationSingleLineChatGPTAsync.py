@@ -1,20 +1,20 @@
 from collections import deque
 
-from openai import AsyncOpenAI
 from openai.types.responses import ResponseCompletedEvent, ResponseTextDeltaEvent, ResponseOutputMessage
 
 from AsyncUtils import serialSubscriber
+from Config import configGlossary, configTranslationContext
 from MessageBus import MessageType
-from Prompts import translationContextClarisSeason3
+from OpenAIClients import asyncOpenAIClient
+from RateLimiter import rateLimiterFor
+from TokenCounter import estimateTokens
 from TranscribedPhrase import TranslatedPhrase
 
 
 class TranslationSingleLineChatGPT:
     def __init__(self, messageBus):
         self.bus = messageBus
-        self.client = AsyncOpenAI(
-            timeout=8 # TODO: maybe tune this
-        )
+        self.client = asyncOpenAIClient("live")
         self.previousContext = deque(maxlen=5)
         serialSubscriber(self.bus, MessageType.SUBTITLE_CHUNK)(self.translate)
         # self.bus.subscribe(MessageType.SUBTITLE_CHUNK)(self.translate)
@@ -26,12 +26,19 @@ class TranslationSingleLineChatGPT:
                                        f"{"\n".join([f"{jpText}" for jpText, enText in self.previousContext])}\n\n"
                                        f"{"\n".join([f"{enText}" for jpText, enText in self.previousContext])}\n\n")
 
+        glossaryPrompt = ""
+        if configGlossary is not None:
+            foundEntries = configGlossary.toPrompt([jpText for jpText, enText in self.previousContext] + [data.text])
+            if foundEntries:
+                glossaryPrompt = f"Names and terms in this subtitle line and the preceding ones:\n{foundEntries}\n\n"
+
         prompt = ("You are an expert translator specializing in Japanese to English subtitle translation.\n"
                   "The subtitles provided are **machine-transcribed**, so they may contain minor errors, typos, or inaccuracies.\n"
                   "Each subtitle line may be a **whole or partial sentence**, depending on how the subtitles were split. Translate each line faithfully while making it understandable in English.\n"
                   "Please correct these errors in your translation to produce fluent, natural English subtitles.\n\n"
                   "Use the following additional translation context for the script to inform translation decisions:\n"
-                  f"- {translationContextClarisSeason3}\n\n"
+                  f"- {configTranslationContext}\n\n"
+                  f"{glossaryPrompt}"
                   f"{precedingSubtitlePrompt}"
                   "You must not output any text other than the English translation. "
                   "Now, translate the following subtitle line:\n"
@@ -48,14 +55,15 @@ class TranslationSingleLineChatGPT:
         def cleanText(s):
             return s.strip('\n\r').replace('\n', ' ').replace('\r', ' ')
 
-        clientOutput = await self.client.responses.create(
+        # few retries, a late line is no use live
+        clientOutput = await rateLimiterFor(model).call(lambda: self.client.responses.with_raw_response.create(
             model=model,
             input=prompt,
             stream=shouldStream,
             reasoning={
                 "effort": "minimal"
             },
-        )
+        ), estimateTokens(prompt) * 2, retries=2)
 
         if model == "gpt-5-nano":
             async for event in clientOutput:
@@ -0,0 +1,224 @@
+from typing import List, Tuple
+
+import numpy as np
+
+from AudioSegmentPlanner import frameSeconds as energyFrameSeconds
+from AudioSource import AudioSource
+from Logger import logger
+
+
+frameSeconds = 0.03
+blockSeconds = 60 # how much audio to hold in memory at once while classifying frames
+speechBandHz = (80, 4000) # voice fundamentals and formants
+energyMarginDb = 10 # frames must be this much louder than the noise floor
+minSpeechBandRatio = 0.6 # fraction of a frame's energy that must be in the speech band
+maxSpectralFlatness = 0.4 # noise and hiss have a flat spectrum, voices don't
+minModulationDb = 4 # speech rises and falls with each syllable, sustained music and tones don't
+modulationWindowSeconds = 1.0
+smoothingSeconds = 0.3
+paddingSeconds = 0.3 # keep this much audio either side of each speech span
+minGapSeconds = 1.0 # merge speech spans closer together than this
+minSpanSeconds = 0.3 # drop speech spans shorter than this
+spanGapSeconds = 0.5 # silence inserted between speech spans, so whisper doesn't join words across them
+
+
+def frameFeatures(samples, sampleRate):
+    """
+    Returns the energy (dB), speech band energy ratio and spectral flatness of each frame of a mono sample array
+    """
+    frameLength = int(sampleRate * frameSeconds)
+    frameCount = len(samples) // frameLength
+    frames = samples[:frameCount * frameLength].astype(np.float32).reshape(frameCount, frameLength)
+
+    spectrum = np.square(np.abs(np.fft.rfft(frames * np.hanning(frameLength), axis=1))) + 1e-10
+    frequencies = np.fft.rfftfreq(frameLength, 1 / sampleRate)
+    isSpeechBand = (frequencies >= speechBandHz[0]) & (frequencies <= speechBandHz[1])
+
+    totalEnergy = spectrum.sum(axis=1)
+    speechBandSpectrum = spectrum[:, isSpeechBand]
+    energyDb = 10 * np.log10(totalEnergy)
+    bandRatio = speechBandSpectrum.sum(axis=1) / totalEnergy
+    flatness = np.exp(np.mean(np.log(speechBandSpectrum), axis=1)) / np.mean(speechBandSpectrum, axis=1)
+    return energyDb, bandRatio, flatness
+
+
+def detectSpeechInSamples(samples, sampleRate) -> List[Tuple[float, float]]:
+    features = [frameFeatures(samples[i:i + blockSeconds * sampleRate], sampleRate)
+                for i in range(0, len(samples), blockSeconds * sampleRate)]
+    return classifyFrames(*[np.concatenate(feature) for feature in zip(*features)])
+
+
+def detectSpeech(audioSource) -> List[Tuple[float, float]]:
+    """
+    Returns the (start, end) of each span of speech in the audio source, in seconds
+    """
+    logger.info("Detecting speech")
+    features = []
+    for start in np.arange(0, audioSource.durationSeconds, blockSeconds):
+        samples = audioSource.samples(start, start + blockSeconds).mean(axis=1)
+        features.append(frameFeatures(samples, audioSource.sampleRate))
+    spans = classifyFrames(*[np.concatenate(feature) for feature in zip(*features)])
+
+    speechSeconds = sum(end - start for start, end in spans)
+    logger.info(f"Voice activity detection dropped {audioSource.durationSeconds - speechSeconds:.0f}s of "
+                f"{audioSource.durationSeconds:.0f}s of audio")
+    return spans
+
+
+def classifyFrames(energyDb, bandRatio, flatness) -> List[Tuple[float, float]]:
+    if not len(energyDb):
+        return []
+
+    noiseFloor = np.percentile(energyDb, 10)
+    isSpeech = (energyDb > noiseFloor + energyMarginDb) & (bandRatio > minSpeechBandRatio) & (flatness < maxSpectralFlatness)
+
+    # standard deviation of the energy over a sliding window
+    window = np.ones(max(1, int(modulationWindowSeconds / frameSeconds)))
+    window /= len(window)
+    mean = np.convolve(energyDb, window, mode="same")
+    meanSquare = np.convolve(np.square(energyDb), window, mode="same")
+    modulation = np.sqrt(np.maximum(meanSquare - np.square(mean), 0))
+    isSpeech &= modulation > minModulationDb
+
+    # majority vote over a short window to remove flickering
+    window = np.ones(max(1, int(smoothingSeconds / frameSeconds)))
+    isSpeech = np.convolve(isSpeech.astype(np.float32), window / len(window), mode="same") > 0.5
+
+    edges = np.diff(np.concatenate(([0], isSpeech.astype(np.int8), [0])))
+    starts = np.flatnonzero(edges == 1) * frameSeconds
+    ends = np.flatnonzero(edges == -1) * frameSeconds
+    durationSeconds = len(energyDb) * frameSeconds
+
+    spans = []
+    for start, end in zip(starts, ends):
+        start = max(0.0, start - paddingSeconds)
+        end = min(durationSeconds, end + paddingSeconds)
+        if spans and start - spans[-1][1] < minGapSeconds:
+            spans[-1] = (spans[-1][0], end)
+        else:
+            spans.append((start, end))
+
+    return [(float(start), float(end)) for start, end in spans if end - start >= minSpanSeconds]
+
+
+class SpeechTimeline:
+    """
+    Maps between the original timeline and a compacted timeline made of only the speech spans,
+    with spanGapSeconds of silence between each span
+    """
+    def __init__(self, spans, durationSeconds):
+        self.originalStarts = np.array([start for start, end in spans], dtype=np.float64)
+        self.lengths = np.array([end - start for start, end in spans], dtype=np.float64)
+        self.compactStarts = np.concatenate(([0.0], np.cumsum(self.lengths + spanGapSeconds)[:-1])) if spans else np.zeros(0)
+        self.compactDurationSeconds = float(self.lengths.sum() + spanGapSeconds * max(0, len(spans) - 1))
+        self.droppedSeconds = durationSeconds - float(self.lengths.sum())
+
+    def toOriginal(self, seconds):
+        if not len(self.compactStarts):
+            return seconds
+        i = max(0, np.searchsorted(self.compactStarts, seconds, side="right") - 1)
+        # times inside the gap after a span map to the end of that span
+        return float(self.originalStarts[i] + min(max(0.0, seconds - self.compactStarts[i]), self.lengths[i]))
+
+    def toCompact(self, seconds):
+        if not len(self.originalStarts):
+            return seconds
+        i = max(0, np.searchsorted(self.originalStarts, seconds, side="right") - 1)
+        return float(self.compactStarts[i] + min(max(0.0, seconds - self.originalStarts[i]), self.lengths[i]))
+
+    def pieces(self, startSeconds, endSeconds):
+        """
+        Yields (compactStart, compactEnd, originalStart) for each part of the compacted range.
+        originalStart is None for the silent gaps between spans
+        """
+        for compactStart, originalStart, length in zip(self.compactStarts, self.originalStarts, self.lengths):
+            for pieceStart, pieceEnd, pieceOriginal in ((compactStart, compactStart + length, originalStart),
+                                                        (compactStart + length, compactStart + length + spanGapSeconds, None)):
+                overlapStart = max(startSeconds, pieceStart)
+                overlapEnd = min(endSeconds, pieceEnd)
+                if overlapEnd <= overlapStart:
+                    continue
+                if pieceOriginal is not None:
+                    pieceOriginal += overlapStart - pieceStart
+                yield float(overlapStart), float(overlapEnd), pieceOriginal
+
+
+def keepSpeechOnly(samples, sampleRate):
+    """
+    Returns the speech in a mono sample array joined together, and the timeline to map timestamps back with
+    """
+    spans = detectSpeechInSamples(samples, sampleRate)
+    timeline = SpeechTimeline(spans, len(samples) / sampleRate)
+    logger.info(f"Voice activity detection dropped {timeline.droppedSeconds:.0f}s of {len(samples) / sampleRate:.0f}s of audio")
+
+    parts = []
+    for compactStart, compactEnd, originalStart in timeline.pieces(0, timeline.compactDurationSeconds):
+        frameCount = int((compactEnd - compactStart) * sampleRate)
+        if originalStart is None:
+            parts.append(np.zeros(frameCount, dtype=samples.dtype))
+        else:
+            firstFrame = int(originalStart * sampleRate)
+            parts.append(samples[firstFrame:firstFrame + frameCount])
+    return (np.concatenate(parts) if parts else samples[:0]), timeline
+
+
+def subtractSpans(spans, skipSpans) -> List[Tuple[float, float]]:
+    """
+    Removes the parts of each (start, end) span that overlap any of the skipSpans
+    """
+    for skipStart, skipEnd in skipSpans:
+        remaining = []
+        for start, end in spans:
+            if start < skipStart:
+                remaining.append((start, min(end, skipStart)))
+            if end > skipEnd:
+                remaining.append((max(start, skipEnd), end))
+        spans = remaining
+    return [(start, end) for start, end in spans if end - start >= minSpanSeconds]
+
+
+class SpanAudioSource(AudioSource):
+    """
+    Presents only the given (start, end) spans of another AudioSource, joined on a compacted timeline.
+    Use toOriginal() to map timestamps back before they are used
+    """
+    def __init__(self, audioSource, spans):
+        self.audioSource = audioSource
+        self.sampleRate = audioSource.sampleRate
+        self.channels = audioSource.channels
+
+        self.timeline = SpeechTimeline(spans, audioSource.durationSeconds)
+        self.durationSeconds = self.timeline.compactDurationSeconds
+        logger.info(f"Skipping {self.timeline.droppedSeconds:.0f}s of {audioSource.durationSeconds:.0f}s of audio")
+
+    def samples(self, startSeconds, endSeconds) -> np.ndarray:
+        parts = []
+        for compactStart, compactEnd, originalStart in self.timeline.pieces(startSeconds, endSeconds):
+            if originalStart is None:
+                parts.append(np.zeros((int((compactEnd - compactStart) * self.sampleRate), self.channels), dtype=np.int16))
+            else:
+                parts.append(self.audioSource.samples(originalStart, originalStart + compactEnd - compactStart))
+
+        if len(parts) == 1:
+            return parts[0]
+        if not parts:
+            return np.zeros((0, self.channels), dtype=np.int16)
+        return np.concatenate(parts)
+
+    def energyDb(self) -> np.ndarray:
+        energyDb = self.audioSource.energyDb()
+        parts = []
+        for compactStart, compactEnd, originalStart in self.timeline.pieces(0, self.durationSeconds):
+            frameCount = int(round((compactEnd - compactStart) / energyFrameSeconds))
+            if originalStart is None:
+                parts.append(np.full(frameCount, -120.0))
+            else:
+                firstFrame = int(originalStart / energyFrameSeconds)
+                parts.append(energyDb[firstFrame:firstFrame + frameCount])
+        return np.concatenate(parts) if parts else np.full(1, -120.0)
+
+    def toOriginal(self, seconds):
+        return self.timeline.toOriginal(seconds)
+
+    def toCompact(self, seconds):
+        return self.timeline.toCompact(seconds)
@@ -1,30 +1,206 @@
-import pickle
-
-from Config import fromLangCode, inputFile, outputFile, configWhisperPrompt, configTranslationContext, chatGPTModel
-from TranslationBatchChatGPT import TranslationBatchChatGPT
-from ASRFromSrtFile import ASRFromSrtFile
-from ASROpenAIWhisper import ASROpenAIWhisper
-from SubtitleWriter import writeSubtitles
-from TranslationPassthrough import TranslationPassthrough
+import time
+startTime = time.perf_counter()
+
+import argparse
+import asyncio
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import replace
+from typing import get_args
+
+import Config
+from Backends import asrBackends, translationBackends, loadBackend, importTimer
 from Logger import logger
+from Types import ServiceTier
 
-if __name__ == '__main__':
-    ### speech to text
-    # save transcript to file so we don't have to waste credits re-transcribing it in the future
-    phrases = ASROpenAIWhisper().speechToText(inputFile, configWhisperPrompt, fromLangCode)
-    with open(f"{outputFile}.pkl", "wb") as f:
-        pickle.dump(phrases, f)
-        f.close()
 
-    # with open(f"{outputFile}.pkl", "rb") as f:
-    #     phrases = pickle.load(f)
+'''
+Backends and pipeline stages are imported once the command line has been read, rather than up front,
+so each run only loads what it uses, and the modules read Config after the arguments have been applied to it.
+Config values are read from the module at call time for the same reason
+'''
+
+
+def parseArguments():
+    parser = argparse.ArgumentParser(description="Generates translated subtitles for a video or audio file. "
+                                                 "Anything not given is taken from Config.py")
+    parser.add_argument("input", nargs="?", help="video or audio file, or an srt file with --asr srt")
+    parser.add_argument("-o", "--output", help="subtitle file path, without the .srt extension. "
+                                               "Defaults to the input's path")
+    parser.add_argument("--from-lang", dest="fromLang", default=Config.fromLang)
+    parser.add_argument("--to-lang", dest="toLangs", action="append",
+                        help="give more than once to write a subtitle file per language")
+    parser.add_argument("--asr", choices=asrBackends, default=Config.asrBackend)
+    parser.add_argument("--translator", choices=translationBackends, default=Config.translationBackend)
+    parser.add_argument("--model", default=Config.chatGPTModel)
+    parser.add_argument("--cascade-model", dest="cascadeModel", default=Config.cascadeModel)
+    parser.add_argument("--service-tier", dest="serviceTier", choices=get_args(ServiceTier), default=Config.chatGPTServiceTier)
+    parser.add_argument("--context-file", dest="contextFile", help="text file of context for the translator, "
+                                                                   "instead of Config's")
+    parser.add_argument("--streaming", action=argparse.BooleanOptionalAction, default=Config.streamingPipelineEnabled)
+    parser.add_argument("--batch-api", dest="batchAPI", action=argparse.BooleanOptionalAction, default=Config.batchAPIEnabled)
+    parser.add_argument("--vad", action=argparse.BooleanOptionalAction, default=Config.vadEnabled)
+    parser.add_argument("--fingerprint-dedup", dest="fingerprintDedup", action=argparse.BooleanOptionalAction,
+                        default=Config.fingerprintDedupEnabled)
+    parser.add_argument("--whisper-concurrency", dest="whisperConcurrency", type=int, default=Config.whisperConcurrency)
+    parser.add_argument("--translation-concurrency", dest="translationConcurrency", type=int,
+                        default=Config.translationConcurrency)
+    return parser.parse_args()
+
+
+def applyArguments(args):
+    """
+    Overrides Config with the command line arguments, before any module that reads Config is imported
+    """
+    if args.input:
+        Config.inputFile = args.input
+        Config.outputFile = os.path.splitext(args.input)[0]
+        if os.path.splitext(args.input)[1].lower() == ".srt":
+            # don't write over an srt file being translated
+            Config.outputFile += ".translated"
+    if args.output:
+        Config.outputFile = args.output
+    Config.fromLang = args.fromLang
+    if args.toLangs:
+        Config.toLangs = args.toLangs
+        Config.toLang = args.toLangs[0]
+    Config.asrBackend = args.asr
+    Config.translationBackend = args.translator
+    Config.chatGPTModel = args.model
+    Config.cascadeModel = args.cascadeModel
+    Config.chatGPTServiceTier = args.serviceTier
+    if args.contextFile:
+        with open(args.contextFile, "r", encoding="utf-8") as f:
+            Config.configTranslationContext = f.read()
+    Config.streamingPipelineEnabled = args.streaming
+    Config.batchAPIEnabled = args.batchAPI
+    Config.vadEnabled = args.vad
+    Config.fingerprintDedupEnabled = args.fingerprintDedup
+    Config.whisperConcurrency = args.whisperConcurrency
+    Config.translationConcurrency = args.translationConcurrency
+
+
+def outputFileOf(toLang, outputFile=None):
+    outputFile = outputFile or Config.outputFile
+    # the output file is named as before when translating into a single language
+    return outputFile if len(Config.toLangs) == 1 else f"{outputFile}.{Config.languageCode(toLang)}"
+
+
+async def runStreamingPipeline(repeatedSpans, inputFile=None, outputFile=None, requestLimit=None):
+    """
+    Transcription, translation and writing run at the same time, each passing on phrases as soon as they are ready.
+    requestLimit is shared with other files being translated at the same time
+    """
+    with importTimer("streaming pipeline"):
+        from ASROpenAIWhisper import ASROpenAIWhisper
+        from MultiLanguageTranslation import translateLanguagesStream
+        from SubtitleWriter import SubtitleFileWriter
+
+    inputFile = inputFile or Config.inputFile
+    reusedPhrases = deque(sorted([phrase for span in repeatedSpans for phrase in span.phrases], key=lambda phrase: phrase.start))
 
-    # phrases = ASRFromSrtFile().speechToText(outputFile + ".srt")
+    async def transcribedPhrases():
+        async for phraseBatch in ASROpenAIWhisper().speechToTextStream(inputFile, Config.configWhisperPrompt,
+                                                                       Config.languageCode(Config.fromLang),
+                                                                       [(span.start, span.end) for span in repeatedSpans]):
+            # merge in the reused phrases, which are already translated if they were translated the same way
+            while reusedPhrases and phraseBatch and reusedPhrases[0].start < phraseBatch[-1].start:
+                phraseBatch.append(reusedPhrases.popleft())
+            yield sorted(phraseBatch, key=lambda phrase: phrase.start)
+        yield list(reusedPhrases)
 
-    ### text to text translation
-    TranslationBatchChatGPT().translate(phrases, configTranslationContext, chatGPTModel)
-    # TranslationLocalGPTOSS().translate(phrases, configTranslationContext, "")
-    # TranslationPassthrough().translate(phrases)
+    subtitleWriters = {toLang: SubtitleFileWriter(outputFileOf(toLang, outputFile)) for toLang in Config.toLangs}
+    phraseLists = await translateLanguagesStream(transcribedPhrases(), Config.toLangs, Config.configTranslationContext,
+                                                 Config.chatGPTModel, Config.configGlossary,
+                                                 lambda toLang, phraseBatch: subtitleWriters[toLang].add(phraseBatch),
+                                                 requestLimit)
+    for subtitleWriter in subtitleWriters.values():
+        subtitleWriter.close()
+    return phraseLists
 
-    ### write output to srt
-    writeSubtitles(phrases, outputFile)
+
+def run():
+    # reusing audio, streaming and the Batch API are built on the openai whisper and batch chatgpt backends
+    openAIWhisper = Config.asrBackend == "openai-whisper"
+    batchChatGPT = Config.translationBackend == "batch-chatgpt"
+    for enabled, name, supported in ((Config.fingerprintDedupEnabled, "Reusing repeated audio", openAIWhisper),
+                                     (Config.streamingPipelineEnabled, "Streaming", openAIWhisper and batchChatGPT),
+                                     (Config.batchAPIEnabled, "The Batch API", batchChatGPT)):
+        if enabled and not supported:
+            logger.warn(f"{name} isn't supported with {Config.asrBackend} and {Config.translationBackend}, turning it off")
+    fingerprintDedupEnabled = Config.fingerprintDedupEnabled and openAIWhisper
+    streamingPipelineEnabled = Config.streamingPipelineEnabled and openAIWhisper and batchChatGPT
+    batchAPIEnabled = Config.batchAPIEnabled and batchChatGPT
+
+    ### reuse results for audio repeated from earlier runs (openings, jingles, sponsor reads)
+    repeatedSpans = []
+    if fingerprintDedupEnabled:
+        with importTimer("audio fingerprinting"):
+            from AudioEncoder import speechSampleRate, speechChannels
+            from AudioFingerprint import FingerprintIndex, fingerprintAudio, translationSettings
+            from AudioSource import openAudioSource
+        fingerprintIndex = FingerprintIndex()
+        fingerprint = fingerprintAudio(openAudioSource(Config.inputFile, speechSampleRate, speechChannels), Config.inputFile)
+        # reused translations are into the first language
+        settings = translationSettings(Config.toLangs[0], Config.chatGPTModel, Config.configTranslationContext)
+        repeatedSpans = fingerprintIndex.findRepeatedSpans(fingerprint, settings)
+
+    if streamingPipelineEnabled:
+        ### speech to text, text to text translation and writing output to srt, all overlapping
+        phraseLists = asyncio.run(runStreamingPipeline(repeatedSpans))
+    else:
+        ### speech to text
+        asr = loadBackend(asrBackends, Config.asrBackend)()
+        fromLangCode = Config.languageCode(Config.fromLang)
+        if openAIWhisper:
+            phrases = asr.speechToText(Config.inputFile, Config.configWhisperPrompt, fromLangCode,
+                                       [(span.start, span.end) for span in repeatedSpans])
+        else:
+            phrases = asr.speechToText(Config.inputFile, Config.configWhisperPrompt, fromLangCode)
+        reusedPhrases = [phrase for span in repeatedSpans for phrase in span.phrases]
+        phrases = sorted(phrases + reusedPhrases, key=lambda phrase: phrase.start)
+
+        # the raw transcript is stored automatically, so re-running the same file doesn't waste credits re-transcribing it
+        # and a run interrupted part way through picks up from the last segment it finished
+
+        ### text to text translation, into each language of toLangs
+        # reused phrases are already translated into the first language, if they were translated the same way
+        translator = loadBackend(translationBackends, Config.translationBackend)
+        with importTimer("subtitle writer"):
+            from SubtitleWriter import writeSubtitles
+        if batchChatGPT:
+            with importTimer("multi-language translation"):
+                from MultiLanguageTranslation import translateLanguages, copyPhrases
+        if batchAPIEnabled:
+            phraseLists = copyPhrases(phrases, Config.toLangs)
+
+            def translateFiles(toLang):
+                translator(glossary=Config.configGlossary, toLang=toLang).translateFiles(
+                    [[phrase for phrase in phraseLists[toLang] if not phrase.translatedText]],
+                    Config.configTranslationContext, Config.chatGPTModel)
+
+            # each language's batch is waited on in its own thread, so they all run at the same time
+            with ThreadPoolExecutor(len(Config.toLangs)) as pool:
+                list(pool.map(translateFiles, Config.toLangs))
+        elif batchChatGPT:
+            phraseLists = asyncio.run(translateLanguages(phrases, {toLang: Config.languageCode(toLang) for toLang in Config.toLangs},
+                                                         Config.configTranslationContext, Config.chatGPTModel,
+                                                         Config.configGlossary, Config.multiLanguageResponsesEnabled))
+        else:
+            phraseLists = {toLang: [replace(phrase) for phrase in phrases] for toLang in Config.toLangs}
+            for toLang in Config.toLangs:
+                translator().translate(phraseLists[toLang], Config.configTranslationContext, Config.chatGPTModel)
+
+        ### write output to srt
+        for toLang in Config.toLangs:
+            writeSubtitles(phraseLists[toLang], outputFileOf(toLang))
+
+    if fingerprintDedupEnabled:
+        fingerprintIndex.add(fingerprint, phraseLists[Config.toLangs[0]], settings)
+
+
+if __name__ == '__main__':
+    applyArguments(parseArguments())
+    logger.info(f"Started in {(time.perf_counter() - startTime) * 1000:.0f}ms")
+    run()
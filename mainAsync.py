@@ -2,12 +2,15 @@ import asyncio
 
 from ASRSpeechmaticsAsync import ASRSpeechmatics
 from MessageBus import MessageBus
+from OpenAIClients import prewarmConnections
 from SomePrinter import SomePrinter
 from SubtitleChunkerAsync import SubtitleChunker
 from TranslationSingleLineChatGPTAsync import TranslationSingleLineChatGPT
 
 
 async def main():
+    # connect before the first line is ready, so it isn't delayed by the handshakes
+    await prewarmConnections("live")
     bus = MessageBus()
 
     asr = ASRSpeechmatics(bus)
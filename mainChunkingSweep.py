@@ -0,0 +1,66 @@
+import itertools
+import time
+from dataclasses import dataclass, replace
+from typing import List
+
+import numpy as np
+
+from Logger import logger
+from PhraseChunker import ChunkingSettings, WordArrays, defaultChunkingSettings, sweepPhraseEnds
+from TranscriptStore import TranscriptStore
+
+
+'''
+Sweeps chunking settings over every stored transcript, so the thresholds can be tuned against a whole archive
+without paying for ASR again. Word text is never decoded, only searched for end of sentence punctuation
+'''
+
+silenceTimeThresholds = [0.2, 0.25, 0.3, 0.35, 0.4, 0.5] # seconds
+targetPhraseLengths = [20, 25, 30, 35, 40] # words
+
+
+@dataclass
+class SweepResult:
+    settings: ChunkingSettings
+    lineCount: int = 0
+    wordCount: int = 0
+    lineSeconds: float = 0.0
+    forcedCount: int = 0 # lines cut at maxPhraseLength, usually mid-sentence
+
+
+def sweepSettings() -> List[ChunkingSettings]:
+    return [replace(defaultChunkingSettings, silenceTimeThreshold=silence, targetPhraseLength=target)
+            for silence, target in itertools.product(silenceTimeThresholds, targetPhraseLengths)]
+
+
+def sweepArchive(settingsList: List[ChunkingSettings], transcriptStore: TranscriptStore) -> List[SweepResult]:
+    """
+    Chunks every stored transcript with each of settingsList, returning the line statistics of each setting
+    """
+    results = [SweepResult(settings) for settings in settingsList]
+    for key in transcriptStore.keys():
+        words = WordArrays.fromStoredTranscript(transcriptStore.get(key))
+        if not len(words):
+            continue
+        for result, phraseEnds in zip(results, sweepPhraseEnds(words, settingsList)):
+            phraseStarts = np.concatenate(([0], phraseEnds[:-1] + 1))
+            lineLengths = phraseEnds - phraseStarts + 1
+            result.lineCount += len(phraseEnds)
+            result.wordCount += len(words)
+            result.lineSeconds += float(np.sum(words.ends[phraseEnds] - words.starts[phraseStarts]))
+            result.forcedCount += int(np.sum(lineLengths >= result.settings.maxPhraseLength))
+    return results
+
+
+if __name__ == '__main__':
+    startTime = time.monotonic()
+    transcriptStore = TranscriptStore()
+    results = sweepArchive(sweepSettings(), transcriptStore)
+    logger.info(f"Swept {len(results)} settings over {len(transcriptStore.keys())} stored transcript(s) "
+                f"in {time.monotonic() - startTime:.1f}s")
+    for result in results:
+        if not result.lineCount:
+            continue
+        logger.info(f"silence {result.settings.silenceTimeThreshold}s, target {result.settings.targetPhraseLength} words: "
+                    f"{result.lineCount} lines, {result.wordCount / result.lineCount:.1f} words and "
+                    f"{result.lineSeconds / result.lineCount:.1f}s per line, {result.forcedCount} forced breaks")
@@ -0,0 +1,129 @@
+import asyncio
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from datetime import timedelta
+from typing import List, Optional
+
+from AudioEncoder import speechSampleRate, speechChannels
+from AudioFingerprint import Fingerprint, FingerprintIndex, fingerprintAudio, translationSettings
+from AudioSource import openAudioSource
+from Config import multiFileInput, multiFileConcurrency, fingerprintDedupEnabled, toLangs, translationRequestLimit, \
+    chatGPTModel, configTranslationContext
+from Logger import logger
+from main import runStreamingPipeline
+
+
+'''
+Transcribes and translates every file of a folder or manifest, rather than one file per run of main.py
+- Audio is decoded, hashed and measured (and fingerprinted) in a process pool with a process per CPU,
+  into the audio cache, so the API stages of each file start with nothing left to decode
+- The API stages of up to multiFileConcurrency files run at once on one event loop, through the same streaming
+  pipeline as main.py. They share one limit on translation requests in flight, and the rate limiters of each model
+- Each file's subtitles are written as it goes, and finished as soon as that file is done
+Segments are encoded for upload by ffmpeg processes, which already run alongside each other
+'''
+
+mediaExtensions = {".mp4", ".mkv", ".webm", ".avi", ".mov", ".ts", ".m4a", ".mp3", ".aac", ".wav", ".flac", ".ogg", ".opus"}
+
+
+@dataclass
+class PreparedInput:
+    inputFile: str
+    durationSeconds: float
+    decodeSeconds: float
+    fingerprint: Optional[Fingerprint] = None
+
+
+@dataclass
+class FileReport:
+    inputFile: str
+    durationSeconds: float
+    wallSeconds: float
+    failed: bool = False
+
+
+def findInputs(path) -> List[str]:
+    """
+    Every media file in a folder, or every path listed in a manifest file (relative to the manifest),
+    skipping blank lines and lines starting with #
+    """
+    if os.path.isdir(path):
+        return sorted(os.path.join(path, name) for name in os.listdir(path)
+                      if os.path.splitext(name)[1].lower() in mediaExtensions)
+
+    with open(path, "r", encoding="utf-8") as f:
+        lines = [line.strip() for line in f]
+    return [os.path.join(os.path.dirname(path), line) for line in lines if line and not line.startswith("#")]
+
+
+def prepareInput(inputFile) -> PreparedInput:
+    """
+    Runs in the process pool. Everything it works out is cached next to the decoded audio,
+    where the API stages find it again
+    """
+    startTime = time.monotonic()
+    audioSource = openAudioSource(inputFile, speechSampleRate, speechChannels)
+    audioSource.contentHash()
+    audioSource.energyDb()
+    fingerprint = fingerprintAudio(audioSource, inputFile) if fingerprintDedupEnabled else None
+    return PreparedInput(inputFile, audioSource.durationSeconds, time.monotonic() - startTime, fingerprint)
+
+
+def throughput(durationSeconds, wallSeconds) -> str:
+    return f"{durationSeconds / 3600:.2f}h of audio in {timedelta(seconds=round(wallSeconds))} " \
+           f"({durationSeconds / max(wallSeconds, 1e-9):.1f} audio hours per hour)"
+
+
+async def processFile(preparing, fileLimit, requestLimit, fingerprintIndex) -> FileReport:
+    prepared = await preparing
+    async with fileLimit:
+        logger.info(f"--- Beginning {prepared.inputFile} ---")
+        startTime = time.monotonic()
+        settings = translationSettings(toLangs[0], chatGPTModel, configTranslationContext)
+        repeatedSpans = fingerprintIndex.findRepeatedSpans(prepared.fingerprint, settings) if prepared.fingerprint else []
+        phraseLists = await runStreamingPipeline(repeatedSpans, prepared.inputFile,
+                                                 os.path.splitext(prepared.inputFile)[0], requestLimit)
+        if prepared.fingerprint:
+            fingerprintIndex.add(prepared.fingerprint, phraseLists[toLangs[0]], settings)
+
+    report = FileReport(prepared.inputFile, prepared.durationSeconds,
+                        prepared.decodeSeconds + time.monotonic() - startTime)
+    logger.info(f"Finished {prepared.inputFile}: {throughput(report.durationSeconds, report.wallSeconds)}")
+    return report
+
+
+async def processFiles(inputFiles):
+    startTime = time.monotonic()
+    loop = asyncio.get_running_loop()
+    fileLimit = asyncio.Semaphore(max(1, multiFileConcurrency))
+    requestLimit = asyncio.Semaphore(max(1, translationRequestLimit))
+    fingerprintIndex = FingerprintIndex() if fingerprintDedupEnabled else None
+
+    async def processOrReport(inputFile, preparing):
+        try:
+            return await processFile(preparing, fileLimit, requestLimit, fingerprintIndex)
+        except Exception as e:
+            # one broken file shouldn't stop the rest
+            logger.error(f"Failed to process {inputFile}: {e!r}")
+            return FileReport(inputFile, 0.0, 0.0, failed=True)
+
+    with ProcessPoolExecutor(os.cpu_count()) as processPool:
+        # every file is queued for decoding at once, and each one's API stages start as soon as it is decoded
+        reports = await asyncio.gather(*[processOrReport(inputFile, loop.run_in_executor(processPool, prepareInput, inputFile))
+                                         for inputFile in inputFiles])
+
+    logger.info("--- Throughput ---")
+    for report in reports:
+        logger.info(f"{os.path.basename(report.inputFile)}: "
+                    f"{'failed' if report.failed else throughput(report.durationSeconds, report.wallSeconds)}")
+    finishedReports = [report for report in reports if not report.failed]
+    logger.info(f"Total: {len(finishedReports)} of {len(reports)} file(s), "
+                f"{throughput(sum(report.durationSeconds for report in finishedReports), time.monotonic() - startTime)}")
+
+
+if __name__ == '__main__':
+    inputFiles = findInputs(multiFileInput)
+    logger.info(f"Found {len(inputFiles)} input file(s) in {multiFileInput}")
+    asyncio.run(processFiles(inputFiles))
@@ -0,0 +1,108 @@
+import asyncio
+import json
+import time
+
+import openai
+import pytest
+
+try:
+    import httpx
+except ImportError: # newer openai releases are built on httpx2
+    import httpx2 as httpx
+
+from RateLimiter import RateLimiter
+
+
+'''
+Runs the rate limiter against the real openai client, with a mock transport standing in for the API
+'''
+
+responseBody = {"id": "resp_test", "object": "response", "created_at": 0, "model": "test-model", "output": [],
+                "usage": {"input_tokens": 5, "output_tokens": 5, "total_tokens": 10}}
+
+
+def mockClient(handler) -> openai.AsyncOpenAI:
+    # max_retries=0 as in OpenAIClients, so every 429 reaches the limiter
+    return openai.AsyncOpenAI(api_key="test", max_retries=0,
+                              http_client=httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+
+
+def sendRequest(client):
+    return lambda: client.responses.with_raw_response.create(model="test-model", input="test")
+
+
+def rateLimited(headers=None) -> httpx.Response:
+    return httpx.Response(429, headers=headers or {}, json={"error": {"message": "Rate limit reached", "type": "requests"}})
+
+
+def test_retryAfterPausesAndHalvesConcurrency():
+    requestTimes = []
+
+    def handler(request):
+        requestTimes.append(time.monotonic())
+        return rateLimited({"retry-after": "0.3"}) if len(requestTimes) == 1 else httpx.Response(200, json=responseBody)
+
+    limiter = RateLimiter("test", requestsPerMinute=6000, tokensPerMinute=10 ** 6)
+    response = asyncio.run(limiter.call(sendRequest(mockClient(handler))))
+
+    assert response.id == "resp_test"
+    assert len(requestTimes) == 2
+    assert requestTimes[1] - requestTimes[0] >= 0.3
+    assert limiter.rateLimitedCount == 1
+    # halved from 4 by the 429, then grown by 1/2 by the success
+    assert limiter.concurrencyLimit == pytest.approx(2.5)
+    assert limiter.inFlight == 0
+
+
+def test_resizesFromHeaders():
+    def handler(request):
+        return httpx.Response(200, json=responseBody, headers={
+            "x-ratelimit-limit-requests": "30", "x-ratelimit-remaining-requests": "3",
+            "x-ratelimit-limit-tokens": "1000", "x-ratelimit-remaining-tokens": "100"})
+
+    limiter = RateLimiter("test", requestsPerMinute=6000, tokensPerMinute=10 ** 6)
+    asyncio.run(limiter.call(sendRequest(mockClient(handler)), estimatedTokens=10,
+                             countTokens=lambda response: response.usage.total_tokens))
+
+    assert limiter.requests.capacity == 30
+    assert limiter.requests.level <= 3
+    assert limiter.tokens.capacity == 1000
+    assert limiter.tokens.level <= 100
+    assert limiter.inFlight == 0
+
+
+def test_inFlightReturnsToZero():
+    inFlight = 0
+    maxInFlight = 0
+    requestCount = 0
+
+    async def handler(request):
+        nonlocal inFlight, maxInFlight, requestCount
+        requestCount += 1
+        number = requestCount
+        inFlight += 1
+        maxInFlight = max(maxInFlight, inFlight)
+        await asyncio.sleep(0.01)
+        inFlight -= 1
+        if number % 4 == 0:
+            return rateLimited({"retry-after": "0"})
+        if json.loads(request.content)["input"] == "bad":
+            return httpx.Response(400, json={"error": {"message": "Bad request", "type": "invalid_request_error"}})
+        return httpx.Response(200, json=responseBody)
+
+    limiter = RateLimiter("test", requestsPerMinute=6000, tokensPerMinute=10 ** 6)
+
+    async def run():
+        client = mockClient(handler)
+        calls = [limiter.call(sendRequest(client)) for _ in range(12)]
+        calls.append(limiter.call(lambda: client.responses.with_raw_response.create(model="test-model", input="bad")))
+        return await asyncio.gather(*calls, return_exceptions=True)
+
+    results = asyncio.run(run())
+
+    assert all(result.id == "resp_test" for result in results[:-1])
+    # errors other than rate limits and server errors aren't retried
+    assert isinstance(results[-1], openai.BadRequestError)
+    assert limiter.rateLimitedCount > 0
+    assert maxInFlight <= 4
+    assert limiter.inFlight == 0